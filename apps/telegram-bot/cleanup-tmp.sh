@@ -6,7 +6,7 @@
 #   ./cleanup-tmp.sh [дней]   # По умолчанию 7 дней
 #
 
-TMP_DIR="/opt/ai-workspace/apps/telegram-bot/tmp"
+TMP_DIR="/opt/ai-workspace/.claude/skills/telegram-notifier/tmp"  # Сюда бот пишет временные файлы /send_file
 DAYS_OLD=${1:-7}
 
 echo "🧹 Очистка временных файлов..."
@@ -9,13 +9,22 @@ import sys
 import asyncio
 import json
 import time
+import uuid
+import hashlib
+import contextlib
+import signal
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures.process import BrokenProcessPool
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BotCommand, MessageEntity
 from aiogram.filters import CommandStart, Command
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import DeleteMessage, EditMessageText, EditMessageReplyMarkup, SendChatAction
 from aiohttp import web
+import aiofiles
 from loguru import logger
 from dotenv import load_dotenv
 
@@ -24,11 +33,63 @@ load_dotenv("/opt/ai-workspace/.env")
 
 # Конфигурация
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-ALLOWED_CHAT_ID = int(os.getenv("TELEGRAM_CHAT_ID", "0"))
+ALLOWED_CHAT_ID = int(os.getenv("TELEGRAM_CHAT_ID", "0"))  # Основной чат
+# Дополнительные разрешённые чаты (через запятую) - каждый со своей сессией и очередью
+EXTRA_CHAT_IDS = [int(chat_id) for chat_id in os.getenv("TELEGRAM_CHAT_IDS", "").split(",") if chat_id.strip()]
+ALLOWED_CHAT_IDS = [ALLOWED_CHAT_ID] + [chat_id for chat_id in EXTRA_CHAT_IDS if chat_id != ALLOWED_CHAT_ID]
 HTTP_PORT = int(os.getenv("BOT_HTTP_PORT", "8081"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 CLAUDE_CLI_PATH = "/usr/local/bin/claude"  # Полный путь к Claude CLI
 
+# Warm pool: сколько заранее запущенных Claude CLI держать на модель (0 - выключен).
+# По умолчанию выключен: `claude -p -` ждёт промпт в stdin только ~3 сек (см. WARM POOL CLAUDE CLI)
+CLAUDE_POOL_SIZE = int(os.getenv("CLAUDE_POOL_SIZE", "0"))
+# Через сколько секунд простоя тёплый процесс перезапускается (подхватывает свежий конфиг)
+CLAUDE_POOL_MAX_IDLE = int(os.getenv("CLAUDE_POOL_MAX_IDLE", "1800"))
+# Сколько процессов Claude может работать одновременно (на все чаты)
+CLAUDE_MAX_CONCURRENT = int(os.getenv("CLAUDE_MAX_CONCURRENT", "2"))
+# Сколько файлов одновременно скачивать с серверов Telegram
+TELEGRAM_DOWNLOAD_CONCURRENCY = int(os.getenv("TELEGRAM_DOWNLOAD_CONCURRENCY", "4"))
+# Максимальный размер скачиваемого файла, MB (Bot API отдаёт до 20 MB; больше - только локальный Bot API сервер)
+TELEGRAM_MAX_DOWNLOAD_MB = int(os.getenv("TELEGRAM_MAX_DOWNLOAD_MB", "20"))
+# Предобработка изображений для Claude (нужен Pillow): уменьшение, без EXIF, перекодирование
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1568"))  # Длинная сторона, px
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()  # webp / jpeg
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# Очистка uploads/tmp: квота на диск (MB) и максимальный возраст файла (дни)
+UPLOADS_QUOTA_MB = int(os.getenv("UPLOADS_QUOTA_MB", "2048"))
+UPLOADS_MAX_AGE_DAYS = float(os.getenv("UPLOADS_MAX_AGE_DAYS", "7"))
+# Сколько процессов извлекают текст из PDF/DOCX/XLSX/CSV параллельно
+DOCUMENT_EXTRACT_WORKERS = int(os.getenv("DOCUMENT_EXTRACT_WORKERS", "2"))
+# Видео и видео-заметки: сколько кадров извлекать (0 - только звук) и сколько ffmpeg одновременно
+VIDEO_KEYFRAMES = int(os.getenv("VIDEO_KEYFRAMES", "4"))
+VIDEO_PROCESS_WORKERS = int(os.getenv("VIDEO_PROCESS_WORKERS", "2"))
+# Транскрипция: длина сегмента длинного аудио (сек), параллельные запросы, транскрибировать ли аудиофайлы (не только голосовые)
+TRANSCRIBE_CHUNK_SECONDS = int(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "300"))
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", "4"))
+TRANSCRIBE_AUDIO_FILES = os.getenv("TRANSCRIBE_AUDIO_FILES", "1") == "1"
+# Backend транскрипции: auto (короткие - локально, длинные - OpenAI) / openai / local
+TRANSCRIBE_BACKEND = os.getenv("TRANSCRIBE_BACKEND", "auto").lower()
+# Локальная транскрипция (нужен faster-whisper): модель, тип вычислений, до какой длины (сек) в auto-режиме
+TRANSCRIBE_LOCAL_MODEL = os.getenv("TRANSCRIBE_LOCAL_MODEL", "small")
+TRANSCRIBE_LOCAL_COMPUTE = os.getenv("TRANSCRIBE_LOCAL_COMPUTE", "int8")
+TRANSCRIBE_LOCAL_MAX_SECONDS = int(os.getenv("TRANSCRIBE_LOCAL_MAX_SECONDS", "60"))
+# Размер кеша транскрипций (MB текста); при переполнении вытесняются давно не использованные
+TRANSCRIPT_CACHE_MB = int(os.getenv("TRANSCRIPT_CACHE_MB", "20"))
+# Auto-mode: максимальное и минимальное окно ожидания продолжения (сек), мгновенная отправка коротких вопросов
+AUTO_MODE_WINDOW = float(os.getenv("AUTO_MODE_WINDOW", "5"))
+AUTO_MODE_MIN_WINDOW = float(os.getenv("AUTO_MODE_MIN_WINDOW", "1.5"))
+AUTO_MODE_INSTANT = os.getenv("AUTO_MODE_INSTANT", "1") == "1"
+# Исходящие запросы к Telegram: глобально в секунду, в личный чат в секунду и допустимый всплеск
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+# Watchdog: запуск без событий stream-json дольше этого (сек) считается зависшим
+CLAUDE_STALL_TIMEOUT = int(os.getenv("CLAUDE_STALL_TIMEOUT", "900"))
+# Потолок жёсткого дедлайна запуска (сек), как бы ни растянулась история
+CLAUDE_HARD_TIMEOUT_MAX = int(os.getenv("CLAUDE_HARD_TIMEOUT_MAX", "7200"))
+
 # Настройка логирования
 logger.remove()
 logger.add(
@@ -66,148 +127,297 @@ message_history = []
 SESSION_FILE = "/opt/ai-workspace/apps/telegram-bot/active_session.txt"
 CONTEXT_FILE = "/opt/ai-workspace/apps/telegram-bot/telegram_agent_context.md"
 CLAUDE_WORKING_DIR = "/opt/ai-workspace"
+JOB_QUEUE_FILE = "/opt/ai-workspace/apps/telegram-bot/job_queue.json"
+RUN_HISTORY_FILE = "/opt/ai-workspace/apps/telegram-bot/run_history.json"
+TRANSCRIPT_CACHE_FILE = "/opt/ai-workspace/apps/telegram-bot/transcript_cache.json"
 
-# Время последней активности (для проверки неактивности)
-last_activity_time = time.time()
+SESSIONS_DIR = "/opt/ai-workspace/apps/telegram-bot/sessions"  # Сессии дополнительных чатов
 
-# Флаги отправленных уведомлений
-notification_30min_sent = False
-notification_8h_sent = False
+# Кеш для медиа-групп (альбомов с несколькими файлами)
+# Структура: {media_group_id: {'messages': [Message, ...], 'timer': asyncio.Task}}
+media_groups_cache = {}
+# Сколько ждать следующую часть альбома (сек) перед обработкой группы
+MEDIA_GROUP_SETTLE = 1.0
 
-# Активный процесс Claude (для возможности остановки)
-active_claude_process = None
+# Длительности последних задач (секунды) - для оценки ETA
+job_durations = []
+JOB_DURATIONS_KEEP = 20
 
-# Текущая модель Claude (по умолчанию opus - умный режим)
-current_model = "opus"
+# Глобальный лимит параллельных запусков Claude (на все чаты)
+claude_semaphore = asyncio.Semaphore(CLAUDE_MAX_CONCURRENT)
+running_claude_jobs = 0
 
-# Флаг блокировки параллельных сессий
-is_processing = False
 
-# Флаг процесса остановки (для защиты от race condition)
-is_stopping = False
+class ChatState:
+    """
+    Состояние одного чата: своя сессия Claude, процесс, очередь задач и режимы накопления.
+    Чаты работают независимо, общий только лимит CLAUDE_MAX_CONCURRENT.
+    """
 
-# Кеш для медиа-групп (альбомов с несколькими файлами)
-# Структура: {media_group_id: {'messages': [Message, ...], 'timer': asyncio.Task}}
-media_groups_cache = {}
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+
+        # Файл сессии (основной чат - прежний active_session.txt)
+        if chat_id == ALLOWED_CHAT_ID:
+            self.session_file = SESSION_FILE
+        else:
+            self.session_file = os.path.join(SESSIONS_DIR, f"{chat_id}.txt")
 
-# Трекинг промежуточных сообщений для прогресс-индикатора
-intermediate_message_ids = []  # ID всех промежуточных сообщений от бота
-current_hourglass_message_id = None  # ID текущего ⌛ сообщения
+        # Время последней активности (для проверки неактивности)
+        self.last_activity_time = time.time()
 
-# === MULTI-MESSAGE ACCUMULATION STATE ===
+        # Флаги отправленных уведомлений
+        self.notification_30min_sent = False
+        self.notification_8h_sent = False
 
-# Режим /multi (явный)
-multi_mode_active = False
-multi_messages = []
-multi_control_message_ids = []
+        # Активный процесс Claude (для возможности остановки)
+        self.active_claude_process = None
 
-# Авто-режим (неявный, с таймером 5 сек)
-auto_mode = {
-    'active': False,
-    'messages': [],
-    'timer_task': None,
-    'control_message_id': None,
-    'waiting_for_next': False
-}
+        # Текущая модель Claude (по умолчанию opus - умный режим)
+        self.current_model = "opus"
+
+        # Флаг блокировки параллельных сессий (в рамках чата)
+        self.is_processing = False
+        # Когда завершился последний запуск (monotonic): тёплый --resume, запущенный раньше, видит устаревшую сессию
+        self.last_run_finished_at = 0.0
+
+        # Флаг процесса остановки (для защиты от race condition)
+        self.is_stopping = False
+
+        # Трекинг промежуточных сообщений для прогресс-индикатора
+        self.intermediate_message_ids = []  # ID всех промежуточных сообщений от бота
+        self.current_hourglass_message_id = None  # ID текущего ⌛ сообщения
+
+        # Режим /multi (явный)
+        self.multi_mode_active = False
+        self.multi_messages = []
+        self.multi_control_message_ids = []
 
-# Текущий вопрос от Claude (для /tg-ask)
-pending_question = None
+        # Авто-режим (неявный, с адаптивным таймером до AUTO_MODE_WINDOW сек)
+        self.auto_mode = {
+            'active': False,
+            'messages': [],
+            'timer_task': None,
+            'control_message_id': None,
+            'waiting_for_next': False,
+            # Адаптивный debounce: время последнего сообщения, паузы внутри пакетов, размеры пакетов
+            'last_message_at': None,
+            'gaps': [],
+            'batch_sizes': []
+        }
 
+        # Текущий вопрос от Claude (для /tg-ask)
+        self.pending_question = None
 
-def read_active_session():
-    """Читает session_id из файла. Возвращает None если нет активной сессии."""
+        # Очередь задач для Claude (FIFO, сохраняется в JOB_QUEUE_FILE)
+        # Структура задачи: {'id', 'chat_id', 'text', 'files', 'title', 'details', 'enqueued_at', 'notice_message_id'}
+        self.job_queue = []
+        self.job_queue_event = asyncio.Event()
+
+        # Текущая выполняемая задача (для ETA в /status)
+        self.current_job = None
+
+        # Подготовка задач (скачивание файлов, транскрипция) идёт по одной,
+        # чтобы задачи попадали в очередь в порядке отправки
+        self.ingest_lock = asyncio.Lock()
+        # Фоновая подготовка ещё не отправленных сообщений: {message_id: (Message, asyncio.Task)}
+        self.ingest_tasks = {}
+
+        # Статистика последнего запуска Claude (для /status)
+        self.last_run_stats = None
+
+        # Файлы, переданные в текущую сессию Claude - очистка uploads их не трогает
+        self.session_files = set()
+
+
+# Состояния разрешённых чатов: {chat_id: ChatState}
+chats = {chat_id: ChatState(chat_id) for chat_id in ALLOWED_CHAT_IDS}
+
+
+def is_allowed_chat(chat_id: int) -> bool:
+    """Проверяет, входит ли чат в список разрешённых."""
+    return chat_id in chats
+
+
+def write_file_atomic(path: str, content: str):
+    """
+    Атомарная запись файла: temp-файл в той же папке + fsync + rename.
+    При падении посреди записи на диске остаётся либо старая, либо новая версия.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # fsync папки - чтобы сам rename пережил падение
     try:
-        with open(SESSION_FILE, 'r') as f:
-            content = f.read().strip()
-            # Пропускаем строки с комментариями
-            lines = [line for line in content.split('\n') if line and not line.startswith('#')]
-            if lines:
-                session_id = lines[0].strip()
-                return session_id if session_id else None
-            return None
-    except FileNotFoundError:
-        return None
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+class SessionStore:
+    """
+    Реестр активных сессий Claude по чатам.
+
+    Держит session_id и версию контекста в памяти (чтение без I/O - /send, /status,
+    проверка неактивности), а каждое изменение сразу атомарно пишет в файл сессии чата.
+    Файлы читаются один раз - при старте бота (load).
+    """
+
+    def __init__(self):
+        # {chat_id: {'session_id': str | None, 'context_hash': str | None}}
+        self.entries = {}
+
+    @staticmethod
+    def _parse(content: str) -> dict:
+        """Разбирает файл сессии: session_id - первая строка без #, версия контекста - строка '# Context: '."""
+        entry = {'session_id': None, 'context_hash': None}
+        for line in content.split('\n'):
+            line = line.strip()
+            if line.startswith("# Context: "):
+                entry['context_hash'] = line[len("# Context: "):].strip() or None
+            elif line and not line.startswith('#') and not entry['session_id']:
+                entry['session_id'] = line
+        return entry
+
+    def load(self, chat: ChatState):
+        """Загружает сессию чата из файла в память."""
+        try:
+            with open(chat.session_file, 'r') as f:
+                self.entries[chat.chat_id] = self._parse(f.read())
+        except FileNotFoundError:
+            self.entries[chat.chat_id] = {'session_id': None, 'context_hash': None}
+        except Exception as e:
+            logger.error(f"[{chat.chat_id}] Не удалось загрузить файл сессии: {e}")
+            self.entries[chat.chat_id] = {'session_id': None, 'context_hash': None}
+
+        session_id = self.entries[chat.chat_id]['session_id']
+        if session_id:
+            logger.info(f"[{chat.chat_id}] Восстановлена сессия {session_id}")
+
+    def get(self, chat: ChatState) -> dict:
+        """Запись сессии чата (загружается с диска, если ещё не загружена)."""
+        if chat.chat_id not in self.entries:
+            self.load(chat)
+        return self.entries[chat.chat_id]
+
+    def set(self, chat: ChatState, session_id: str, context_hash: str = None):
+        """Запоминает сессию чата и атомарно сохраняет её на диск."""
+        self.entries[chat.chat_id] = {'session_id': session_id, 'context_hash': context_hash}
+        content = "# Active Claude Code session ID\n"
+        content += f"# Created: {datetime.now().isoformat()}\n"
+        if context_hash:
+            content += f"# Context: {context_hash}\n"
+        content += f"{session_id}\n"
+        write_file_atomic(chat.session_file, content)
+
+    def clear(self, chat: ChatState):
+        """Сбрасывает сессию чата и атомарно сохраняет пустой файл сессии."""
+        self.entries[chat.chat_id] = {'session_id': None, 'context_hash': None}
+        write_file_atomic(
+            chat.session_file,
+            "# Active Claude Code session ID\n"
+            "# When empty - no active session\n"
+            "#\n"
+        )
+
 
+session_store = SessionStore()
 
-def save_session_id(session_id: str):
-    """Сохраняет session_id в файл."""
-    with open(SESSION_FILE, 'w') as f:
-        f.write(f"# Active Claude Code session ID\n")
-        f.write(f"# Created: {datetime.now().isoformat()}\n")
-        f.write(f"{session_id}\n")
-    logger.info(f"Session ID сохранён: {session_id}")
 
+def read_active_session(chat: ChatState):
+    """Возвращает session_id чата (из памяти). None если нет активной сессии."""
+    return session_store.get(chat)['session_id']
 
-def clear_session():
-    """Очищает файл сессии."""
-    with open(SESSION_FILE, 'w') as f:
-        f.write("# Active Claude Code session ID\n")
-        f.write("# When empty - no active session\n")
-        f.write("#\n")
-    logger.info("Session ID очищен")
 
+def save_session_id(chat: ChatState, session_id: str, context_hash: str = None):
+    """
+    Сохраняет session_id чата.
+    context_hash - версия контекста TG-агента, которую эта сессия уже получила.
+    """
+    session_store.set(chat, session_id, context_hash)
+    logger.info(f"[{chat.chat_id}] Session ID сохранён: {session_id}")
+
+
+def read_session_context_hash(chat: ChatState) -> str | None:
+    """Возвращает версию контекста TG-агента, отправленную в текущую сессию чата."""
+    return session_store.get(chat)['context_hash']
 
-async def cleanup_intermediate_messages():
+
+def clear_session(chat: ChatState):
+    """Очищает сессию чата."""
+    session_store.clear(chat)
+    logger.info(f"[{chat.chat_id}] Session ID очищен")
+
+
+async def cleanup_intermediate_messages(chat: ChatState):
     """
     Удаляет все промежуточные сообщения КРОМЕ последнего (финального) и индикатор прогресса ⌛.
     Вызывается перед началом новой задачи.
     """
-    global intermediate_message_ids, current_hourglass_message_id
-
     try:
         # Если нет сообщений для очистки - выходим
-        if not intermediate_message_ids and not current_hourglass_message_id:
+        if not chat.intermediate_message_ids and not chat.current_hourglass_message_id:
             return
 
         # Удаляем все промежуточные сообщения КРОМЕ последнего
         # Последнее сообщение = финальный ответ Claude, оставляем его
         # Исключение: если сообщение только одно (например "Обрабатываю..." без ответа),
         # удаляем и его тоже
-        if len(intermediate_message_ids) == 1:
+        if len(chat.intermediate_message_ids) == 1:
             # Только одно сообщение - скорее всего "Обрабатываю..." без ответа
-            messages_to_delete = intermediate_message_ids
-        elif len(intermediate_message_ids) > 1:
+            messages_to_delete = chat.intermediate_message_ids
+        elif len(chat.intermediate_message_ids) > 1:
             # Несколько сообщений - удаляем все кроме последнего
-            messages_to_delete = intermediate_message_ids[:-1]
+            messages_to_delete = chat.intermediate_message_ids[:-1]
         else:
             # Нет сообщений
             messages_to_delete = []
 
         for message_id in messages_to_delete:
             try:
-                await bot.delete_message(chat_id=ALLOWED_CHAT_ID, message_id=message_id)
+                await bot.delete_message(chat_id=chat.chat_id, message_id=message_id)
                 logger.debug(f"Удалено промежуточное сообщение: {message_id}")
             except Exception as e:
                 logger.warning(f"Не удалось удалить промежуточное сообщение {message_id}: {e}")
 
         # Удаляем индикатор прогресса ⌛
-        if current_hourglass_message_id:
+        if chat.current_hourglass_message_id:
             try:
-                await bot.delete_message(chat_id=ALLOWED_CHAT_ID, message_id=current_hourglass_message_id)
-                logger.debug(f"Удален индикатор прогресса: {current_hourglass_message_id}")
+                await bot.delete_message(chat_id=chat.chat_id, message_id=chat.current_hourglass_message_id)
+                logger.debug(f"Удален индикатор прогресса: {chat.current_hourglass_message_id}")
             except Exception as e:
                 logger.warning(f"Не удалось удалить индикатор прогресса: {e}")
 
         # Очищаем списки
-        intermediate_message_ids.clear()
-        current_hourglass_message_id = None
+        chat.intermediate_message_ids.clear()
+        chat.current_hourglass_message_id = None
 
-        logger.info("✅ Промежуточные сообщения и прогресс-индикатор очищены")
+        logger.info(f"[{chat.chat_id}] ✅ Промежуточные сообщения и прогресс-индикатор очищены")
 
     except Exception as e:
         logger.error(f"Ошибка при очистке промежуточных сообщений: {e}")
 
 
-def update_activity():
-    """Обновляет время последней активности и сбрасывает флаги уведомлений."""
-    global last_activity_time, notification_30min_sent, notification_8h_sent
-    last_activity_time = time.time()
+def update_activity(chat: ChatState):
+    """Обновляет время последней активности чата и сбрасывает флаги уведомлений."""
+    chat.last_activity_time = time.time()
     # Сбрасываем флаги уведомлений при любой активности
-    notification_30min_sent = False
-    notification_8h_sent = False
+    chat.notification_30min_sent = False
+    chat.notification_8h_sent = False
 
 
-async def send_progress_indicator():
+async def send_progress_indicator(chat_id: int):
     """
     Отправляет кастомный эмодзи прогресс-индикатора из набора NewsEmoji.
     Custom emoji ID: 5386367538735104399
@@ -216,7 +426,7 @@ async def send_progress_indicator():
         Message ID отправленного индикатора
     """
     hourglass_msg = await bot.send_message(
-        chat_id=ALLOWED_CHAT_ID,
+        chat_id=chat_id,
         text="⏳",  # Фоллбэк для клиентов без поддержки custom emoji
         entities=[
             MessageEntity(
@@ -230,47 +440,38 @@ async def send_progress_indicator():
     return hourglass_msg.message_id
 
 
-def set_model(model: str):
-    """Устанавливает модель Claude."""
-    global current_model
-    current_model = model
-    logger.info(f"Модель изменена на: {model}")
+def set_model(chat: ChatState, model: str):
+    """Устанавливает модель Claude для чата."""
+    chat.current_model = model
+    logger.info(f"[{chat.chat_id}] Модель изменена на: {model}")
 
+    # Прогреваем пул под новую модель (воркеры старой модели будут убиты)
+    asyncio.create_task(claude_pool_refill())
 
-async def stop_claude_process():
-    """Останавливает активный процесс Claude (если есть)."""
-    global active_claude_process, is_stopping
 
-    if active_claude_process and active_claude_process.returncode is None:
+async def stop_claude_process(chat: ChatState):
+    """Останавливает активный процесс Claude чата (если есть)."""
+    process = chat.active_claude_process
+
+    if process and process.returncode is None:
         try:
             # Устанавливаем флаг остановки (защита от race condition)
-            is_stopping = True
+            chat.is_stopping = True
 
-            pid = active_claude_process.pid
-            logger.info(f"Останавливаем Claude процесс {pid}...")
+            pid = process.pid
+            logger.info(f"[{chat.chat_id}] Останавливаем Claude процесс {pid} (группа процессов)...")
 
-            # Шаг 1: Пробуем graceful shutdown (SIGTERM)
-            # Используем process group kill чтобы убить всё дерево процессов
-            try:
-                active_claude_process.terminate()
-                await asyncio.wait_for(active_claude_process.wait(), timeout=2.0)
-                logger.info(f"Процесс {pid} остановлен gracefully")
-            except asyncio.TimeoutError:
-                # Шаг 2: Если не помогло за 2 секунды - жёсткое убийство (SIGKILL)
-                logger.warning(f"Процесс {pid} не ответил на SIGTERM, использую SIGKILL")
-                active_claude_process.kill()
-                await active_claude_process.wait()
-                logger.info(f"Процесс {pid} убит через SIGKILL")
+            await terminate_process_group(process)
 
             # ⚠️ ВАЖНО: Очищаем переменную процесса
-            active_claude_process = None
+            chat.active_claude_process = None
             # НЕ трогаем is_processing - он сбросится в finally блоке обработчика
             logger.info("Процесс остановлен, флаг is_stopping установлен")
             return True
 
         except Exception as e:
             logger.error(f"Ошибка остановки процесса: {e}")
-            active_claude_process = None  # Очищаем даже при ошибке
+            chat.active_claude_process = None  # Очищаем даже при ошибке
             # НЕ трогаем is_processing
             return False
 
@@ -278,816 +479,3286 @@ async def stop_claude_process():
     return False
 
 
-async def start_new_session(user_prompt: str, files: list[dict] = None):
-    """Запускает новую сессию Claude Code."""
-    global active_claude_process, is_processing, is_stopping
-    import tempfile
+# === ГРУППЫ ПРОЦЕССОВ И РЕСУРСЫ ЗАПУСКОВ ===
 
-    try:
-        # Читаем контекст для TG-агента
-        with open(CONTEXT_FILE, 'r') as f:
-            context = f.read()
-
-        # Формируем секцию с файлами если есть
-        files_section = ""
-        if files:
-            files_section = "\n\n📎 **Файлы прикреплённые к сообщению:**\n\n"
-
-            # Маппинг типов на эмодзи
-            type_emoji = {
-                'photo': '📸 Фото',
-                'document': '📄 Документ',
-                'video': '🎥 Видео',
-                'audio': '🎵 Аудио',
-                'voice': '🎤 Голосовое сообщение',
-                'video_note': '⭕ Видео-заметка'
-            }
+# Как часто снимать ресурсы группы процессов запуска из /proc
+RUN_SAMPLE_INTERVAL = 1.0
+
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Накопленные ресурсы по моделям (для /status): {model: {'runs', 'wall', 'cpu', 'peak_rss'}}
+model_resource_stats = {}
 
-            has_photos = False
 
-            for file_info in files:
-                file_type_label = type_emoji.get(file_info['type'], '📎 Файл')
-                files_section += f"{file_type_label}: {file_info['name']}\n"
-                files_section += f"Путь: {file_info['path']}\n"
+def kill_process_group(process: asyncio.subprocess.Process, sig: int):
+    """
+    Отправляет сигнал всей группе процессов запуска.
+    Claude запускается в своей сессии (start_new_session), pgid == pid лидера.
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass  # Группа уже пуста
+    except PermissionError as e:
+        logger.warning(f"Нет прав на сигнал группе {process.pid}: {e}")
 
-                if file_info.get('size'):
-                    size_mb = file_info['size'] / (1024 * 1024)
-                    size_text = f"{size_mb:.2f} MB" if size_mb >= 1 else f"{file_info['size'] / 1024:.2f} KB"
-                    files_section += f"Размер: {size_text}\n"
 
-                files_section += "\n"
+async def terminate_process_group(process: asyncio.subprocess.Process, timeout: float = 2.0):
+    """
+    Останавливает запуск вместе со всеми его tool-процессами:
+    SIGTERM группе, через timeout секунд - SIGKILL, затем добивает оставшихся в группе.
+    """
+    pid = process.pid
 
-                if file_info['type'] == 'photo':
-                    has_photos = True
+    # Шаг 1: Пробуем graceful shutdown (SIGTERM всей группе - claude и его tool-процессам)
+    try:
+        kill_process_group(process, signal.SIGTERM)
+        await asyncio.wait_for(process.wait(), timeout=timeout)
+        logger.info(f"Процесс {pid} остановлен gracefully")
+    except asyncio.TimeoutError:
+        # Шаг 2: Если не помогло - жёсткое убийство (SIGKILL)
+        logger.warning(f"Процесс {pid} не ответил на SIGTERM, использую SIGKILL")
+        kill_process_group(process, signal.SIGKILL)
+        await process.wait()
+        logger.info(f"Процесс {pid} убит через SIGKILL")
 
-            if has_photos:
-                files_section += "💡 Используй Read tool чтобы 'увидеть' изображение(я).\n\n"
+    # Добиваем оставшихся в группе (tool-процессы, пережившие SIGTERM)
+    kill_process_group(process, signal.SIGKILL)
 
-        # Формируем полный промпт
-        full_prompt = f"""{context}
 
----
-[Новое сообщение от пользователя]
-{files_section}
-{user_prompt if user_prompt else "Проанализируй прикреплённые файлы"}
-"""
+def sample_process_group(pgid: int) -> dict | None:
+    """
+    Снимает ресурсы группы процессов из /proc.
+
+    Returns:
+        {'processes', 'rss', 'cpu'} или None если /proc недоступен.
+        cpu - user+system всех живых процессов группы вместе с уже завершёнными
+        потомками, которых они дождались (cutime/cstime), в секундах.
+    """
+    try:
+        pids = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return None
 
-        # Сохраняем промпт во временный файл в shared директории
-        import time
-        tmp_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/tmp"
-        os.makedirs(tmp_dir, exist_ok=True)  # Создаём директорию если её нет
-        tmp_file = f"{tmp_dir}/prompt_{int(time.time() * 1000)}.txt"
-        with open(tmp_file, 'w') as f:
-            f.write(full_prompt)
-        os.chmod(tmp_file, 0o644)  # Читаемый для всех
+    processes = 0
+    rss = 0
+    cpu_ticks = 0
 
+    for pid in pids:
         try:
-            # Запускаем Claude Code в headless режиме
-            cmd = f'export IS_SANDBOX=1 && cd {CLAUDE_WORKING_DIR} && cat {tmp_file} | {CLAUDE_CLI_PATH} --model {current_model} --dangerously-skip-permissions -p - --output-format json'
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue  # Процесс успел завершиться
 
-            active_claude_process = await asyncio.create_subprocess_shell(
-                cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+        # comm может содержать пробелы и скобки - поля считаем после последней ')'
+        fields = stat[stat.rfind(b')') + 2:].split()
+        if int(fields[2]) != pgid:
+            continue
 
-            # Сохраняем локальную ссылку (защита от race condition с stop_claude_process)
-            local_process = active_claude_process
-            stdout, stderr = await local_process.communicate()
-        finally:
-            # Удаляем временный файл
-            os.remove(tmp_file)
+        processes += 1
+        cpu_ticks += sum(int(value) for value in fields[11:15])  # utime, stime, cutime, cstime
+        rss += int(fields[21]) * PAGE_SIZE
 
-        # Используем локальную ссылку (active_claude_process может быть None после stop_claude_process)
-        if local_process.returncode != 0:
-            error_msg = stderr.decode()
-            logger.error(f"Claude failed: {error_msg}")
-            active_claude_process = None  # Очищаем при ошибке
+    return {'processes': processes, 'rss': rss, 'cpu': cpu_ticks / CLK_TCK}
 
-            # Проверяем: был ли процесс остановлен пользователем (/stop или /tg-ask)?
-            if is_stopping:
-                logger.info("Процесс был остановлен пользователем - пробуем сохранить session_id")
-                # Попытаемся извлечь session_id из stdout даже при остановке
-                try:
-                    stdout_text = stdout.decode()
-                    if stdout_text.strip():
-                        data = json.loads(stdout_text)
-                        session_id = data.get("session_id")
-                        if session_id:
-                            save_session_id(session_id)
-                            logger.info(f"Session ID сохранён при остановке: {session_id}")
-                except Exception as e:
-                    logger.debug(f"Не удалось извлечь session_id при остановке: {e}")
-                return
 
-            raise Exception(f"Claude execution failed: {error_msg}")
+async def monitor_run_resources(process: asyncio.subprocess.Process, run: dict):
+    """
+    Background task на время запуска: периодически снимает ресурсы группы процессов
+    и обновляет в run пиковый RSS, максимум дочерних процессов и CPU время.
+    """
+    while process.returncode is None:
+        sample = await asyncio.to_thread(sample_process_group, process.pid)
+        if sample is None:
+            return
 
-        # Парсим JSON ответ
-        data = json.loads(stdout.decode())
-        session_id = data.get("session_id")
+        if sample['processes']:
+            run['peak_rss'] = max(run['peak_rss'] or 0, sample['rss'])
+            run['max_children'] = max(run['max_children'] or 0, sample['processes'] - 1)
+            run['cpu_time'] = max(run['cpu_time'] or 0.0, sample['cpu'])
 
-        if session_id:
-            # Сохраняем session_id
-            save_session_id(session_id)
-            logger.info(f"Новая сессия создана: {session_id}")
-        else:
-            logger.warning("Session ID не найден в ответе Claude")
+        await asyncio.sleep(RUN_SAMPLE_INTERVAL)
 
-        # ⚠️ ВАЖНО: Очищаем переменную после естественного завершения
-        # Session ID сохранён, можно будет продолжить новым сообщением
-        active_claude_process = None
 
-        update_activity()
+def format_bytes(size: int | None) -> str:
+    """Форматирует размер в байтах для логов и /status."""
+    if size is None:
+        return "—"
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.2f} GB"
+    if size >= 1024 ** 2:
+        return f"{size / 1024 ** 2:.0f} MB"
+    return f"{size / 1024:.0f} KB"
 
-    except Exception as e:
-        logger.error(f"Ошибка при создании сессии: {e}")
-        # Отправляем сообщение об ошибке только если НЕ была остановка пользователем
-        if not is_stopping:
-            await bot.send_message(
-                ALLOWED_CHAT_ID,
-                f"❌ <b>Ошибка запуска Claude</b>\n\n<code>{str(e)}</code>",
-                parse_mode="HTML"
-            )
-    finally:
-        # ВСЕГДА сбрасываем ОБА флага после завершения
-        is_processing = False
-        is_stopping = False
-        logger.info("Флаги is_processing и is_stopping сброшены (start_new_session завершена)")
 
-        # Удаляем прогресс-индикатор ⏳ после завершения задачи
-        global current_hourglass_message_id
-        if current_hourglass_message_id:
-            try:
-                await bot.delete_message(chat_id=ALLOWED_CHAT_ID, message_id=current_hourglass_message_id)
-                logger.debug(f"Удален финальный ⏳ после завершения задачи: {current_hourglass_message_id}")
-                current_hourglass_message_id = None
-            except Exception as e:
-                logger.warning(f"Не удалось удалить финальный ⏳: {e}")
+def record_model_resources(run: dict, duration: float):
+    """Добавляет ресурсы завершённого запуска в статистику модели."""
+    stats = model_resource_stats.setdefault(run['model'], {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0})
+    stats['runs'] += 1
+    stats['wall'] += duration
+    stats['cpu'] += run['cpu_time'] or 0.0
+    stats['peak_rss'] = max(stats['peak_rss'], run['peak_rss'] or 0)
 
 
-async def resume_session(session_id: str, user_prompt: str, files: list[dict] = None):
-    """Продолжает существующую сессию Claude Code."""
-    global active_claude_process, is_processing, is_stopping
-    import tempfile
+# === WATCHDOG ЗАПУСКОВ ===
 
-    try:
-        # Читаем контекст (напоминание)
-        with open(CONTEXT_FILE, 'r') as f:
-            context = f.read()
-
-        # Формируем секцию с файлами если есть
-        files_section = ""
-        if files:
-            files_section = "\n\n📎 **Файлы прикреплённые к сообщению:**\n\n"
-
-            # Маппинг типов на эмодзи
-            type_emoji = {
-                'photo': '📸 Фото',
-                'document': '📄 Документ',
-                'video': '🎥 Видео',
-                'audio': '🎵 Аудио',
-                'voice': '🎤 Голосовое сообщение',
-                'video_note': '⭕ Видео-заметка'
-            }
+# Как часто watchdog проверяет запуск
+WATCHDOG_INTERVAL = 5.0
 
-            has_photos = False
+# Дедлайны (soft, hard) в секундах, пока по модели мало истории
+DEFAULT_RUN_DEADLINES = {
+    'haiku': (120, 900),
+    'sonnet': (300, 1800),
+    'opus': (600, 3600)
+}
+# Сколько успешных запусков модели нужно, чтобы считать дедлайны по истории
+RUN_HISTORY_MIN_SAMPLES = 5
+RUN_HISTORY_KEEP = 100
 
-            for file_info in files:
-                file_type_label = type_emoji.get(file_info['type'], '📎 Файл')
-                files_section += f"{file_type_label}: {file_info['name']}\n"
-                files_section += f"Путь: {file_info['path']}\n"
+# Длительности успешных запусков по моделям: {model: [секунды, ...]} (RUN_HISTORY_FILE)
+model_run_durations = {}
 
-                if file_info.get('size'):
-                    size_mb = file_info['size'] / (1024 * 1024)
-                    size_text = f"{size_mb:.2f} MB" if size_mb >= 1 else f"{file_info['size'] / 1024:.2f} KB"
-                    files_section += f"Размер: {size_text}\n"
 
-                files_section += "\n"
+def load_run_history():
+    """Загружает историю длительностей запусков (для дедлайнов watchdog)."""
+    try:
+        with open(RUN_HISTORY_FILE, 'r') as f:
+            model_run_durations.update(json.load(f))
+        logger.info(f"История запусков загружена: { {model: len(d) for model, d in model_run_durations.items()} }")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Не удалось загрузить историю запусков: {e}")
 
-                if file_info['type'] == 'photo':
-                    has_photos = True
 
-            if has_photos:
-                files_section += "💡 Используй Read tool чтобы 'увидеть' изображение(я).\n\n"
+def record_run_duration(model: str, duration: float):
+    """Добавляет длительность успешного запуска в историю модели и сохраняет её."""
+    durations = model_run_durations.setdefault(model, [])
+    durations.append(round(duration, 1))
+    del durations[:-RUN_HISTORY_KEEP]
+    try:
+        write_file_atomic(RUN_HISTORY_FILE, json.dumps(model_run_durations))
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить историю запусков: {e}")
 
-        # Формируем промпт с напоминанием о контексте
-        prompt = f"""[НАПОМИНАНИЕ: Ты в Telegram Agent режиме]
-{context}
 
----
-[Новое сообщение от пользователя]
-{files_section}
-{user_prompt if user_prompt else "Проанализируй прикреплённые файлы"}
-"""
+def percentile(values: list[float], fraction: float) -> float:
+    """Перцентиль по отсортированной выборке (без интерполяции)."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
 
-        # Сохраняем промпт во временный файл в shared директории
-        import time
-        tmp_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/tmp"
-        os.makedirs(tmp_dir, exist_ok=True)  # Создаём директорию если её нет
-        tmp_file = f"{tmp_dir}/prompt_{int(time.time() * 1000)}.txt"
-        with open(tmp_file, 'w') as f:
-            f.write(prompt)
-        os.chmod(tmp_file, 0o644)  # Читаемый для всех
 
-        try:
-            # Запускаем Claude с --resume
-            cmd = f'export IS_SANDBOX=1 && cd {CLAUDE_WORKING_DIR} && cat {tmp_file} | {CLAUDE_CLI_PATH} --model {current_model} --dangerously-skip-permissions --resume {session_id} -p - --output-format json'
+def get_run_deadlines(model: str) -> tuple[float, float]:
+    """
+    Soft и hard дедлайны запуска модели (секунды).
 
-            active_claude_process = await asyncio.create_subprocess_shell(
-                cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+    soft - p90 истории x1.5: запуск заметно дольше обычного, стоит сказать пользователю.
+    hard - max(p99 x3, максимум x2): такого не было, запуск считаем зависшим.
+    Пока истории мало - DEFAULT_RUN_DEADLINES. Дедлайны не опускаются ниже дефолтных soft / hard/2.
+    """
+    default_soft, default_hard = DEFAULT_RUN_DEADLINES.get(model, DEFAULT_RUN_DEADLINES['opus'])
+    durations = model_run_durations.get(model, [])
 
-            # Сохраняем локальную ссылку (защита от race condition с stop_claude_process)
-            local_process = active_claude_process
-            stdout, stderr = await local_process.communicate()
-        finally:
-            # Удаляем временный файл
-            os.remove(tmp_file)
+    if len(durations) < RUN_HISTORY_MIN_SAMPLES:
+        return default_soft, min(default_hard, CLAUDE_HARD_TIMEOUT_MAX)
 
-        # Используем локальную ссылку (active_claude_process может быть None после stop_claude_process)
-        if local_process.returncode != 0:
-            error_msg = stderr.decode()
-            logger.error(f"Claude resume failed: {error_msg}")
-            active_claude_process = None  # Очищаем при ошибке
+    soft = max(default_soft, percentile(durations, 0.9) * 1.5)
+    hard = max(default_hard / 2, percentile(durations, 0.99) * 3, max(durations) * 2, soft * 2)
+    return soft, min(hard, CLAUDE_HARD_TIMEOUT_MAX)
 
-            # Проверяем: был ли процесс остановлен пользователем (/stop или /tg-ask)?
-            if is_stopping:
-                logger.info(f"Процесс был остановлен пользователем - сессия {session_id} сохранена")
-                return
 
-            # Сессия протухла естественным образом - создаём новую
-            logger.info("Сессия протухла, создаю новую...")
-            clear_session()
-            await start_new_session(user_prompt, files)
-            return
+async def watch_run(chat: ChatState, process: asyncio.subprocess.Process, run: dict):
+    """
+    Background task на время запуска: следит за дедлайнами и тишиной в stream-json.
 
-        logger.info(f"Сессия {session_id} продолжена успешно")
+    - soft дедлайн: одно сообщение пользователю, что Claude ещё работает
+    - hard дедлайн или нет событий дольше CLAUDE_STALL_TIMEOUT: запуск останавливается
+      (run['timed_out'] = причина), слот очереди освобождается
+    """
+    soft, hard = get_run_deadlines(run['model'])
+    soft_pinged = False
 
-        # ⚠️ ВАЖНО: Очищаем переменную после естественного завершения
-        # Session ID сохранён, можно будет продолжить новым сообщением
-        active_claude_process = None
+    while process.returncode is None:
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        if process.returncode is not None:
+            return
 
-        update_activity()
+        now = time.monotonic()
+        elapsed = now - run['started_at']
+        silence = now - (run['last_event_at'] or run['started_at'])
 
-    except Exception as e:
-        logger.error(f"Ошибка при продолжении сессии: {e}")
+        if elapsed >= hard:
+            run['timed_out'] = f"превышен лимит {int(hard / 60)} мин для {run['model']}"
+        elif silence >= CLAUDE_STALL_TIMEOUT:
+            run['timed_out'] = f"нет активности {int(silence / 60)} мин"
 
-        # Создаём новую сессию только если НЕ была остановка пользователем
-        if not is_stopping:
-            clear_session()
-            await start_new_session(user_prompt, files)
-    finally:
-        # ВСЕГДА сбрасываем ОБА флага после завершения
-        is_processing = False
-        is_stopping = False
-        logger.info("Флаги is_processing и is_stopping сброшены (resume_session завершена)")
+        if run['timed_out']:
+            logger.error(f"[{chat.chat_id}] ⏱ Watchdog: останавливаю Claude {process.pid} - {run['timed_out']}")
+            await terminate_process_group(process)
+            return
 
-        # Удаляем прогресс-индикатор ⏳ после завершения задачи
-        global current_hourglass_message_id
-        if current_hourglass_message_id:
+        if elapsed >= soft and not soft_pinged:
+            soft_pinged = True
+            logger.info(f"[{chat.chat_id}] ⏱ Watchdog: запуск идёт {elapsed:.0f}s (soft {soft:.0f}s, hard {hard:.0f}s)")
             try:
-                await bot.delete_message(chat_id=ALLOWED_CHAT_ID, message_id=current_hourglass_message_id)
-                logger.debug(f"Удален финальный ⏳ после завершения задачи: {current_hourglass_message_id}")
-                current_hourglass_message_id = None
+                ping = await bot.send_message(
+                    chat.chat_id,
+                    f"⏳ Claude всё ещё работает ({int(elapsed / 60)} мин). "
+                    f"Остановлю автоматически через {max(1, int((hard - elapsed) / 60))} мин, "
+                    f"если не закончит. /stop - остановить сейчас."
+                )
+                chat.intermediate_message_ids.append(ping.message_id)
             except Exception as e:
-                logger.warning(f"Не удалось удалить финальный ⏳: {e}")
+                logger.warning(f"Не удалось отправить progress ping: {e}")
 
 
-# === HELPER: Медиа-группы ===
+async def notify_run_timeout(chat: ChatState, run: dict):
+    """Сообщает пользователю, что запуск остановлен watchdog (сессия сохраняется)."""
+    try:
+        await bot.send_message(
+            chat.chat_id,
+            f"⏱ <b>Claude остановлен по таймауту</b>\n\n"
+            f"Причина: {run['timed_out']}.\n"
+            f"Сессия сохранена - следующее сообщение продолжит её.",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось отправить сообщение о таймауте: {e}")
 
-async def process_media_group(media_group_id: str):
-    """
-    Обрабатывает накопленные сообщения из медиа-группы.
-    Вызывается через таймер после получения последнего файла.
-    """
-    global media_groups_cache, is_processing, is_stopping, intermediate_message_ids, current_hourglass_message_id
 
-    if media_group_id not in media_groups_cache:
-        return
+# === STREAMING RUN ENGINE ===
 
-    # Проверяем блокировку (оба флага)
-    if is_processing or is_stopping:
-        logger.warning(f"Медиа-группа {media_group_id} отклонена (processing={is_processing}, stopping={is_stopping})")
-        # Оставляем в кеше, попробуем позже
-        return
+# Лимит длины одной строки stream-json (tool_result с большим выводом может быть длинным)
+STREAM_LINE_LIMIT = 16 * 1024 * 1024
+
+# Сколько последних байт stderr храним для сообщения об ошибке
+STDERR_TAIL_LIMIT = 64 * 1024
+
+# Хуки на события stream-json: async def hook(event: dict, run: dict)
+# Вызываются для КАЖДОГО события в порядке регистрации
+stream_event_hooks = []
 
-    group_data = media_groups_cache.pop(media_group_id)
-    messages = group_data['messages']
 
-    if not messages:
+def register_stream_hook(hook):
+    """Регистрирует хук, который будет вызываться на каждое событие stream-json."""
+    stream_event_hooks.append(hook)
+    return hook
+
+
+@register_stream_hook
+async def log_progress_hook(event: dict, run: dict):
+    """Логирует прогресс выполнения: какие инструменты вызывает Claude."""
+    if event.get('type') != 'assistant':
         return
 
-    # Удаляем промежуточные сообщения от предыдущей задачи
-    await cleanup_intermediate_messages()
+    content = event.get('message', {}).get('content') or []
+    for block in content:
+        if isinstance(block, dict) and block.get('type') == 'tool_use':
+            elapsed = time.monotonic() - run['started_at']
+            logger.info(f"[{run['chat_id']}] 🔧 [{elapsed:.1f}s] Claude вызывает {block.get('name')}")
 
-    # Очищаем списки промежуточных сообщений перед новой сессией
-    intermediate_message_ids.clear()
-    current_hourglass_message_id = None
-    logger.debug("Списки промежуточных сообщений очищены перед новой сессией (медиа-группа)")
 
-    # Устанавливаем флаг блокировки
-    is_processing = True
-    logger.info(f"Обработка медиа-группы {media_group_id}: {len(messages)} сообщений")
-
-    # Берём первое сообщение как основное (оно содержит текст/caption)
-    first_message = messages[0]
-
-    # Собираем файлы из ВСЕХ сообщений группы
-    all_files = []
-    for msg in messages:
-        files, voice_info = await save_message_files(msg)
-        all_files.extend(files)
-        # В медиа-группах голосовых быть не должно, но на всякий случай проверяем
-        if voice_info:
-            logger.warning("⚠️ Голосовое сообщение в медиа-группе - пропускаем")
-
-    # Формируем текст сообщения
-    user_text = first_message.text or first_message.caption or ""
-
-    # Логирование
-    text_preview = user_text[:100] if user_text else f"[медиа-группа: {len(all_files)} файл(ов)]"
-    logger.info(f"Получена медиа-группа: {text_preview}")
-    message_history.append({
-        "timestamp": datetime.now().isoformat(),
-        "from": "user",
-        "text": user_text,
-        "files": [f['name'] for f in all_files] if all_files else []
-    })
+async def _drain_stderr(stream: asyncio.StreamReader) -> str:
+    """Читает stderr процесса параллельно со stdout (иначе пайп может переполниться)."""
+    tail = b""
+    while True:
+        chunk = await stream.read(8192)
+        if not chunk:
+            break
+        tail = (tail + chunk)[-STDERR_TAIL_LIMIT:]
+    return tail.decode(errors='replace')
+
+
+async def _handle_stream_event(chat: ChatState, event: dict, run: dict):
+    """Обновляет состояние запуска по событию stream-json и вызывает хуки."""
+    now = time.monotonic()
+    run['events'] += 1
+    run['last_event_at'] = now
+
+    event_type = event.get('type')
+
+    # session_id приходит в init событии (в самом начале) и дублируется в result
+    # Сохраняем сразу, чтобы /stop и /tg-ask не потеряли сессию
+    if (event_type == 'system' and event.get('subtype') == 'init') or event_type == 'result':
+        session_id = event.get('session_id')
+        if session_id and (session_id != run['session_id'] or run['context_pending']):
+            run['session_id'] = session_id
+            run['context_pending'] = False
+            save_session_id(chat, session_id, run['context_hash'])
+            logger.info(f"Session ID получен из stream-json ({event_type}): {session_id}")
+
+    if event_type == 'assistant' and run['first_token_at'] is None:
+        run['first_token_at'] = now
+        logger.info(f"[{chat.chat_id}] ⏱ Time-to-first-token: {now - run['started_at']:.2f}s")
+
+    if event_type == 'result':
+        run['result'] = event
+
+    for hook in stream_event_hooks:
+        try:
+            await hook(event, run)
+        except Exception as e:
+            logger.warning(f"Ошибка в stream-хуке {getattr(hook, '__name__', hook)}: {e}")
 
-    # Формируем статусное сообщение
-    files_info = f"{len(all_files)} файл(ов)"
-    has_photos = any(f['type'] == 'photo' for f in all_files)
-    status_emoji = "📸" if has_photos else "📎"
 
-    # Проверяем активную сессию
-    session_id = read_active_session()
+async def run_claude_streaming(
+    chat: ChatState, process: asyncio.subprocess.Process, session_id: str = None,
+    context_hash: str = None, context_changed: bool = False
+) -> dict:
+    """
+    Читает события stream-json запущенного Claude CLI построчно до завершения процесса.
 
-    if session_id:
-        # Продолжить существующую сессию
-        logger.info(f"Продолжаю сессию: {session_id}")
-        status_msg = f"{status_emoji} Обрабатываю медиа-группу ({files_info})..."
+    Процесс сохраняется в chat.active_claude_process (для /stop), session_id сохраняется
+    сразу после init события, весь stdout в памяти не держится.
+
+    Args:
+        chat: Чат, в котором идёт запуск
+        process: Запущенный Claude CLI (--output-format stream-json, stdout/stderr = PIPE)
+        session_id: ID продолжаемой сессии (None для новой)
+        context_hash: Версия контекста TG-агента, которую сессия получила (сохраняется вместе с session_id)
+        context_changed: --resume сессии отправлен новый контекст - сохранить context_hash с первым
+            init/result (до него неизвестно, дошёл ли промпт до сессии)
 
-        # Отправляем статусное сообщение и трекаем его
-        sent_msg = await first_message.answer(status_msg)
-        intermediate_message_ids.append(sent_msg.message_id)
+    Returns:
+        dict с результатами запуска: session_id, result (финальное событие),
+        returncode, stderr, тайминги (started_at, first_token_at, finished_at)
+    """
+    run = {
+        'chat_id': chat.chat_id,
+        'model': chat.current_model,
+        'session_id': session_id,
+        'context_hash': context_hash,
+        'context_pending': context_changed,
+        'started_at': time.monotonic(),
+        'first_token_at': None,
+        'last_event_at': None,
+        'finished_at': None,
+        'events': 0,
+        'result': None,
+        'returncode': None,
+        'stderr': '',
+        'cpu_time': None,
+        'peak_rss': None,
+        'max_children': None,
+        'timed_out': None
+    }
+
+    chat.active_claude_process = process
+
+    # Сохраняем локальную ссылку (защита от race condition с stop_claude_process)
+    local_process = process
+    stderr_task = asyncio.create_task(_drain_stderr(local_process.stderr))
+    monitor_task = asyncio.create_task(monitor_run_resources(local_process, run))
+    watchdog_task = asyncio.create_task(watch_run(chat, local_process, run))
+
+    try:
+        while True:
+            try:
+                line = await local_process.stdout.readline()
+            except ValueError as e:
+                # Строка длиннее STREAM_LINE_LIMIT - пропускаем её, поток продолжаем
+                logger.warning(f"Пропущена слишком длинная строка stream-json: {e}")
+                continue
 
-        # Отправляем индикатор прогресса (custom emoji из NewsEmoji)
-        current_hourglass_message_id = await send_progress_indicator()
+            if not line:
+                break
 
-        await resume_session(session_id, user_text, all_files)
-    else:
-        # Создать новую сессию
-        logger.info("Создаю новую сессию Claude Code")
-        status_msg = f"{status_emoji} Обрабатываю медиа-группу ({files_info})..."
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                logger.debug(f"Не-JSON строка в stdout Claude: {line[:200]!r}")
+                continue
 
-        # Отправляем статусное сообщение и трекаем его
-        sent_msg = await first_message.answer(status_msg)
-        intermediate_message_ids.append(sent_msg.message_id)
+            await _handle_stream_event(chat, event, run)
 
-        # Отправляем индикатор прогресса (custom emoji из NewsEmoji)
-        current_hourglass_message_id = await send_progress_indicator()
+        await local_process.wait()
+    finally:
+        run['stderr'] = await stderr_task
+        run['returncode'] = local_process.returncode
+        run['finished_at'] = time.monotonic()
+        monitor_task.cancel()
+        if run['timed_out']:
+            # Watchdog сейчас добивает группу процессов - даём ему закончить
+            await asyncio.gather(watchdog_task, return_exceptions=True)
+        else:
+            watchdog_task.cancel()
+
+        # Tool-процессы, пережившие сам claude, остаются в его группе
+        leftover = await asyncio.to_thread(sample_process_group, local_process.pid)
+        if leftover and leftover['processes']:
+            logger.warning(f"[{chat.chat_id}] После Claude осталось процессов в группе: {leftover['processes']}")
+
+    duration = run['finished_at'] - run['started_at']
+    ttft = run['first_token_at'] - run['started_at'] if run['first_token_at'] else None
+    cost = (run['result'] or {}).get('total_cost_usd')
+
+    chat.last_run_stats = {
+        'model': run['model'],
+        'duration': duration,
+        'ttft': ttft,
+        'events': run['events'],
+        'cost': cost,
+        'returncode': run['returncode'],
+        'cpu_time': run['cpu_time'],
+        'peak_rss': run['peak_rss'],
+        'max_children': run['max_children'],
+        'finished': datetime.now()
+    }
+    record_model_resources(run, duration)
+    if run['returncode'] == 0:
+        record_run_duration(run['model'], duration)
+
+    cpu_time = run['cpu_time']
+    logger.info(
+        f"[{chat.chat_id}] Claude завершён: код {run['returncode']}, {duration:.1f}s, "
+        f"TTFT {f'{ttft:.2f}s' if ttft is not None else '—'}, событий {run['events']}"
+        + (f", ${cost:.4f}" if cost is not None else "")
+        + f", CPU {f'{cpu_time:.1f}s' if cpu_time is not None else '—'}"
+        + f", пик RSS {format_bytes(run['peak_rss'])}, дочерних {run['max_children'] if run['max_children'] is not None else '—'}"
+    )
 
-        await start_new_session(user_text, all_files)
+    return run
 
 
-# === HELPER: Сохранение файлов из сообщения ===
+def get_run_error(run: dict) -> str:
+    """Возвращает текст ошибки запуска (stderr или текст result события)."""
+    if run['stderr'].strip():
+        return run['stderr']
+    result = run['result'] or {}
+    return str(result.get('result') or result.get('subtype') or f"exit code {run['returncode']}")
 
-async def save_message_files(message: Message) -> tuple[list[dict], dict | None]:
+
+# === ЗАПУСК CLAUDE CLI ===
+
+def build_claude_args(model: str, session_id: str = None) -> list[str]:
+    """Аргументы Claude CLI: промпт читается из stdin, вывод - stream-json."""
+    args = [CLAUDE_CLI_PATH, '--model', model, '--dangerously-skip-permissions']
+    if session_id:
+        args += ['--resume', session_id]
+    args += ['-p', '-', '--output-format', 'stream-json', '--verbose']
+    return args
+
+
+async def launch_claude(chat_id: int, model: str, session_id: str = None) -> asyncio.subprocess.Process:
     """
-    Сохраняет все файлы из сообщения (фото, документы, видео, аудио).
-    Голосовые сообщения обрабатываются отдельно.
+    Запускает Claude CLI напрямую (без sh -c и cat): cwd и env передаются в exec,
+    промпт потом пишется прямо в stdin процесса через write_prompt().
 
-    Returns:
-        tuple[list[dict], dict | None]:
-            - Список обычных файлов (БЕЗ голосовых)
-            - Информация о голосовом сообщении (или None)
+    TG_BOT_CHAT_ID в окружении - чат, в который tg-send.sh / tg-ask.sh отправят ответ.
+    Процесс запускается в своей сессии (своя группа процессов) - /stop убивает
+    claude вместе со всеми его tool-процессами через kill_process_group().
     """
-    from datetime import datetime
+    return await asyncio.create_subprocess_exec(
+        *build_claude_args(model, session_id),
+        cwd=CLAUDE_WORKING_DIR,
+        env={**os.environ, 'IS_SANDBOX': '1', 'TG_BOT_CHAT_ID': str(chat_id)},
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=STREAM_LINE_LIMIT,
+        start_new_session=True
+    )
 
-    files = []
-    voice_info = None
 
-    # Обработка фото
-    if message.photo:
-        try:
-            photo = message.photo[-1]  # Лучшее качество
-            file_id = photo.file_id
+async def write_prompt(process: asyncio.subprocess.Process, prompt: str):
+    """Передаёт промпт в stdin Claude CLI и закрывает stdin (сигнал конца промпта)."""
+    process.stdin.write(prompt.encode())
+    await process.stdin.drain()
+    process.stdin.close()
 
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
 
-            photos_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/uploads/photos"
-            os.makedirs(photos_dir, exist_ok=True)
+async def start_claude_process(chat: ChatState, session_id: str, prompt: str) -> asyncio.subprocess.Process:
+    """
+    Запускает Claude для промпта: тёплый процесс из пула, иначе холодный старт.
+
+    Returns:
+        Процесс, которому уже передан промпт
+    """
+    process = await claude_pool_acquire(chat.chat_id, chat.current_model, session_id, prompt)
+    if process:
+        return process
+
+    process = await launch_claude(chat.chat_id, chat.current_model, session_id)
+    await write_prompt(process, prompt)
+    return process
+
+
+# === WARM POOL CLAUDE CLI ===
+#
+# Идея: Claude CLI в режиме `-p -` загружается (node, конфиг, MCP, skills) ДО чтения
+# промпта из stdin, поэтому процесс можно запустить заранее и отдать ему промпт когда
+# придёт сообщение - холодный старт оплачивается пока бот простаивает.
+#
+# Процесс `-p` одноразовый (один промпт = один запуск), поэтому воркер обслуживает
+# ровно один запуск и после него пул доливается новым. Воркеры для --resume
+# запускаются заранее для активной сессии (следующее сообщение почти всегда её продолжает).
+#
+# Воркер привязан к чату (TG_BOT_CHAT_ID в окружении), тёплыми держим только чаты,
+# активные за последние CLAUDE_POOL_MAX_IDLE секунд.
+#
+# ВНИМАНИЕ: текущий CLI ждёт данные в stdin только ~3 сек (peekForStdinData), потом
+# запускает платный ход с промптом "-" и завершается, а --resume воркер пишет этот ход
+# в сессию пользователя. Пока нет режима, который действительно блокируется на stdin,
+# пул выключен по умолчанию (CLAUDE_POOL_SIZE=0) - не включать без проверки на своей версии CLI.
+
+# Тёплые процессы: {(chat_id, model, session_id): [{'process': Process, 'spawned_at': float}, ...]}
+# session_id=None - воркеры для новых сессий, иначе - для --resume конкретной сессии
+claude_pool = {}
+claude_pool_lock = asyncio.Lock()
+claude_pool_stats = {'hits': 0, 'misses': 0, 'spawned': 0, 'recycled': 0}
+
+
+async def spawn_claude_worker(chat_id: int, model: str, session_id: str = None) -> dict:
+    """Запускает Claude CLI, ожидающий промпт в stdin."""
+    process = await launch_claude(chat_id, model, session_id)
+    claude_pool_stats['spawned'] += 1
+    logger.debug(f"Пул: запущен тёплый процесс {process.pid} ([{chat_id}] {model}, resume={session_id})")
+    return {'process': process, 'spawned_at': time.monotonic()}
+
+
+async def _kill_worker(worker: dict):
+    """Убивает простаивающий воркер пула."""
+    process = worker['process']
+    if process.returncode is None:
+        try:
+            kill_process_group(process, signal.SIGKILL)
+            await asyncio.wait_for(process.wait(), timeout=5.0)
+        except Exception as e:
+            logger.warning(f"Пул: не удалось убить процесс {process.pid}: {e}")
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_extension = file_path.split('.')[-1] if '.' in file_path else 'jpg'
-            local_filename = f"photo_{timestamp}.{file_extension}"
-            local_path = os.path.join(photos_dir, local_filename)
 
-            await bot.download_file(file_path, local_path)
+def is_stale_resume_worker(key: tuple, worker: dict) -> bool:
+    """--resume воркер, запущенный до завершения последнего запуска сессии: CLI уже прочитал её старое состояние."""
+    chat_id, _, session_id = key
+    chat = chats.get(chat_id)
+    return bool(session_id) and chat is not None and worker['spawned_at'] < chat.last_run_finished_at
 
-            files.append({
-                'type': 'photo',
-                'path': local_path,
-                'name': local_filename,
-                'size': photo.file_size if hasattr(photo, 'file_size') else 0,
-                'caption': message.caption
-            })
 
-            logger.info(f"Фото сохранено: {local_path}")
+async def claude_pool_acquire(chat_id: int, model: str, session_id: str, prompt: str):
+    """
+    Берёт тёплый процесс из пула и отдаёт ему промпт.
 
-        except Exception as e:
-            logger.error(f"Ошибка сохранения фото: {e}")
+    Returns:
+        Запущенный процесс (промпт уже записан) или None если тёплого нет (miss)
+    """
+    while True:
+        # Снимаем воркер под локом: claude_pool_refill перебирает и чистит списки между await
+        async with claude_pool_lock:
+            workers = claude_pool.get((chat_id, model, session_id))
+            if not workers:
+                break
+            worker = workers.pop(0)
+        process = worker['process']
+
+        if process.returncode is not None:
+            logger.warning(f"Пул: тёплый процесс {process.pid} умер (код {process.returncode})")
+            continue
+
+        if is_stale_resume_worker((chat_id, model, session_id), worker):
+            logger.info(f"[{chat_id}] Пул: тёплый процесс {process.pid} запущен до конца прошлого запуска - не использую")
+            await _kill_worker(worker)
+            continue
 
-    # Обработка документов
-    if message.document:
         try:
-            document = message.document
-            file_id = document.file_id
-            original_filename = document.file_name or "document"
+            await write_prompt(process, prompt)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.warning(f"Пул: не удалось передать промпт процессу {process.pid}: {e}")
+            await _kill_worker(worker)
+            continue
 
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
+        claude_pool_stats['hits'] += 1
+        logger.info(f"[{chat_id}] 🔥 Пул: использую тёплый процесс {process.pid} ({model}, resume={session_id})")
+        return process
 
-            files_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/uploads/files"
-            os.makedirs(files_dir, exist_ok=True)
+    claude_pool_stats['misses'] += 1
+    if CLAUDE_POOL_SIZE > 0:
+        logger.info(f"[{chat_id}] Пул: нет тёплого процесса ({model}, resume={session_id}) - холодный старт")
+    return None
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-            if '.' in original_filename:
-                name_parts = original_filename.rsplit('.', 1)
-                base_name = name_parts[0]
-                extension = name_parts[1]
-                local_filename = f"{base_name}_{timestamp}.{extension}"
-            else:
-                local_filename = f"{original_filename}_{timestamp}"
+async def claude_pool_refill():
+    """
+    Доводит пул до CLAUDE_POOL_SIZE для текущей модели и активной сессии каждого
+    недавно активного чата. Воркеры для другой модели / завершённой сессии /
+    неактивного чата и простаивающие дольше CLAUDE_POOL_MAX_IDLE убиваются.
+    """
+    if CLAUDE_POOL_SIZE <= 0:
+        return
 
-            local_path = os.path.join(files_dir, local_filename)
+    async with claude_pool_lock:
+        wanted_keys = []
+        for chat in chats.values():
+            if time.time() - chat.last_activity_time > CLAUDE_POOL_MAX_IDLE:
+                continue
+            wanted_keys.append((chat.chat_id, chat.current_model, None))
+            # Пока сессия выполняется, --resume воркер загрузил бы её состояние до конца запуска.
+            # is_processing (а не current_job): он сбрасывается до доливки пула после запуска
+            session_id = read_active_session(chat)
+            if session_id and not chat.is_processing:
+                wanted_keys.append((chat.chat_id, chat.current_model, session_id))
+
+        # Неактуальные ключи (модель переключили, сессию завершили, чат неактивен)
+        for key in list(claude_pool):
+            if key not in wanted_keys:
+                for worker in claude_pool.pop(key):
+                    await _kill_worker(worker)
+
+        now = time.monotonic()
+        for key in wanted_keys:
+            workers = claude_pool.setdefault(key, [])
+
+            for worker in list(workers):
+                if worker['process'].returncode is not None:
+                    workers.remove(worker)
+                elif is_stale_resume_worker(key, worker):
+                    workers.remove(worker)
+                    await _kill_worker(worker)
+                elif now - worker['spawned_at'] > CLAUDE_POOL_MAX_IDLE:
+                    workers.remove(worker)
+                    await _kill_worker(worker)
+                    claude_pool_stats['recycled'] += 1
+
+            while len(workers) < CLAUDE_POOL_SIZE:
+                try:
+                    workers.append(await spawn_claude_worker(*key))
+                except Exception as e:
+                    logger.error(f"Пул: не удалось запустить тёплый процесс: {e}")
+                    break
 
-            await bot.download_file(file_path, local_path)
 
-            files.append({
-                'type': 'document',
-                'path': local_path,
-                'name': local_filename,
-                'size': document.file_size,
-                'caption': message.caption
-            })
+async def claude_pool_shutdown():
+    """Убивает все тёплые процессы пула."""
+    async with claude_pool_lock:
+        for workers in claude_pool.values():
+            for worker in workers:
+                await _kill_worker(worker)
+        claude_pool.clear()
 
-            logger.info(f"Документ сохранён: {local_path}")
 
-        except Exception as e:
-            logger.error(f"Ошибка сохранения документа: {e}")
+async def claude_pool_maintenance_loop():
+    """Background task - прогревает пул при старте и периодически его обслуживает."""
+    CHECK_INTERVAL = 60
 
-    # Обработка видео
-    if message.video:
+    while True:
         try:
-            video = message.video
-            file_id = video.file_id
+            await claude_pool_refill()
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания пула: {e}")
+        await asyncio.sleep(CHECK_INTERVAL)
 
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
 
-            files_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/uploads/files"
-            os.makedirs(files_dir, exist_ok=True)
+# === КОНТЕКСТ TG-АГЕНТА ===
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_extension = file_path.split('.')[-1] if '.' in file_path else 'mp4'
-            local_filename = f"video_{timestamp}.{file_extension}"
-            local_path = os.path.join(files_dir, local_filename)
+# Кеш telegram_agent_context.md в памяти: перечитывается только при изменении mtime/размера
+agent_context = {'text': None, 'hash': None, 'mtime': None, 'size': None}
 
-            await bot.download_file(file_path, local_path)
+# Тип файла -> подпись в промпте
+FILE_TYPE_LABELS = {
+    'photo': '📸 Фото',
+    'document': '📄 Документ',
+    'video': '🎥 Видео',
+    'audio': '🎵 Аудио',
+    'voice': '🎤 Голосовое сообщение',
+    'video_note': '⭕ Видео-заметка'
+}
 
-            files.append({
-                'type': 'video',
-                'path': local_path,
-                'name': local_filename,
-                'size': video.file_size,
-                'caption': message.caption
-            })
 
-            logger.info(f"Видео сохранено: {local_path}")
+def get_agent_context() -> dict:
+    """
+    Возвращает контекст TG-агента {'text', 'hash'} из кеша.
+    Файл перечитывается только если изменились его mtime или размер.
+    """
+    stat = os.stat(CONTEXT_FILE)
 
-        except Exception as e:
-            logger.error(f"Ошибка сохранения видео: {e}")
+    if agent_context['text'] is None or (stat.st_mtime_ns, stat.st_size) != (agent_context['mtime'], agent_context['size']):
+        with open(CONTEXT_FILE, 'r') as f:
+            text = f.read()
+        context_hash = hashlib.sha256(text.encode()).hexdigest()[:12]
 
-    # Обработка аудио
-    if message.audio:
-        try:
-            audio = message.audio
-            file_id = audio.file_id
+        if agent_context['hash'] and context_hash != agent_context['hash']:
+            logger.info(f"Контекст TG-агента изменён: {agent_context['hash']} -> {context_hash}")
+        else:
+            logger.debug(f"Контекст TG-агента загружен: {context_hash} ({len(text)} символов)")
 
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
+        agent_context.update(text=text, hash=context_hash, mtime=stat.st_mtime_ns, size=stat.st_size)
 
-            files_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/uploads/files"
-            os.makedirs(files_dir, exist_ok=True)
+    return agent_context
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_extension = file_path.split('.')[-1] if '.' in file_path else 'mp3'
-            original_name = audio.file_name or f"audio_{timestamp}"
 
-            if '.' in original_name:
-                name_parts = original_name.rsplit('.', 1)
-                local_filename = f"{name_parts[0]}_{timestamp}.{name_parts[1]}"
-            else:
-                local_filename = f"{original_name}.{file_extension}"
+def format_files_section(files: list[dict] | None) -> str:
+    """Формирует секцию промпта со списком прикреплённых файлов."""
+    if not files:
+        return ""
 
-            local_path = os.path.join(files_dir, local_filename)
+    files_section = "\n\n📎 **Файлы прикреплённые к сообщению:**\n\n"
+    has_photos = False
 
-            await bot.download_file(file_path, local_path)
+    for file_info in files:
+        file_type_label = FILE_TYPE_LABELS.get(file_info['type'], '📎 Файл')
+        files_section += f"{file_type_label}: {file_info['name']}\n"
 
-            files.append({
-                'type': 'audio',
-                'path': local_path,
-                'name': local_filename,
-                'size': audio.file_size,
-                'caption': message.caption
-            })
+        if file_info.get('preview_path'):
+            # Claude читает оптимизированную копию, оригинал остаётся доступен
+            files_section += f"Путь: {file_info['preview_path']} (оптимизировано: {file_info['preview_note']})\n"
+            files_section += f"Оригинал: {file_info['path']}\n"
+        else:
+            files_section += f"Путь: {file_info['path']}\n"
 
-            logger.info(f"Аудио сохранено: {local_path}")
+        if file_info.get('size'):
+            size_mb = file_info['size'] / (1024 * 1024)
+            size_text = f"{size_mb:.2f} MB" if size_mb >= 1 else f"{file_info['size'] / 1024:.2f} KB"
+            files_section += f"Размер: {size_text}\n"
 
-        except Exception as e:
-            logger.error(f"Ошибка сохранения аудио: {e}")
+        if file_info.get('text_path'):
+            # Извлечённый текст - читать его, а не бинарный оригинал
+            files_section += f"Текст: {file_info['text_path']} ({file_info['text_note']})\n"
 
-    # Обработка голосовых сообщений
-    # НЕ добавляем в files - обрабатываем отдельно
-    if message.voice:
-        try:
-            voice = message.voice
-            file_id = voice.file_id
+        if file_info.get('frame_paths'):
+            # Видео Claude не смотрит - даём кадры и транскрипцию звука
+            duration_text = f" из {file_info['duration']:.0f} сек" if file_info.get('duration') else ""
+            files_section += f"Кадры{duration_text}:\n"
+            files_section += "".join(f"  {frame_path}\n" for frame_path in file_info['frame_paths'])
 
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
+        if file_info.get('transcript_path'):
+            files_section += f"Транскрипция звука: {file_info['transcript_path']}\n"
 
-            files_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/uploads/files"
-            os.makedirs(files_dir, exist_ok=True)
+        files_section += "\n"
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_extension = file_path.split('.')[-1] if '.' in file_path else 'ogg'
-            local_filename = f"voice_{timestamp}.{file_extension}"
-            local_path = os.path.join(files_dir, local_filename)
+        if file_info['type'] == 'photo' or file_info.get('preview_path') or file_info.get('frame_paths'):
+            has_photos = True
 
-            await bot.download_file(file_path, local_path)
+    if has_photos:
+        files_section += "💡 Используй Read tool чтобы 'увидеть' изображение(я).\n"
+        files_section += "Оригинал в полном разрешении читай только если не хватает деталей.\n\n"
 
-            # Сохраняем информацию о голосовом для последующей обработки
-            voice_info = {
-                'path': local_path,
-                'name': local_filename,
-                'size': voice.file_size,
-                'caption': message.caption
-            }
+    return files_section
 
-            logger.info(f"Голосовое сообщение скачано: {local_path}")
 
-        except Exception as e:
-            logger.error(f"Ошибка сохранения голосового: {e}")
+def build_user_section(user_prompt: str, files: list[dict] | None) -> str:
+    """Часть промпта с сообщением пользователя (общая для новой и продолжаемой сессии)."""
+    return f"""---
+[Новое сообщение от пользователя]
+{format_files_section(files)}
+{user_prompt if user_prompt else "Проанализируй прикреплённые файлы"}
+"""
 
-    # Обработка видео-заметок (кружочки)
-    if message.video_note:
-        try:
-            video_note = message.video_note
-            file_id = video_note.file_id
 
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
+def build_context_reminder(context_hash: str) -> str:
+    """Короткое напоминание вместо полного контекста - сессия его уже получила."""
+    return (
+        f"[НАПОМИНАНИЕ: Ты в Telegram Agent режиме. Инструкции (контекст v{context_hash}) "
+        f"даны в начале этой сессии и не изменились - следуй им: отвечай через "
+        f"/opt/ai-workspace/commands/tg-session-send.sh, форматируй HTML тегами.]"
+    )
+
+
+async def start_new_session(chat: ChatState, user_prompt: str, files: list[dict] = None):
+    """Запускает новую сессию Claude Code в чате."""
+
+    try:
+        # Полный контекст TG-агента отправляется один раз - в первом сообщении сессии,
+        # дальше он остаётся в истории сессии (см. resume_session)
+        context = get_agent_context()
+
+        # Новая сессия - под защитой от очистки только её файлы
+        chat.session_files = set(collect_file_paths(files))
+
+        full_prompt = f"""{context['text']}
+
+{build_user_section(user_prompt, files)}"""
 
-            files_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/uploads/files"
-            os.makedirs(files_dir, exist_ok=True)
+        # Запускаем Claude Code в headless режиме (промпт уходит прямо в stdin)
+        process = await start_claude_process(chat, None, full_prompt)
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_extension = file_path.split('.')[-1] if '.' in file_path else 'mp4'
-            local_filename = f"video_note_{timestamp}.{file_extension}"
-            local_path = os.path.join(files_dir, local_filename)
+        # session_id (вместе с версией контекста) сохраняется внутри run_claude_streaming сразу по init событию
+        run = await run_claude_streaming(chat, process, context_hash=context['hash'])
 
-            await bot.download_file(file_path, local_path)
+        # chat.active_claude_process может быть None после stop_claude_process - смотрим на run
+        if run['returncode'] != 0:
+            error_msg = get_run_error(run)
+            logger.error(f"Claude failed: {error_msg}")
+            chat.active_claude_process = None  # Очищаем при ошибке
+
+            # Проверяем: был ли процесс остановлен пользователем (/stop или /tg-ask)?
+            if chat.is_stopping:
+                if run['session_id']:
+                    logger.info(f"Процесс был остановлен пользователем - сессия {run['session_id']} сохранена")
+                else:
+                    logger.info("Процесс был остановлен пользователем до init события - session_id нет")
+                return
+
+            if run['timed_out']:
+                await notify_run_timeout(chat, run)
+                return
+
+            raise Exception(f"Claude execution failed: {error_msg}")
+
+        if run['session_id']:
+            logger.info(f"Новая сессия создана: {run['session_id']}")
+        else:
+            logger.warning("Session ID не найден в ответе Claude")
+
+        # ⚠️ ВАЖНО: Очищаем переменную после естественного завершения
+        # Session ID сохранён, можно будет продолжить новым сообщением
+        chat.active_claude_process = None
+
+        update_activity(chat)
+
+    except Exception as e:
+        logger.error(f"Ошибка при создании сессии: {e}")
+        # Отправляем сообщение об ошибке только если НЕ была остановка пользователем
+        if not chat.is_stopping:
+            await bot.send_message(
+                chat.chat_id,
+                f"❌ <b>Ошибка запуска Claude</b>\n\n<code>{str(e)}</code>",
+                parse_mode="HTML"
+            )
+    finally:
+        # ВСЕГДА сбрасываем ОБА флага после завершения
+        chat.is_processing = False
+        chat.is_stopping = False
+        chat.last_run_finished_at = time.monotonic()
+        logger.info("Флаги is_processing и is_stopping сброшены (start_new_session завершена)")
+
+        # Доливаем пул (в т.ч. тёплый --resume для только что созданной сессии)
+        asyncio.create_task(claude_pool_refill())
+
+        # Удаляем прогресс-индикатор ⏳ после завершения задачи
+        if chat.current_hourglass_message_id:
+            try:
+                await bot.delete_message(chat_id=chat.chat_id, message_id=chat.current_hourglass_message_id)
+                logger.debug(f"Удален финальный ⏳ после завершения задачи: {chat.current_hourglass_message_id}")
+                chat.current_hourglass_message_id = None
+            except Exception as e:
+                logger.warning(f"Не удалось удалить финальный ⏳: {e}")
+
+
+async def resume_session(chat: ChatState, session_id: str, user_prompt: str, files: list[dict] = None):
+    """Продолжает существующую сессию Claude Code в чате."""
+
+    try:
+        context = get_agent_context()
+        session_context_hash = read_session_context_hash(chat)
+        chat.session_files.update(collect_file_paths(files))
+
+        if session_context_hash == context['hash']:
+            # Сессия уже видела этот контекст - только короткое напоминание
+            prompt = f"""{build_context_reminder(context['hash'])}
+
+{build_user_section(user_prompt, files)}"""
+        else:
+            # Контекст изменился (или сессия создана до версионирования) - отправляем заново
+            logger.info(
+                f"[{chat.chat_id}] Контекст сессии {session_id} устарел "
+                f"({session_context_hash or 'нет версии'} -> {context['hash']}) - отправляю полностью"
+            )
+            prompt = f"""[ОБНОВЛЁННЫЕ ИНСТРУКЦИИ: Ты в Telegram Agent режиме, контекст v{context['hash']} заменяет предыдущий]
+{context['text']}
+
+{build_user_section(user_prompt, files)}"""
+
+        # Запускаем Claude с --resume (промпт уходит прямо в stdin)
+        process = await start_claude_process(chat, session_id, prompt)
+        run = await run_claude_streaming(
+            chat, process, session_id=session_id, context_hash=context['hash'],
+            context_changed=session_context_hash != context['hash']
+        )
+
+        # chat.active_claude_process может быть None после stop_claude_process - смотрим на run
+        if run['returncode'] != 0:
+            error_msg = get_run_error(run)
+            logger.error(f"Claude resume failed: {error_msg}")
+            chat.active_claude_process = None  # Очищаем при ошибке
+
+            # Проверяем: был ли процесс остановлен пользователем (/stop или /tg-ask)?
+            if chat.is_stopping:
+                logger.info(f"Процесс был остановлен пользователем - сессия {session_id} сохранена")
+                return
+
+            # Остановлен watchdog - сессия цела, новую не создаём
+            if run['timed_out']:
+                await notify_run_timeout(chat, run)
+                return
+
+            # Сессия протухла естественным образом - создаём новую
+            logger.info("Сессия протухла, создаю новую...")
+            clear_session(chat)
+            await start_new_session(chat, user_prompt, files)
+            return
+
+        logger.info(f"Сессия {session_id} продолжена успешно")
+
+        # ⚠️ ВАЖНО: Очищаем переменную после естественного завершения
+        # Session ID сохранён, можно будет продолжить новым сообщением
+        chat.active_claude_process = None
+
+        update_activity(chat)
+
+    except Exception as e:
+        logger.error(f"Ошибка при продолжении сессии: {e}")
+
+        # Создаём новую сессию только если НЕ была остановка пользователем
+        if not chat.is_stopping:
+            clear_session(chat)
+            await start_new_session(chat, user_prompt, files)
+    finally:
+        # ВСЕГДА сбрасываем ОБА флага после завершения
+        chat.is_processing = False
+        chat.is_stopping = False
+        chat.last_run_finished_at = time.monotonic()
+        logger.info("Флаги is_processing и is_stopping сброшены (resume_session завершена)")
+
+        # Доливаем пул тёплым --resume процессом для следующего сообщения
+        asyncio.create_task(claude_pool_refill())
+
+        # Удаляем прогресс-индикатор ⏳ после завершения задачи
+        if chat.current_hourglass_message_id:
+            try:
+                await bot.delete_message(chat_id=chat.chat_id, message_id=chat.current_hourglass_message_id)
+                logger.debug(f"Удален финальный ⏳ после завершения задачи: {chat.current_hourglass_message_id}")
+                chat.current_hourglass_message_id = None
+            except Exception as e:
+                logger.warning(f"Не удалось удалить финальный ⏳: {e}")
+
+
+# === JOB QUEUE ===
+
+def save_job_queue():
+    """Сохраняет ожидающие задачи всех чатов в файл (переживают перезапуск бота)."""
+    try:
+        data = {str(chat.chat_id): chat.job_queue for chat in chats.values() if chat.job_queue}
+        write_file_atomic(JOB_QUEUE_FILE, json.dumps(data, ensure_ascii=False))
+    except Exception as e:
+        logger.error(f"Не удалось сохранить очередь задач: {e}")
+
+
+def load_job_queue():
+    """Загружает ожидающие задачи из файла при старте."""
+    try:
+        with open(JOB_QUEUE_FILE, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.error(f"Не удалось загрузить очередь задач: {e}")
+        return
+
+    # Старый формат (один чат) - список задач основного чата
+    if isinstance(data, list):
+        data = {str(ALLOWED_CHAT_ID): data}
+
+    for chat_id, jobs in data.items():
+        chat = chats.get(int(chat_id))
+        if not chat:
+            logger.warning(f"Пропущено {len(jobs)} задач(и) неразрешённого чата {chat_id}")
+            continue
+
+        for job in jobs:
+            # Уведомление "в очереди" осталось от прошлого запуска - не трогаем
+            job['notice_message_id'] = None
+        chat.job_queue.extend(jobs)
+
+        if chat.job_queue:
+            logger.info(f"[{chat.chat_id}] Восстановлено задач в очереди: {len(chat.job_queue)}")
+            chat.job_queue_event.set()
+
+
+def estimate_queue_eta(chat: ChatState) -> float | None:
+    """Оценка времени (сек) до выполнения всей очереди чата по средней длительности задач."""
+    if not job_durations:
+        return None
+
+    avg_duration = sum(job_durations) / len(job_durations)
+    eta = len(chat.job_queue) * avg_duration
+
+    if chat.current_job:
+        elapsed = time.monotonic() - chat.current_job['started_at']
+        eta += max(0.0, avg_duration - elapsed)
+
+    return eta
+
+
+def format_eta(seconds: float | None) -> str:
+    """Форматирует ETA для пользователя."""
+    if seconds is None:
+        return "неизвестно"
+    if seconds < 60:
+        return f"~{int(seconds)} сек"
+    return f"~{int(seconds / 60) + 1} мин"
+
+
+async def enqueue_job(chat: ChatState, text: str, files: list[dict], title: str, details: str = "", front: bool = False):
+    """
+    Ставит задачу для Claude в очередь чата.
+
+    Args:
+        chat: Чат пользователя
+        text: Текст промпта (уже с транскрипциями голосовых)
+        files: Скачанные файлы
+        title: Заголовок статусного сообщения ("💬 Обрабатываю 2 сообщений")
+        details: Доп. строка статусного сообщения (например, список файлов)
+        front: Поставить в начало очереди (ответ на вопрос Claude)
+    """
+    job = {
+        'id': uuid.uuid4().hex[:8],
+        'chat_id': chat.chat_id,
+        'text': text,
+        'files': files,
+        'title': title,
+        'details': details,
+        'enqueued_at': time.time(),
+        'notice_message_id': None
+    }
+
+    busy = (
+        chat.is_processing or chat.is_stopping or chat.current_job is not None
+        or bool(chat.job_queue) or chat.pending_question is not None
+    )
+
+    if front:
+        chat.job_queue.insert(0, job)
+    else:
+        chat.job_queue.append(job)
+    save_job_queue()
+
+    position = chat.job_queue.index(job) + 1
+    logger.info(f"[{chat.chat_id}] Задача {job['id']} поставлена в очередь (позиция {position}, всего {len(chat.job_queue)})")
+
+    # Если Claude занят - сообщаем позицию в очереди
+    if busy:
+        try:
+            notice = await bot.send_message(
+                chat_id=chat.chat_id,
+                text=(
+                    f"📥 <b>Добавлено в очередь</b>\n\n"
+                    f"Позиция: {position}\n"
+                    f"Ожидание: {format_eta(estimate_queue_eta(chat))}"
+                ),
+                parse_mode="HTML"
+            )
+            job['notice_message_id'] = notice.message_id
+        except Exception as e:
+            logger.warning(f"Не удалось отправить уведомление об очереди: {e}")
+
+    chat.job_queue_event.set()
+
+
+async def run_job(chat: ChatState, job: dict):
+    """Выполняет задачу из очереди: статус, прогресс-индикатор и запуск/продолжение сессии."""
+    # Уведомление "в очереди" больше не актуально
+    if job.get('notice_message_id'):
+        try:
+            await bot.delete_message(chat_id=chat.chat_id, message_id=job['notice_message_id'])
+        except Exception as e:
+            logger.debug(f"Не удалось удалить уведомление об очереди: {e}")
+
+    # Удаляем промежуточные сообщения от предыдущей задачи
+    await cleanup_intermediate_messages(chat)
+    chat.intermediate_message_ids.clear()
+    chat.current_hourglass_message_id = None
+
+    # Устанавливаем флаг блокировки
+    chat.is_processing = True
+
+    # Сессию проверяем в момент запуска - предыдущая задача могла её создать
+    session_id = read_active_session(chat)
+
+    status_msg = f"{job['title']} ({'продолжение сессии' if session_id else 'новая сессия'})..."
+    if job['details']:
+        status_msg += f"\n{job['details']}"
+
+    try:
+        sent_msg = await bot.send_message(chat_id=chat.chat_id, text=status_msg)
+        chat.intermediate_message_ids.append(sent_msg.message_id)
+        chat.current_hourglass_message_id = await send_progress_indicator(chat.chat_id)
+    except Exception as e:
+        logger.warning(f"Не удалось отправить статус задачи {job['id']}: {e}")
+
+    if session_id:
+        logger.info(f"[{chat.chat_id}] Задача {job['id']}: продолжаю сессию {session_id}")
+        await resume_session(chat, session_id, job['text'], job['files'])
+    else:
+        logger.info(f"[{chat.chat_id}] Задача {job['id']}: создаю новую сессию Claude Code")
+        await start_new_session(chat, job['text'], job['files'])
+
+
+async def job_queue_consumer(chat: ChatState):
+    """
+    Background task - единственный исполнитель задач из очереди чата.
+    Задачи выполняются строго по порядку; пока Claude ждёт ответ на /tg-ask - очередь на паузе.
+    Параллельно с другими чатами - в пределах CLAUDE_MAX_CONCURRENT.
+    """
+    global running_claude_jobs
+
+    while True:
+        # Ждём задачу (с таймаутом - на случай пропущенного сигнала)
+        if not chat.job_queue or chat.pending_question or chat.is_processing or chat.is_stopping:
+            chat.job_queue_event.clear()
+            try:
+                await asyncio.wait_for(chat.job_queue_event.wait(), timeout=5.0)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        # Ждём свободный слот (общий лимит на все чаты)
+        if claude_semaphore.locked():
+            logger.info(f"[{chat.chat_id}] Все слоты Claude заняты ({CLAUDE_MAX_CONCURRENT}) - жду")
+
+        async with claude_semaphore:
+            # Пока ждали слот, очередь могли очистить (/restart) или поставить на паузу
+            if not chat.job_queue or chat.pending_question:
+                continue
+
+            job = chat.job_queue.pop(0)
+            save_job_queue()
+
+            chat.current_job = {'id': job['id'], 'started_at': time.monotonic(), 'files': job['files']}
+            running_claude_jobs += 1
+            logger.info(f"[{chat.chat_id}] Задача {job['id']} запущена (осталось в очереди: {len(chat.job_queue)})")
+
+            try:
+                await run_job(chat, job)
+            except Exception as e:
+                logger.error(f"Ошибка выполнения задачи {job['id']}: {e}")
+            finally:
+                duration = time.monotonic() - chat.current_job['started_at']
+                job_durations.append(duration)
+                del job_durations[:-JOB_DURATIONS_KEEP]
+                chat.current_job = None
+                running_claude_jobs -= 1
+                logger.info(f"[{chat.chat_id}] Задача {job['id']} завершена за {duration:.1f}s")
+
+
+def clear_job_queue(chat: ChatState) -> int:
+    """Очищает очередь задач чата. Возвращает количество удалённых задач."""
+    count = len(chat.job_queue)
+    chat.job_queue.clear()
+    save_job_queue()
+    return count
+
+
+# === HELPER: Медиа-группы ===
+
+async def collect_media_group(message: Message):
+    """
+    Добавляет сообщение альбома в media_groups_cache и перезапускает таймер группы.
+    Telegram присылает части альбома отдельными сообщениями почти одновременно -
+    группа обрабатывается через MEDIA_GROUP_SETTLE сек после последней части.
+    """
+    media_group_id = message.media_group_id
+
+    # Если это первое сообщение из группы - создаём запись
+    if media_group_id not in media_groups_cache:
+        media_groups_cache[media_group_id] = {
+            'messages': [],
+            'timer': None
+        }
+
+    group_data = media_groups_cache[media_group_id]
+    group_data['messages'].append(message)
+
+    # Файлы альбома начинают качаться, не дожидаясь остальных частей
+    start_ingest(chats[message.chat.id], [message])
+
+    # Отменяем предыдущий таймер если был
+    if group_data['timer']:
+        group_data['timer'].cancel()
+
+    async def delayed_process():
+        await asyncio.sleep(MEDIA_GROUP_SETTLE)
+        await process_media_group(media_group_id)
+
+    group_data['timer'] = asyncio.create_task(delayed_process())
+
+    logger.debug(f"Добавлено сообщение в медиа-группу {media_group_id} ({len(group_data['messages'])} файлов)")
+
+
+async def process_media_group(media_group_id: str):
+    """
+    Передаёт собранный альбом в приём сообщений (multi-mode / auto-mode) одним пакетом:
+    одно контрольное сообщение, одна задача, файлы скачиваются параллельно.
+    """
+    group_data = media_groups_cache.pop(media_group_id, None)
+    if not group_data or not group_data['messages']:
+        return
+
+    # Части альбома могут прийти не по порядку - сортируем, чтобы подпись и файлы шли как у пользователя
+    messages = sorted(group_data['messages'], key=lambda msg: msg.message_id)
+
+    chat = chats.get(messages[0].chat.id)
+    if not chat:
+        return
+
+    logger.info(f"[{chat.chat_id}] Медиа-группа {media_group_id}: {len(messages)} сообщений")
+    await accept_messages(chat, messages)
+
+
+# === HELPER: Сохранение файлов из сообщения ===
+
+UPLOADS_DIR = "/opt/ai-workspace/.claude/skills/telegram-notifier/uploads"
+BOT_TMP_DIR = "/opt/ai-workspace/.claude/skills/telegram-notifier/tmp"  # Временные файлы /send_file
+UPLOADS_INDEX_FILE = os.path.join(UPLOADS_DIR, "index.json")
+
+# Ограничение параллельных скачиваний с серверов Telegram (на весь бот)
+download_semaphore = asyncio.Semaphore(TELEGRAM_DOWNLOAD_CONCURRENCY)
+
+# Скачивание потоком: размер чанка, прогресс для больших файлов
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_TIMEOUT = 600  # На весь файл (сек) - большие видео качаются долго
+DOWNLOAD_PROGRESS_MIN_SIZE = 5 * 1024 * 1024
+DOWNLOAD_PROGRESS_INTERVAL = 2.0
+
+# Лимиты размера по типам вложений (байты); остальные - TELEGRAM_MAX_DOWNLOAD_MB
+DOWNLOAD_SIZE_LIMITS = {
+    'photo': 10 * 1024 * 1024,
+    'voice': 20 * 1024 * 1024,
+    'video_note': 20 * 1024 * 1024,
+}
+
+DOWNLOAD_KIND_LABELS = {
+    'photo': "фото",
+    'document': "документ",
+    'video': "видео",
+    'audio': "аудио",
+    'voice': "голосовое",
+    'video_note': "видео-заметку"
+}
+
+
+def touch_file(path: str):
+    """
+    Отмечает переиспользованный файл (загрузку или кеш рядом с ней) как свежий:
+    очистка uploads удаляет по mtime, а файл снова в работе.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+class UploadStore:
+    """
+    Content-addressed хранилище загрузок: имя файла содержит sha256 содержимого,
+    индекс (UPLOADS_INDEX_FILE) связывает Telegram file_unique_id с локальным файлом.
+
+    Повторно присланный файл (пересылка, тот же документ) находится по file_unique_id
+    без get_file/download_file, одинаковое содержимое под разными file_unique_id
+    хранится один раз. Пути стабильны между сессиями.
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        # {'files': {file_unique_id: {'path', 'sha256', 'size', 'created'}}, 'hashes': {sha256: path}}
+        self.index = None
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+            logger.info(f"Индекс загрузок: {len(self.index['files'])} файлов")
+        except FileNotFoundError:
+            self.index = {'files': {}, 'hashes': {}}
+        except Exception as e:
+            logger.error(f"Не удалось загрузить индекс загрузок: {e}")
+            self.index = {'files': {}, 'hashes': {}}
+
+    def _save(self):
+        try:
+            write_file_atomic(self.index_file, json.dumps(self.index, ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить индекс загрузок: {e}")
+
+    def prune(self) -> int:
+        """Удаляет из индекса записи, чьих файлов больше нет на диске. Возвращает их количество."""
+        if self.index is None:
+            self._load()
+
+        missing = [uid for uid, entry in self.index['files'].items() if not os.path.exists(entry['path'])]
+        for uid in missing:
+            self.index['files'].pop(uid)
+        self.index['hashes'] = {sha: path for sha, path in self.index['hashes'].items() if os.path.exists(path)}
+
+        if missing:
+            self._save()
+        return len(missing)
+
+    def lookup(self, file_unique_id: str) -> dict | None:
+        """Запись индекса, если файл уже скачан и ещё лежит на диске."""
+        if self.index is None:
+            self._load()
+
+        entry = self.index['files'].get(file_unique_id)
+        if not entry:
+            return None
+
+        if not os.path.exists(entry['path']):
+            # Файл удалён очисткой uploads - забываем запись
+            self.index['files'].pop(file_unique_id, None)
+            if self.index['hashes'].get(entry['sha256']) == entry['path']:
+                self.index['hashes'].pop(entry['sha256'], None)
+            self._save()
+            return None
+
+        touch_file(entry['path'])
+        return entry
+
+    def peek(self, file_unique_id: str) -> dict | None:
+        """Запись индекса как есть - без проверки диска и обновления mtime (для очистки)."""
+        if self.index is None:
+            self._load()
+        return self.index['files'].get(file_unique_id)
+
+    def add(self, file_unique_id: str, downloaded_path: str, sha256: str, make_path) -> dict:
+        """
+        Регистрирует скачанный файл под content-addressed именем.
+
+        Args:
+            file_unique_id: file_unique_id из Telegram
+            downloaded_path: Временный путь, куда файл скачан
+            sha256: Хеш содержимого
+            make_path: Функция sha256 -> итоговый путь файла
+
+        Returns:
+            Запись индекса {'path', 'sha256', 'size', 'created'}
+        """
+        if self.index is None:
+            self._load()
+
+        existing_path = self.index['hashes'].get(sha256)
+        if existing_path and os.path.exists(existing_path):
+            # Такое содержимое уже есть (другой file_unique_id) - второй копии не держим
+            os.remove(downloaded_path)
+            path = existing_path
+            logger.info(f"Загрузка совпала по sha256 с {path}")
+        else:
+            path = make_path(sha256)
+            os.replace(downloaded_path, path)
+            self.index['hashes'][sha256] = path
+
+        entry = {
+            'path': path,
+            'sha256': sha256,
+            'size': os.path.getsize(path),
+            'created': datetime.now().isoformat()
+        }
+        self.index['files'][file_unique_id] = entry
+        self._save()
+        return entry
+
+
+upload_store = UploadStore(UPLOADS_INDEX_FILE)
+
+
+def split_filename(filename: str, default_extension: str) -> tuple[str, str]:
+    """Делит имя файла на (база, расширение)."""
+    if '.' in filename:
+        base_name, extension = filename.rsplit('.', 1)
+        return base_name, extension
+    return filename, default_extension
+
+
+class DownloadTooLarge(Exception):
+    """Файл больше лимита своего типа (DOWNLOAD_SIZE_LIMITS)."""
+
+    def __init__(self, kind: str, size: int, limit: int):
+        self.kind = kind
+        self.size = size
+        self.limit = limit
+        super().__init__(f"{kind}: {format_bytes(size)} больше лимита {format_bytes(limit)}")
+
+
+def get_download_limit(kind: str) -> int:
+    """Лимит размера файла данного типа (байты)."""
+    return DOWNLOAD_SIZE_LIMITS.get(kind, TELEGRAM_MAX_DOWNLOAD_MB * 1024 * 1024)
+
+
+class DownloadProgress:
+    """
+    Прогресс скачивания большого файла в чате: одно сообщение, которое редактируется
+    не чаще раза в DOWNLOAD_PROGRESS_INTERVAL и удаляется по завершении.
+    """
+
+    def __init__(self, chat_id: int, label: str, total: int):
+        self.chat_id = chat_id
+        self.label = label
+        self.total = total
+        self.message_id = None
+        self.last_update = 0.0
+
+    async def update(self, done: int):
+        now = time.monotonic()
+        if self.message_id and now - self.last_update < DOWNLOAD_PROGRESS_INTERVAL:
+            return
+        self.last_update = now
+
+        text = f"⬇️ Скачиваю {self.label}: {int(done * 100 / self.total)}% ({format_bytes(done)} из {format_bytes(self.total)})"
+        try:
+            if self.message_id:
+                await bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text)
+            else:
+                sent = await bot.send_message(self.chat_id, text)
+                self.message_id = sent.message_id
+        except Exception as e:
+            logger.debug(f"Не удалось обновить прогресс скачивания: {e}")
+
+    async def finish(self):
+        if self.message_id:
+            try:
+                await bot.delete_message(chat_id=self.chat_id, message_id=self.message_id)
+            except Exception as e:
+                logger.debug(f"Не удалось удалить прогресс скачивания: {e}")
+
+
+async def read_local_file(path: str, chunk_size: int):
+    """Читает файл чанками (async generator, как session.stream_content)."""
+    async with aiofiles.open(path, 'rb') as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+
+
+async def stream_telegram_file(file_path: str, tmp_path: str, kind: str, limit: int, progress: DownloadProgress | None) -> str:
+    """
+    Скачивает файл с серверов Telegram потоком: чанки пишутся во временный файл
+    и сразу хешируются, файл целиком в памяти не держится.
+
+    Локальный Bot API сервер (api.is_local) отдаёт в get_file путь на диске, а не
+    ссылку для скачивания - такой файл копируется с диска так же чанками.
+
+    Returns:
+        sha256 содержимого
+    """
+    api = bot.session.api
+    digest = hashlib.sha256()
+    done = 0
+
+    # aclosing: при DownloadTooLarge или отмене задачи генератор закрывается сразу,
+    # вместе с ответом aiohttp и соединением (а не когда доберётся сборщик мусора)
+    if api.is_local:
+        stream = read_local_file(str(api.wrap_local_file.to_local(file_path)), DOWNLOAD_CHUNK_SIZE)
+    else:
+        stream = bot.session.stream_content(
+            url=api.file_url(bot.token, file_path), timeout=DOWNLOAD_TIMEOUT,
+            chunk_size=DOWNLOAD_CHUNK_SIZE, raise_for_status=True
+        )
+    async with aiofiles.open(tmp_path, 'wb') as f, contextlib.aclosing(stream):
+        async for chunk in stream:
+            done += len(chunk)
+            if done > limit:
+                raise DownloadTooLarge(kind, done, limit)
+
+            digest.update(chunk)
+            await f.write(chunk)
+
+            if progress:
+                await progress.update(done)
+
+        await f.flush()
+        await asyncio.to_thread(os.fsync, f.fileno())
+
+    return digest.hexdigest()
+
+
+async def download_telegram_file(media, kind: str, chat_id: int, subdir: str, make_filename) -> tuple[str, str]:
+    """
+    Возвращает локальный путь файла Telegram в uploads/<subdir>.
+
+    Уже известный file_unique_id отдаётся из upload_store без обращения к Telegram.
+    Иначе - get_file + потоковое скачивание (под download_semaphore) во временный файл
+    с хешированием на лету, затем атомарное переименование в content-addressed имя:
+    хранилище никогда не видит недокачанный файл.
+
+    Args:
+        media: Объект вложения (PhotoSize, Document, Video, ...) - file_id, file_unique_id, file_size
+        kind: Тип вложения (для лимита размера и прогресса)
+        chat_id: Чат, куда показывать прогресс скачивания больших файлов
+        subdir: Подпапка uploads ("photos" / "files")
+        make_filename: Функция (расширение файла на серверах Telegram, метка содержимого) -> локальное имя
+
+    Returns:
+        (local_path, local_filename)
+
+    Raises:
+        DownloadTooLarge: файл больше лимита своего типа
+    """
+    entry = upload_store.lookup(media.file_unique_id)
+    if entry:
+        logger.info(f"Файл {media.file_unique_id} уже скачан: {entry['path']}")
+        return entry['path'], os.path.basename(entry['path'])
+
+    # Размер известен из сообщения - слишком большой файл отсекаем ещё до get_file
+    limit = get_download_limit(kind)
+    if media.file_size and media.file_size > limit:
+        raise DownloadTooLarge(kind, media.file_size, limit)
+
+    target_dir = os.path.join(UPLOADS_DIR, subdir)
+    os.makedirs(target_dir, exist_ok=True)
+    tmp_path = os.path.join(target_dir, f".download_{uuid.uuid4().hex}")
+
+    progress = None
+    if media.file_size and media.file_size >= DOWNLOAD_PROGRESS_MIN_SIZE:
+        progress = DownloadProgress(chat_id, DOWNLOAD_KIND_LABELS.get(kind, "файл"), media.file_size)
+
+    try:
+        async with download_semaphore:
+            file = await bot.get_file(media.file_id)
+            file_path = file.file_path
+            extension = file_path.rsplit('.', 1)[-1] if '.' in file_path else None
+
+            sha256 = await stream_telegram_file(file_path, tmp_path, kind, limit, progress)
+
+        entry = upload_store.add(
+            media.file_unique_id, tmp_path, sha256,
+            lambda digest: os.path.join(target_dir, make_filename(extension, digest[:12]))
+        )
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if progress:
+            await progress.finish()
+
+    return entry['path'], os.path.basename(entry['path'])
+
+
+# Документы-картинки, для которых тоже делаем оптимизированную копию
+PREPROCESSABLE_IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/bmp', 'image/tiff'}
+
+
+def make_image_variant(path: str) -> tuple[str, str] | None:
+    """
+    Готовит оптимизированную копию изображения рядом с оригиналом:
+    длинная сторона до IMAGE_MAX_EDGE, без EXIF (ориентация применяется к пикселям),
+    IMAGE_FORMAT с качеством IMAGE_QUALITY.
+
+    Копия кешируется: имя зависит от оригинала (content-addressed) и настроек,
+    повторный вызов просто возвращает готовый файл (или None по маркеру .skip).
+
+    Returns:
+        (путь копии, описание для промпта) или None если копия не нужна
+        (Pillow не установлен, картинка уже маленькая и копия не легче оригинала)
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.warning("Библиотека Pillow не установлена - предобработка изображений пропущена. Установите: pip install Pillow")
+        return None
+
+    extension = 'jpg' if IMAGE_FORMAT in ('jpeg', 'jpg') else 'webp'
+    # splitext, а не rsplit('.'): у документа без расширения точка нашлась бы в имени каталога (.claude)
+    variant_base = f"{os.path.splitext(path)[0]}.{IMAGE_MAX_EDGE}q{IMAGE_QUALITY}"
+    variant_path = f"{variant_base}.{extension}"
+    # Маркер "копия не нужна" - повторно присланную маленькую картинку не декодируем заново
+    skip_path = f"{variant_base}.skip"
+
+    if os.path.exists(skip_path):
+        return None
+
+    if not os.path.exists(variant_path):
+        with Image.open(path) as image:
+            original_size = image.size
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+
+            if extension == 'jpg' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            elif image.mode not in ('RGB', 'RGBA', 'L'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+            # Пишем во временный файл и переименовываем - параллельный вызов не увидит недописанную копию
+            tmp_path = f"{variant_path}.tmp.{uuid.uuid4().hex[:8]}"
+            image.save(tmp_path, format='JPEG' if extension == 'jpg' else 'WEBP', quality=IMAGE_QUALITY)
+            resized = image.size != original_size
+
+        if not resized and os.path.getsize(tmp_path) >= os.path.getsize(path):
+            os.remove(tmp_path)
+            open(skip_path, 'w').close()
+            return None
+        os.replace(tmp_path, variant_path)
+    else:
+        touch_file(variant_path)
+
+    with Image.open(variant_path) as variant:
+        width, height = variant.size
+    note = f"{width}x{height} {extension.upper()}, {format_bytes(os.path.getsize(variant_path))}"
+    return variant_path, note
+
+
+async def attach_image_preview(file_info: dict) -> dict:
+    """Добавляет к файлу оптимизированную копию (preview_path/preview_note), если включено."""
+    if not IMAGE_PREPROCESS:
+        return file_info
+
+    try:
+        variant = await asyncio.to_thread(make_image_variant, file_info['path'])
+    except Exception as e:
+        logger.warning(f"Не удалось подготовить превью {file_info['path']}: {e}")
+        return file_info
+
+    if variant:
+        file_info['preview_path'], file_info['preview_note'] = variant
+        logger.info(f"Превью изображения: {file_info['preview_path']} ({file_info['preview_note']})")
+    return file_info
+
+
+# Извлечение текста из документов: расширение -> формат sidecar-файла
+EXTRACTABLE_DOCUMENT_TYPES = {
+    'pdf': 'txt',
+    'docx': 'md',
+    'xlsx': 'md',
+    'xlsm': 'md',
+    'csv': 'md'
+}
+# Сколько строк таблицы (лист XLSX, CSV) выгружать в sidecar
+EXTRACT_MAX_ROWS = 5000
+# Таймаут извлечения одного документа (сек)
+EXTRACT_TIMEOUT = 120
+
+# Пул процессов для извлечения (разбор PDF/XLSX грузит CPU и держит GIL) - создаётся при первом документе
+extract_pool = None
+
+
+def _markdown_table(rows: list[list]) -> str:
+    """Строки таблицы -> markdown таблица (первая строка - заголовок)."""
+    if not rows:
+        return ""
+
+    width = max(len(row) for row in rows)
+
+    def cell(value) -> str:
+        text = "" if value is None else str(value)
+        return text.replace("|", "\\|").replace("\n", " ").strip()
+
+    lines = []
+    for index, row in enumerate(rows):
+        cells = [cell(value) for value in row] + [""] * (width - len(row))
+        lines.append("| " + " | ".join(cells) + " |")
+        if index == 0:
+            lines.append("|" + " --- |" * width)
+    return "\n".join(lines)
+
+
+def _extract_pdf(path: str) -> tuple[str, int]:
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    parts = []
+    for number, page in enumerate(reader.pages, start=1):
+        parts.append(f"--- Страница {number} ---\n{(page.extract_text() or '').strip()}")
+    return "\n\n".join(parts), len(reader.pages)
+
+
+def _extract_docx(path: str) -> tuple[str, int | None]:
+    import re
+    import zipfile
+    from docx import Document
+
+    document = Document(path)
+    parts = []
+    for paragraph in document.paragraphs:
+        text = paragraph.text.strip()
+        if not text:
+            continue
+        style = (paragraph.style.name or "") if paragraph.style is not None else ""
+        if style.startswith("Heading") and style[-1:].isdigit():
+            parts.append(f"{'#' * int(style[-1])} {text}")
+        else:
+            parts.append(text)
+
+    for table in document.tables:
+        parts.append(_markdown_table([[cell.text for cell in row.cells] for row in table.rows]))
+
+    # Количество страниц Word хранит в docProps/app.xml (если документ сохранён Word'ом)
+    pages = None
+    with zipfile.ZipFile(path) as archive:
+        if 'docProps/app.xml' in archive.namelist():
+            match = re.search(rb"<Pages>(\d+)</Pages>", archive.read('docProps/app.xml'))
+            if match:
+                pages = int(match.group(1))
+
+    return "\n\n".join(parts), pages
+
+
+def _extract_xlsx(path: str) -> tuple[str, int]:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    parts = []
+    try:
+        for sheet in workbook.worksheets:
+            rows = []
+            truncated = False
+            for row in sheet.iter_rows(values_only=True):
+                if len(rows) >= EXTRACT_MAX_ROWS:
+                    truncated = True
+                    break
+                if any(value is not None for value in row):
+                    rows.append(list(row))
+            section = f"## Лист: {sheet.title}\n\n{_markdown_table(rows) or '(пусто)'}"
+            if truncated:
+                section += f"\n\n(показаны первые {EXTRACT_MAX_ROWS} строк)"
+            parts.append(section)
+        return "\n\n".join(parts), len(workbook.worksheets)
+    finally:
+        workbook.close()
+
+
+def _extract_csv(path: str) -> tuple[str, int | None]:
+    import csv
+
+    with open(path, 'r', encoding='utf-8-sig', errors='replace', newline='') as f:
+        sample = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+
+        rows = []
+        total = 0
+        for row in csv.reader(f, dialect):
+            total += 1
+            if len(rows) < EXTRACT_MAX_ROWS:
+                rows.append(row)
+
+    text = f"Строк: {total}\n\n{_markdown_table(rows)}"
+    if total > EXTRACT_MAX_ROWS:
+        text += f"\n\n(показаны первые {EXTRACT_MAX_ROWS} строк)"
+    return text, None
+
+
+def extract_document_text(path: str, extension: str, sidecar_path: str) -> dict:
+    """
+    Извлекает текст документа в sidecar-файл (выполняется в процессе extract_pool).
+
+    Returns:
+        {'pages': int | None, 'chars': int} - метаданные, которые кешируются рядом с документом
+    """
+    extractors = {
+        'pdf': _extract_pdf,
+        'docx': _extract_docx,
+        'xlsx': _extract_xlsx,
+        'xlsm': _extract_xlsx,
+        'csv': _extract_csv
+    }
+    text, pages = extractors[extension](path)
+
+    tmp_path = f"{sidecar_path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, sidecar_path)
+
+    return {'pages': pages, 'chars': len(text)}
+
+
+def shutdown_extract_pool(terminate: bool = False):
+    """
+    Останавливает extract_pool, следующий документ создаст новый.
+
+    terminate=True - убить процессы: зависший разбор (битый PDF) не прервать через
+    future, а без этого воркер так и занимал бы слот пула.
+    """
+    global extract_pool
+
+    pool, extract_pool = extract_pool, None
+    if pool is None:
+        return
+    if terminate:
+        for process in list((getattr(pool, '_processes', None) or {}).values()):
+            process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def attach_text_extract(file_info: dict) -> dict:
+    """
+    Добавляет к документу текстовый sidecar (text_path/text_note) для PDF, DOCX, XLSX, CSV.
+
+    Результат кешируется рядом с документом: имя документа содержит хеш содержимого,
+    так что повторно присланный файл берёт готовый sidecar без разбора.
+    """
+    global extract_pool
+
+    extension = file_info['path'].rsplit('.', 1)[-1].lower() if '.' in os.path.basename(file_info['path']) else ""
+    sidecar_format = EXTRACTABLE_DOCUMENT_TYPES.get(extension)
+    if not sidecar_format:
+        return file_info
+
+    sidecar_path = f"{file_info['path']}.{sidecar_format}"
+    meta_path = f"{file_info['path']}.extract.json"
+
+    meta = None
+    if os.path.exists(sidecar_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            touch_file(sidecar_path)
+            logger.info(f"Текст документа из кеша: {sidecar_path}")
+        except Exception as e:
+            logger.debug(f"Кеш извлечения повреждён ({meta_path}): {e}")
+            meta = None
+
+    if meta is None:
+        if extract_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # forkserver, не fork: форкнутый воркер унаследовал бы stdin-pipe тёплых процессов Claude,
+            # и claude -p - не получил бы EOF после write_prompt()
+            extract_pool = ProcessPoolExecutor(
+                max_workers=DOCUMENT_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+
+        pool = extract_pool
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            meta = await asyncio.wait_for(
+                loop.run_in_executor(pool, extract_document_text, file_info['path'], extension, sidecar_path),
+                timeout=EXTRACT_TIMEOUT
+            )
+        except ImportError as e:
+            logger.warning(f"Нет библиотеки для извлечения текста из .{extension} ({e.name}) - пропускаю")
+            return file_info
+        except (asyncio.TimeoutError, BrokenProcessPool) as e:
+            # Зависший или упавший воркер: пул пересоздаётся, параллельные извлечения тоже отменятся
+            logger.warning(f"Извлечение текста из {file_info['path']} прервано ({e!r})")
+            if extract_pool is pool:  # Соседняя задача могла уже пересоздать пул
+                logger.warning("Перезапускаю пул извлечения текста")
+                shutdown_extract_pool(terminate=True)
+            return file_info
+        except Exception as e:
+            logger.warning(f"Не удалось извлечь текст из {file_info['path']}: {e!r}")
+            return file_info
+
+        write_file_atomic(meta_path, json.dumps(meta))
+        logger.info(f"Текст документа извлечён за {time.monotonic() - started:.1f}s: {sidecar_path} ({meta['chars']} символов)")
+
+    if not meta['chars']:
+        return file_info
+
+    note = format_bytes(os.path.getsize(sidecar_path))
+    if meta.get('pages'):
+        note += f", {meta['pages']} {'листов' if extension in ('xlsx', 'xlsm') else 'стр.'}"
+
+    file_info['text_path'] = sidecar_path
+    file_info['text_note'] = note
+    return file_info
+
+
+# Ограничение параллельных ffmpeg для видео (кадры + звуковая дорожка)
+media_process_semaphore = asyncio.Semaphore(VIDEO_PROCESS_WORKERS)
+# Таймаут одного вызова ffmpeg/ffprobe (сек)
+FFMPEG_TIMEOUT = 300
+# Длинная сторона кадра, px
+VIDEO_FRAME_EDGE = 1024
+
+
+async def run_media_command(args: list[str]) -> tuple[int, bytes, bytes]:
+    """Запускает ffmpeg/ffprobe без блокировки event loop. Returns: (код возврата, stdout, stderr)."""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=FFMPEG_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stdout, stderr
+
+
+async def probe_media(path: str) -> tuple[float, bool]:
+    """Длительность видео / аудио (сек) и наличие звуковой дорожки."""
+    returncode, stdout, stderr = await run_media_command([
+        'ffprobe', '-v', 'error', '-print_format', 'json', '-show_entries',
+        'format=duration:stream=codec_type', path
+    ])
+    if returncode != 0:
+        raise RuntimeError(f"ffprobe: {stderr.decode(errors='replace').strip()[-300:]}")
+
+    info = json.loads(stdout or b"{}")
+    duration = float(info.get('format', {}).get('duration') or 0)
+    has_audio = any(stream.get('codec_type') == 'audio' for stream in info.get('streams', []))
+    return duration, has_audio
+
+
+async def extract_video_frames(path: str, duration: float) -> list[str]:
+    """
+    VIDEO_KEYFRAMES кадров JPEG, равномерно по длительности.
+    -ss перед -i - быстрый поиск по ключевым кадрам, файл не декодируется целиком.
+    """
+    count = max(1, VIDEO_KEYFRAMES if duration > 0 else 1)
+    frames = []
+    for index in range(count):
+        frame_path = f"{path}.frame{index + 1}.jpg"
+        timestamp = duration * (index + 0.5) / count
+        returncode, _, stderr = await run_media_command([
+            'ffmpeg', '-v', 'error', '-y', '-ss', f"{timestamp:.2f}", '-i', path,
+            '-frames:v', '1', '-q:v', '3',
+            '-vf', f"scale='min({VIDEO_FRAME_EDGE},iw)':'min({VIDEO_FRAME_EDGE},ih)':force_original_aspect_ratio=decrease",
+            frame_path
+        ])
+        if returncode != 0 or not os.path.exists(frame_path):
+            logger.warning(f"Кадр {index + 1} не извлечён из {path}: {stderr.decode(errors='replace').strip()[-300:]}")
+            continue
+        frames.append(frame_path)
+    return frames
+
+
+async def extract_audio_track(path: str) -> str | None:
+    """Вытаскивает звуковую дорожку видео в mp3 для transcribe_audio. Returns: путь mp3 или None."""
+    audio_path = f"{path}.audio.mp3"
+    returncode, _, stderr = await run_media_command([
+        'ffmpeg', '-v', 'error', '-y', '-i', path, '-vn', '-ac', '1', '-ar', '16000',
+        '-codec:a', 'libmp3lame', '-q:a', '4', audio_path
+    ])
+    if returncode != 0:
+        logger.warning(f"Звуковая дорожка не извлечена из {path}: {stderr.decode(errors='replace').strip()[-300:]}")
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+        return None
+    return audio_path
+
+
+async def attach_video_media(file_info: dict) -> dict:
+    """
+    Добавляет к видео / видео-заметке кадры (frame_paths) и транскрипцию звука (transcript_path).
+
+    Результат кешируется рядом с видео (имя содержит хеш содержимого): <путь>.media.json.
+    Повторно присланное видео ffmpeg не трогает.
+    """
+    path = file_info['path']
+    meta_path = f"{path}.media.json"
+
+    meta = None
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            cached = meta['frames'] + ([meta['transcript_path']] if meta.get('transcript_path') else [])
+            if all(os.path.exists(cached_path) for cached_path in cached):
+                for cached_path in cached:
+                    touch_file(cached_path)
+                logger.info(f"Кадры/транскрипция видео из кеша: {meta_path}")
+            else:
+                meta = None
+        except Exception as e:
+            logger.debug(f"Кеш видео повреждён ({meta_path}): {e}")
+            meta = None
+
+    if meta is None:
+        started = time.monotonic()
+        audio_path = None
+        try:
+            # Семафор - только на ffprobe/ffmpeg: транскрипция идёт своим бэкендом (API или пул
+            # whisper) и не должна держать слот, пока следующее видео ждёт нарезки кадров
+            async with media_process_semaphore:
+                duration, has_audio = await probe_media(path)
+                frames = await extract_video_frames(path, duration) if VIDEO_KEYFRAMES > 0 else []
+                audio_path = await extract_audio_track(path) if has_audio else None
+            transcript = await transcribe_audio(audio_path, language="ru") if audio_path else None
+        except FileNotFoundError:
+            logger.warning("ffmpeg/ffprobe не найден - кадры и звук видео не извлекаются")
+            return file_info
+        except Exception as e:
+            logger.warning(f"Не удалось обработать видео {path}: {e!r}")
+            return file_info
+        finally:
+            if audio_path and os.path.exists(audio_path):
+                os.remove(audio_path)
+
+        transcript_path = None
+        if transcript:
+            transcript_path = f"{path}.transcript.txt"
+            write_file_atomic(transcript_path, transcript)
+
+        meta = {'duration': duration, 'frames': frames, 'transcript_path': transcript_path}
+        # Транскрипция не удалась, хотя звук есть - не кешируем, пусть повторится в следующий раз
+        if transcript_path or not has_audio:
+            write_file_atomic(meta_path, json.dumps(meta))
+        logger.info(
+            f"Видео обработано за {time.monotonic() - started:.1f}s: {len(frames)} кадров, "
+            f"транскрипция {'есть' if transcript_path else 'нет'} ({path})"
+        )
+
+    if meta['frames']:
+        file_info['frame_paths'] = meta['frames']
+    if meta.get('transcript_path'):
+        file_info['transcript_path'] = meta['transcript_path']
+    if meta.get('duration'):
+        file_info['duration'] = meta['duration']
+    return file_info
+
+
+async def _save_photo(message: Message) -> dict:
+    photo = message.photo[-1]  # Лучшее качество
+    local_path, local_filename = await download_telegram_file(
+        photo, 'photo', message.chat.id, "photos",
+        lambda ext, tag: f"photo_{tag}.{ext or 'jpg'}"
+    )
+    logger.info(f"Фото сохранено: {local_path}")
+    return await attach_image_preview({
+        'type': 'photo',
+        'path': local_path,
+        'name': local_filename,
+        'size': photo.file_size if hasattr(photo, 'file_size') else 0,
+        'caption': message.caption
+    })
+
+
+async def _save_document(message: Message) -> dict:
+    document = message.document
+    base_name, extension = split_filename(document.file_name or "document", "")
+    local_path, local_filename = await download_telegram_file(
+        document, 'document', message.chat.id, "files",
+        lambda ext, tag: f"{base_name}_{tag}" + (f".{extension}" if extension else "")
+    )
+    logger.info(f"Документ сохранён: {local_path}")
+    file_info = {
+        'type': 'document',
+        'path': local_path,
+        'name': local_filename,
+        'size': document.file_size,
+        'caption': message.caption
+    }
+    # Картинка, отправленная файлом (без сжатия Telegram) - тоже готовим превью
+    if (document.mime_type or "") in PREPROCESSABLE_IMAGE_TYPES:
+        file_info = await attach_image_preview(file_info)
+    # PDF / офисные документы - извлекаем текст, чтобы Claude читал его напрямую
+    return await attach_text_extract(file_info)
+
+
+async def _save_video(message: Message) -> dict:
+    video = message.video
+    local_path, local_filename = await download_telegram_file(
+        video, 'video', message.chat.id, "files",
+        lambda ext, tag: f"video_{tag}.{ext or 'mp4'}"
+    )
+    logger.info(f"Видео сохранено: {local_path}")
+    return await attach_video_media({
+        'type': 'video',
+        'path': local_path,
+        'name': local_filename,
+        'size': video.file_size,
+        'caption': message.caption
+    })
+
+
+async def _save_audio(message: Message) -> dict:
+    audio = message.audio
+
+    def make_filename(ext, tag):
+        if audio.file_name and '.' in audio.file_name:
+            base_name, extension = split_filename(audio.file_name, ext or 'mp3')
+            return f"{base_name}_{tag}.{extension}"
+        return f"{audio.file_name or 'audio'}_{tag}.{ext or 'mp3'}"
+
+    local_path, local_filename = await download_telegram_file(audio, 'audio', message.chat.id, "files", make_filename)
+    logger.info(f"Аудио сохранено: {local_path}")
+    return await attach_audio_transcript({
+        'type': 'audio',
+        'path': local_path,
+        'name': local_filename,
+        'size': audio.file_size,
+        'caption': message.caption,
+        'file_unique_id': audio.file_unique_id
+    })
+
+
+async def _save_voice(message: Message) -> dict:
+    voice = message.voice
+
+    # Уже транскрибировано (пересылка, повтор после /stop) - не скачиваем
+    cached = transcript_cache.get(voice.file_unique_id, language="ru")
+    if cached:
+        logger.info(f"Голосовое сообщение уже транскрибировано - беру из кеша ({voice.file_unique_id})")
+        return {
+            'path': None,
+            'name': f"voice_{voice.file_unique_id}",
+            'size': voice.file_size,
+            'caption': message.caption,
+            'file_unique_id': voice.file_unique_id,
+            'transcript': cached['text']
+        }
+
+    local_path, local_filename = await download_telegram_file(
+        voice, 'voice', message.chat.id, "files",
+        lambda ext, tag: f"voice_{tag}.{ext or 'ogg'}"
+    )
+    logger.info(f"Голосовое сообщение скачано: {local_path}")
+    return {
+        'path': local_path,
+        'name': local_filename,
+        'size': voice.file_size,
+        'caption': message.caption,
+        'file_unique_id': voice.file_unique_id
+    }
+
+
+async def _save_video_note(message: Message) -> dict:
+    video_note = message.video_note
+    local_path, local_filename = await download_telegram_file(
+        video_note, 'video_note', message.chat.id, "files",
+        lambda ext, tag: f"video_note_{tag}.{ext or 'mp4'}"
+    )
+    logger.info(f"Видео-заметка сохранена: {local_path}")
+    return await attach_video_media({
+        'type': 'video_note',
+        'path': local_path,
+        'name': local_filename,
+        'size': video_note.file_size,
+        'caption': message.caption
+    })
+
+
+# Типы вложений в порядке, в котором они попадают в промпт: (атрибут Message, загрузчик, название для логов)
+MESSAGE_FILE_SAVERS = [
+    ('photo', _save_photo, "фото"),
+    ('document', _save_document, "документа"),
+    ('video', _save_video, "видео"),
+    ('audio', _save_audio, "аудио"),
+    ('voice', _save_voice, "голосового"),
+    ('video_note', _save_video_note, "видео-заметки"),
+]
+
+
+async def _run_saver(saver, message: Message, label: str) -> dict | None:
+    """Запускает загрузчик вложения; ошибка одного файла не роняет остальные."""
+    try:
+        return await saver(message)
+    except DownloadTooLarge as e:
+        logger.warning(f"Пропущен файл ({label}): {e}")
+        try:
+            await message.reply(
+                f"⚠️ Файл слишком большой ({format_bytes(e.size)}, лимит {format_bytes(e.limit)}) - пропускаю его"
+            )
+        except Exception as reply_error:
+            logger.warning(f"Не удалось сообщить о пропущенном файле: {reply_error}")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка сохранения {label}: {e}")
+        return None
+
+
+async def save_message_files(message: Message) -> tuple[list[dict], dict | None]:
+    """
+    Сохраняет все файлы из сообщения (фото, документы, видео, аудио).
+    Голосовые сообщения обрабатываются отдельно.
+    Вложения скачиваются параллельно (в пределах download_semaphore), порядок сохраняется.
+
+    Returns:
+        tuple[list[dict], dict | None]:
+            - Список обычных файлов (БЕЗ голосовых)
+            - Информация о голосовом сообщении (или None)
+    """
+    savers = [(attr, saver, label) for attr, saver, label in MESSAGE_FILE_SAVERS if getattr(message, attr)]
+    results = await asyncio.gather(*(_run_saver(saver, message, label) for _, saver, label in savers))
+
+    files = []
+    voice_info = None
+    for (attr, _, _), result in zip(savers, results):
+        if result is None:
+            continue
+        # Голосовое НЕ добавляем в files - обрабатываем отдельно
+        if attr == 'voice':
+            voice_info = result
+        else:
+            files.append(result)
+
+    return files, voice_info
+
+
+# Общий клиент OpenAI: один пул HTTP-соединений на все транскрипции (создаётся при первой)
+openai_client = None
+
+# Форматы, которые API транскрипции принимает без конвертации
+TRANSCRIBE_NATIVE_FORMATS = {'flac', 'mp3', 'mp4', 'mpeg', 'mpga', 'm4a', 'ogg', 'wav', 'webm'}
+# Расширения Telegram, которые отличаются от принятых API только названием
+TRANSCRIBE_EXTENSION_ALIASES = {'oga': 'ogg', 'opus': 'ogg'}
+# Лимит размера файла API; больше - перекодируем в mono mp3
+TRANSCRIBE_UPLOAD_LIMIT = 25 * 1024 * 1024
+# Длинное аудио режется, только если длиннее сегмента хотя бы на эту долю (хвост в 10 сек не стоит отдельного запроса)
+TRANSCRIBE_CHUNK_SLACK = 1.2
+# Пауза для разреза: уровень тишины и минимальная длительность (сек)
+TRANSCRIBE_SILENCE_NOISE = "-30dB"
+TRANSCRIBE_SILENCE_MIN = 0.5
+# Перекрытие сегментов при разрезе без паузы (сек)
+TRANSCRIBE_OVERLAP = 2.0
+
+# Ограничение параллельных запросов транскрипции (на весь бот)
+transcribe_semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+
+def get_openai_client():
+    """AsyncOpenAI клиент или None, если нет библиотеки или OPENAI_API_KEY."""
+    global openai_client
+
+    if openai_client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            logger.warning("OPENAI_API_KEY не найден в .env - транскрипция пропущена")
+            return None
+
+        try:
+            from openai import AsyncOpenAI
+        except ImportError:
+            logger.error("Библиотека openai не установлена. Установите: pip install openai")
+            return None
+
+        openai_client = AsyncOpenAI(api_key=api_key)
+
+    return openai_client
+
+
+async def prepare_audio_upload(audio_file_path: str) -> tuple[str, bytes] | None:
+    """
+    Файл для API транскрипции: (имя, содержимое).
+    Поддерживаемые форматы уходят как есть, остальное - mono mp3, перекодированный в памяти.
+    """
+    base_name, extension = split_filename(os.path.basename(audio_file_path), "")
+    extension = TRANSCRIBE_EXTENSION_ALIASES.get(extension.lower(), extension.lower())
+
+    if extension in TRANSCRIBE_NATIVE_FORMATS and os.path.getsize(audio_file_path) <= TRANSCRIBE_UPLOAD_LIMIT:
+        # Формат понимает API - отправляем как есть (.oga голосовых - это ogg/opus, меняем только имя)
+        async with aiofiles.open(audio_file_path, "rb") as f:
+            return f"{base_name}.{extension}", await f.read()
+
+    # Конвертация в mp3 через pipe - без промежуточного файла на диске
+    logger.info(f"Конвертация {audio_file_path} -> mp3 (в памяти)")
+    returncode, stdout, stderr = await run_media_command([
+        'ffmpeg', '-v', 'error', '-i', audio_file_path, '-vn', '-ac', '1',
+        '-codec:a', 'libmp3lame', '-q:a', '4', '-f', 'mp3', 'pipe:1'
+    ])
+
+    if returncode != 0:
+        logger.error(f"Ошибка конвертации аудио: {stderr.decode(errors='replace')}")
+        return None
+
+    logger.info(f"Конвертация завершена: {format_bytes(len(stdout))}")
+    return f"{base_name}.mp3", stdout
+
+
+class OpenAITranscriber:
+    """Backend транскрипции: gpt-4o-transcribe через общий AsyncOpenAI клиент."""
+
+    name = "openai"
+    # Лимит 25 MB на запрос - длинное аудио режется на сегменты (они же идут параллельно)
+    chunked = True
+
+    def available(self) -> bool:
+        return get_openai_client() is not None
+
+    async def transcribe(self, upload: tuple[str, bytes], language: str) -> str:
+        logger.info(f"Отправка аудио на транскрипцию (gpt-4o-transcribe): {upload[0]}, {format_bytes(len(upload[1]))}")
+
+        transcription = await get_openai_client().audio.transcriptions.create(
+            model="gpt-4o-transcribe",  # Новая модель с лучшей точностью
+            file=upload,
+            response_format="text",
+            language=language,
+            temperature=0.0,
+        )
+
+        # API возвращает строку напрямую при response_format="text"
+        return transcription.strip() if transcription else ""
+
+    async def shutdown(self):
+        if openai_client is not None:
+            await openai_client.close()
+
+
+# Модель faster-whisper внутри процесса LocalWhisperTranscriber (загружается initializer'ом один раз)
+_local_whisper_model = None
+
+
+def _local_whisper_init(model_name: str, compute_type: str):
+    global _local_whisper_model
+    from faster_whisper import WhisperModel
+
+    _local_whisper_model = WhisperModel(model_name, device="cpu", compute_type=compute_type)
+
+
+def _local_whisper_ping() -> bool:
+    return _local_whisper_model is not None
+
+
+def _local_whisper_transcribe(audio: bytes, language: str) -> str:
+    import io
+
+    segments, _ = _local_whisper_model.transcribe(io.BytesIO(audio), language=language, beam_size=1, vad_filter=True)
+    return " ".join(segment.text.strip() for segment in segments).strip()
+
+
+class LocalWhisperTranscriber:
+    """
+    Backend транскрипции: faster-whisper на CPU, без сети.
+
+    Модель живёт в отдельном процессе (ProcessPoolExecutor из одного воркера):
+    грузится один раз и остаётся тёплой, распознавание не держит GIL бота.
+    """
+
+    name = "local"
+    # Модель сама режет аудио на окна - сегменты не нужны (воркер один, параллелить нечего)
+    chunked = False
+
+    def __init__(self):
+        self.pool = None
+        self.missing = False  # faster-whisper не установлен - не проверяем на каждом сообщении
+
+    def available(self) -> bool:
+        if self.missing or not TRANSCRIBE_LOCAL_MODEL:
+            return False
+
+        import importlib.util
+        if importlib.util.find_spec('faster_whisper') is None:
+            # В auto-режиме это нормально (работает OpenAI), явный local без библиотеки - ошибка конфигурации
+            log = logger.warning if TRANSCRIBE_BACKEND == 'local' else logger.info
+            log("Библиотека faster-whisper не установлена - локальная транскрипция недоступна")
+            self.missing = True
+            return False
+        return True
+
+    def _get_pool(self):
+        if self.pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            logger.info(f"Запуск локальной транскрипции: faster-whisper {TRANSCRIBE_LOCAL_MODEL} ({TRANSCRIBE_LOCAL_COMPUTE})")
+            # forkserver, как у extract_pool: пул пересоздаётся, когда тёплые процессы Claude уже запущены,
+            # а fork унаследовал бы их stdin-pipe
+            self.pool = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_local_whisper_init,
+                initargs=(TRANSCRIBE_LOCAL_MODEL, TRANSCRIBE_LOCAL_COMPUTE)
+            )
+        return self.pool
+
+    async def _run(self, func, *args):
+        from concurrent.futures.process import BrokenProcessPool
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_pool(), func, *args)
+        except BrokenProcessPool:
+            # Воркер упал (модель не загрузилась, OOM) - следующий вызов поднимет новый
+            self.pool = None
+            raise
+
+    async def warm_up(self):
+        """Загружает модель заранее, чтобы первое голосовое не ждало её."""
+        started = time.monotonic()
+        try:
+            await self._run(_local_whisper_ping)
+            logger.info(f"Модель faster-whisper загружена за {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить модель faster-whisper: {e!r}")
+
+    async def transcribe(self, upload: tuple[str, bytes], language: str) -> str:
+        logger.info(f"Локальная транскрипция (faster-whisper {TRANSCRIBE_LOCAL_MODEL}): {upload[0]}, {format_bytes(len(upload[1]))}")
+        return await self._run(_local_whisper_transcribe, upload[1], language)
+
+    async def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+transcription_backends = {
+    'openai': OpenAITranscriber(),
+    'local': LocalWhisperTranscriber()
+}
+
+
+def select_transcription_backends(duration: float) -> list:
+    """
+    Backend'ы для файла в порядке попытки (следующий - запасной, если предыдущий упал).
+
+    TRANSCRIBE_BACKEND=openai / local - только он.
+    auto - короткие (до TRANSCRIBE_LOCAL_MAX_SECONDS) локально, без сетевого запроса,
+    длинные через OpenAI (параллельные сегменты), второй backend - запасной.
+    """
+    if TRANSCRIBE_BACKEND in transcription_backends:
+        candidates = [transcription_backends[TRANSCRIBE_BACKEND]]
+    elif 0 < duration <= TRANSCRIBE_LOCAL_MAX_SECONDS:
+        candidates = [transcription_backends['local'], transcription_backends['openai']]
+    else:
+        candidates = [transcription_backends['openai'], transcription_backends['local']]
+
+    return [backend for backend in candidates if backend.available()]
+
+
+async def detect_silences(audio_file_path: str) -> list[tuple[float, float]]:
+    """Паузы в аудио (ffmpeg silencedetect): [(начало, конец), ...] в секундах."""
+    returncode, _, stderr = await run_media_command([
+        'ffmpeg', '-hide_banner', '-nostats', '-i', audio_file_path, '-vn',
+        '-af', f"silencedetect=noise={TRANSCRIBE_SILENCE_NOISE}:d={TRANSCRIBE_SILENCE_MIN}", '-f', 'null', '-'
+    ])
+    if returncode != 0:
+        logger.warning(f"Поиск пауз не удался: {stderr.decode(errors='replace').strip()[-300:]}")
+        return []
+
+    silences = []
+    silence_start = None
+    for line in stderr.decode(errors='replace').splitlines():
+        if 'silence_start:' in line:
+            silence_start = float(line.split('silence_start:')[1].split()[0])
+        elif 'silence_end:' in line and silence_start is not None:
+            silences.append((silence_start, float(line.split('silence_end:')[1].split()[0])))
+            silence_start = None
+    return silences
+
+
+def plan_audio_segments(duration: float, silences: list[tuple[float, float]]) -> list[tuple[float, float, bool]]:
+    """
+    Делит аудио на сегменты не длиннее TRANSCRIBE_CHUNK_SECONDS.
+
+    Разрез - по середине последней паузы во второй половине сегмента. Если пауз нет,
+    режем по времени, и следующий сегмент начинается на TRANSCRIBE_OVERLAP раньше,
+    чтобы не потерять слово на стыке.
+
+    Returns:
+        [(начало, конец, перекрывается с предыдущим), ...]
+    """
+    segments = []
+    start = 0.0
+    overlapped = False
+    while duration - start > TRANSCRIBE_CHUNK_SECONDS:
+        target = start + TRANSCRIBE_CHUNK_SECONDS
+        window_start = start + TRANSCRIBE_CHUNK_SECONDS / 2
+        cuts = [(silence_start + silence_end) / 2 for silence_start, silence_end in silences
+                if window_start <= (silence_start + silence_end) / 2 <= target]
+
+        if cuts:
+            segments.append((start, cuts[-1], overlapped))
+            start, overlapped = cuts[-1], False
+        else:
+            segments.append((start, target, overlapped))
+            start, overlapped = target - TRANSCRIBE_OVERLAP, True
+
+    segments.append((start, duration, overlapped))
+    return segments
+
+
+def strip_overlap(previous: str, text: str, max_words: int = 30) -> str:
+    """Убирает из начала text слова, повторяющие конец previous (стык перекрывающихся сегментов)."""
+    def normalize(word: str) -> str:
+        return word.strip(".,!?…:;\"'«»()-—").lower()
+
+    previous_words = [normalize(word) for word in previous.split()[-max_words:]]
+    words = text.split()
+    head = [normalize(word) for word in words[:max_words]]
+
+    for size in range(min(len(previous_words), len(head)), 0, -1):
+        if previous_words[-size:] == head[:size]:
+            return " ".join(words[size:])
+    return text
+
+
+async def transcribe_chunked(backend, audio_file_path: str, duration: float, language: str) -> str | None:
+    """Длинное аудио: сегменты по паузам транскрибируются параллельно и склеиваются по порядку."""
+    silences = await detect_silences(audio_file_path)
+    segments = plan_audio_segments(duration, silences)
+    logger.info(f"Длинное аудио ({duration:.0f} сек): {len(segments)} сегментов, пауз найдено: {len(silences)}")
+
+    async def transcribe_segment(index: int, start: float, end: float) -> str:
+        async with transcribe_semaphore:
+            returncode, stdout, stderr = await run_media_command([
+                'ffmpeg', '-v', 'error', '-ss', f"{start:.2f}", '-t', f"{end - start:.2f}", '-i', audio_file_path,
+                '-vn', '-ac', '1', '-codec:a', 'libmp3lame', '-q:a', '4', '-f', 'mp3', 'pipe:1'
+            ])
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg (сегмент {index + 1}): {stderr.decode(errors='replace').strip()[-300:]}")
+            return await backend.transcribe((f"segment_{index + 1}.mp3", stdout), language)
+
+    started = time.monotonic()
+    texts = await asyncio.gather(*(
+        transcribe_segment(index, start, end) for index, (start, end, _) in enumerate(segments)
+    ))
+
+    result = texts[0]
+    for (_, _, overlapped), text in zip(segments[1:], texts[1:]):
+        if overlapped:
+            text = strip_overlap(result, text)
+        result = f"{result} {text}".strip()
+
+    logger.info(f"Сегменты транскрибированы за {time.monotonic() - started:.1f}s")
+    return result
+
+
+class TranscriptCache:
+    """
+    Постоянный кеш транскрипций: sha256 содержимого (и file_unique_id из Telegram) -> текст.
+
+    Повторно присланное голосовое (пересылка, повтор после /stop) находится по file_unique_id
+    ещё до скачивания - без get_file, ffmpeg и запроса к API. Размер ограничен TRANSCRIPT_CACHE_MB,
+    при переполнении вытесняются давно не использованные записи (LRU).
+
+    Файл пишется в потоке (flush), не в event loop: новая запись сохраняется сразу,
+    время использования (used) при попадании - при следующем flush (storage_gc_loop, остановка бота).
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        # {'entries': {sha256: {'text', 'language', 'duration', 'backend', 'created', 'used'}}, 'uids': {file_unique_id: sha256}}
+        self.data = None
+        self.dirty = False
+        self.flush_lock = asyncio.Lock()  # Старый снимок не должен перезаписать более новый
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                self.data = json.load(f)
+            logger.info(f"Кеш транскрипций: {len(self.data['entries'])} записей")
+        except FileNotFoundError:
+            self.data = {'entries': {}, 'uids': {}}
+        except Exception as e:
+            logger.error(f"Не удалось загрузить кеш транскрипций: {e}")
+            self.data = {'entries': {}, 'uids': {}}
+
+    async def flush(self):
+        """Сохраняет кеш, если он менялся. Сериализация и запись - в потоке, в loop только снимок словарей."""
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            snapshot = {
+                'entries': {key: dict(entry) for key, entry in self.data['entries'].items()},
+                'uids': dict(self.data['uids'])
+            }
+            try:
+                await asyncio.to_thread(
+                    lambda: write_file_atomic(self.cache_file, json.dumps(snapshot, ensure_ascii=False))
+                )
+            except Exception as e:
+                self.dirty = True
+                logger.warning(f"Не удалось сохранить кеш транскрипций: {e}")
+
+    def get(self, file_unique_id: str | None = None, sha256: str | None = None, language: str | None = None) -> dict | None:
+        """Запись кеша по хешу содержимого или file_unique_id (того же языка)."""
+        if self.data is None:
+            self.load()
+
+        key = sha256 if sha256 in self.data['entries'] else self.data['uids'].get(file_unique_id)
+        entry = self.data['entries'].get(key)
+        if not entry or (language and entry['language'] != language):
+            return None
+
+        # Только в памяти - на диск уйдёт при следующем flush
+        entry['used'] = time.time()
+        if file_unique_id:
+            self.data['uids'][file_unique_id] = key
+        self.dirty = True
+        return entry
+
+    async def put(self, sha256: str, file_unique_id: str | None, text: str, language: str, duration: float, backend: str):
+        if self.data is None:
+            self.load()
+
+        now = time.time()
+        self.data['entries'][sha256] = {
+            'text': text,
+            'language': language,
+            'duration': duration,
+            'backend': backend,
+            'created': now,
+            'used': now
+        }
+        if file_unique_id:
+            self.data['uids'][file_unique_id] = sha256
+
+        self._evict()
+        self.dirty = True
+        await self.flush()
+
+    def _evict(self):
+        """Вытесняет давно не использованные записи, пока тексты не уложатся в TRANSCRIPT_CACHE_MB."""
+        entries = self.data['entries']
+        limit = TRANSCRIPT_CACHE_MB * 1024 * 1024
+        total = sum(len(entry['text'].encode()) for entry in entries.values())
+        if total <= limit:
+            return
+
+        for key in sorted(entries, key=lambda key: entries[key]['used']):
+            if total <= limit:
+                break
+            total -= len(entries.pop(key)['text'].encode())
+
+        self.data['uids'] = {uid: key for uid, key in self.data['uids'].items() if key in entries}
+        logger.info(f"Кеш транскрипций сокращён до {len(entries)} записей ({format_bytes(total)})")
+
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_FILE)
+
+
+def file_sha256(path: str) -> str:
+    """sha256 файла (синхронно - вызывать через asyncio.to_thread)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def transcribe_audio(audio_file_path: str, language: str = "ru", file_unique_id: str | None = None) -> str | None:
+    """
+    Транскрибирует аудио файл используя OpenAI gpt-4o-transcribe или локальный faster-whisper.
+
+    Модель gpt-4o-transcribe - улучшенная модель транскрипции от OpenAI,
+    предоставляющая лучшую точность чем Whisper (меньше Word Error Rate),
+    особенно для речи с акцентами и в шумной среде.
+    Локальная модель работает без сети и без ключа - backend выбирается
+    select_transcription_backends (TRANSCRIBE_BACKEND, длина файла), при ошибке пробуется следующий.
+    Результат сохраняется в transcript_cache: то же содержимое повторно не транскрибируется.
+
+    Конвертация (ffmpeg) и запрос к API не блокируют event loop:
+    пока идёт транскрипция, бот отвечает на сообщения, кнопки и /send.
+    Голосовые (ogg/opus) и другие поддерживаемые форматы уходят как есть,
+    остальное перекодируется в mp3 в памяти (ffmpeg пишет в pipe).
+    Аудио длиннее TRANSCRIBE_CHUNK_SECONDS режется по паузам на сегменты,
+    которые транскрибируются параллельно (до TRANSCRIBE_CONCURRENCY запросов).
+
+    Стоимость: $0.006 за минуту аудио (gpt-4o-transcribe)
+    Лимит: 25 MB файл, до 2000 токенов на выход (на сегмент)
+
+    Args:
+        audio_file_path: Путь к аудио файлу (ogg, mp3, mp4, mpeg, mpga, m4a, wav, webm)
+        language: Код языка (ru, en, etc.) - опционально, помогает точности
+        file_unique_id: file_unique_id из Telegram - чтобы следующий раз найти транскрипцию до скачивания
+
+    Returns:
+        Текст транскрипции или None в случае ошибки
+    """
+    sha256 = await asyncio.to_thread(file_sha256, audio_file_path)
+    cached = transcript_cache.get(file_unique_id, sha256, language)
+    if cached:
+        logger.info(f"Транскрипция из кеша ({cached['backend']}): {len(cached['text'])} символов")
+        return cached['text']
+
+    try:
+        duration, _ = await probe_media(audio_file_path)
+    except Exception as e:
+        logger.debug(f"Длительность аудио не определена ({e!r}) - транскрибирую целиком")
+        duration = 0
+
+    backends = select_transcription_backends(duration)
+    if not backends:
+        logger.error(f"Нет доступного backend'а транскрипции (TRANSCRIBE_BACKEND={TRANSCRIBE_BACKEND})")
+        return None
+
+    for backend in backends:
+        try:
+            started = time.monotonic()
+            if backend.chunked and duration > TRANSCRIBE_CHUNK_SECONDS * TRANSCRIBE_CHUNK_SLACK:
+                transcription_text = await transcribe_chunked(backend, audio_file_path, duration, language)
+            else:
+                upload = await prepare_audio_upload(audio_file_path)
+                if upload is None:
+                    return None
+                async with transcribe_semaphore:
+                    transcription_text = await backend.transcribe(upload, language)
+
+            logger.info(f"Транскрипция получена ({backend.name}, {time.monotonic() - started:.1f}s): {len(transcription_text)} символов")
+            if transcription_text:
+                await transcript_cache.put(sha256, file_unique_id, transcription_text, language, duration, backend.name)
+            return transcription_text
+
+        except Exception as e:
+            logger.error(f"Ошибка транскрипции аудио ({backend.name}): {e!r}")
+
+    return None
+
+
+async def attach_audio_transcript(file_info: dict) -> dict:
+    """
+    Добавляет к аудиофайлу транскрипцию (transcript_path).
+    Кешируется рядом с файлом (имя содержит хеш содержимого): <путь>.transcript.txt.
+    """
+    if not TRANSCRIBE_AUDIO_FILES:
+        return file_info
+
+    transcript_path = f"{file_info['path']}.transcript.txt"
+    if os.path.exists(transcript_path):
+        touch_file(transcript_path)
+        logger.info(f"Транскрипция аудио из кеша: {transcript_path}")
+    else:
+        transcript = await transcribe_audio(file_info['path'], language="ru", file_unique_id=file_info.get('file_unique_id'))
+        if not transcript:
+            return file_info
+        write_file_atomic(transcript_path, transcript)
+
+    file_info['transcript_path'] = transcript_path
+    return file_info
+
+
+async def transcribe_voice(voice_info: dict) -> str | None:
+    """Транскрипция голосового: из кеша (файл не скачивался) или заново. Скачанный файл после неё удаляется."""
+    if voice_info.get('transcript'):
+        return voice_info['transcript']
+
+    try:
+        return await transcribe_audio(voice_info['path'], language="ru", file_unique_id=voice_info.get('file_unique_id'))
+    finally:
+        # Удаляем файл голосового - текст уже в transcript_cache
+        try:
+            if os.path.exists(voice_info['path']):
+                os.remove(voice_info['path'])
+        except Exception as e:
+            logger.warning(f"Не удалось удалить файлы голосового: {e}")
+
+
+async def ingest_message(message: Message) -> tuple[list[dict], dict | None]:
+    """
+    Вся подготовка сообщения к отправке Claude: вложения скачаны (с превью, текстом, кадрами),
+    голосовое транскрибировано (voice_info['transcript'], None - ошибка).
+    """
+    files, voice_info = await save_message_files(message)
+    if voice_info:
+        voice_info['transcript'] = await transcribe_voice(voice_info)
+    return files, voice_info
+
+
+def start_ingest(chat: ChatState, messages: list[Message]):
+    """
+    Запускает подготовку сообщений в фоне сразу при получении (задачи привязаны к чату до отправки).
+    Пока идёт обратный отсчёт auto-mode или накопление /multi, файлы уже качаются и транскрибируются.
+    """
+    for message in messages:
+        if message.message_id not in chat.ingest_tasks:
+            chat.ingest_tasks[message.message_id] = (message, asyncio.create_task(ingest_message(message)))
+
+
+def cancel_ingest(chat: ChatState, messages: list[Message]):
+    """Отменяет фоновую подготовку сброшенных сообщений."""
+    for message in messages:
+        entry = chat.ingest_tasks.pop(message.message_id, None)
+        if entry:
+            entry[1].cancel()
+
+
+async def collect_ingest(chat: ChatState, messages: list[Message]) -> list[tuple[list[dict], dict | None]]:
+    """
+    Результаты подготовки в порядке сообщений; сообщения без фоновой задачи готовятся сейчас (параллельно).
+    Задачи остаются в chat.ingest_tasks, пока не готовы все: их файлы защищены от очистки uploads.
+    """
+    start_ingest(chat, messages)
+    try:
+        return await asyncio.gather(*(chat.ingest_tasks[message.message_id][1] for message in messages))
+    finally:
+        for message in messages:
+            chat.ingest_tasks.pop(message.message_id, None)
+
+
+async def submit_accumulated_messages(chat_id: int, messages_list: list, bot):
+    """
+    Отправляет накопленные сообщения в Claude Code.
+    Используется как для multi-mode, так и для auto-mode.
+    Дожидается фоновой подготовки (start_ingest: файлы, транскрипция), затем задача ставится в очередь.
+
+    Args:
+        chat_id: ID чата пользователя
+        messages_list: Список сообщений для отправки
+        bot: Экземпляр бота для отправки статусных сообщений
+    """
+    if not messages_list:
+        logger.warning("submit_accumulated_messages вызван с пустым списком")
+        return
+
+    chat = chats.get(chat_id)
+    if not chat:
+        return
+
+    async with chat.ingest_lock:
+        logger.info(f"[{chat_id}] Обработка {len(messages_list)} накопленных сообщений")
+
+        # Обрабатываем все сообщения и собираем файлы + текст
+        all_files = []
+        all_texts = []
+
+        # Подготовка началась при получении сообщений - здесь только ждём (порядок сохраняется)
+        saved = await collect_ingest(chat, messages_list)
+
+        for msg, (files, voice_info) in zip(messages_list, saved):
+            # Сохраняем файлы если есть
+            if files:
+                all_files.extend(files)
+
+            # Собираем текст
+            text = msg.text or msg.caption or ""
+
+            # Обработка голосового сообщения
+            if voice_info:
+                transcription = voice_info['transcript']
+                if transcription:
+                    text += f"\n\n🎤 Голосовое сообщение: {transcription}"
+                else:
+                    await bot.send_message(
+                        chat_id=chat_id,
+                        text="❌ <b>Ошибка транскрипции голосового сообщения</b>",
+                        parse_mode="HTML"
+                    )
+                    return
+
+            if text:
+                all_texts.append(text)
+
+        # Объединяем все тексты
+        combined_text = "\n\n---\n\n".join(all_texts) if all_texts else ""
+
+        # Логирование
+        logger.info(f"Объединённый текст: {len(combined_text)} символов, {len(all_files)} файл(ов)")
+        message_history.append({
+            "timestamp": datetime.now().isoformat(),
+            "chat_id": chat_id,
+            "from": "user",
+            "text": combined_text,
+            "files": [f['name'] for f in all_files] if all_files else []
+        })
+
+        # Формируем статусное сообщение
+        if all_files:
+            files_info = f"📎 {len(all_files)} файл(ов)"
+            status_emoji = "📎"
+        else:
+            files_info = ""
+            status_emoji = "💬"
+
+        # Ставим в очередь - выполнится сразу или после текущей задачи
+        await enqueue_job(
+            chat,
+            combined_text,
+            all_files,
+            title=f"{status_emoji} Обрабатываю {len(messages_list)} сообщений",
+            details=files_info
+        )
+
+
+# === ОЧИСТКА UPLOADS ===
+
+# Как часто запускать очистку (сек)
+STORAGE_GC_INTERVAL = 10 * 60
+# При превышении квоты чистим до этой доли квоты - чтобы не запускаться на каждом новом файле
+STORAGE_GC_TARGET = 0.9
+# Незавершённые скачивания (.download_*) моложе этого не трогаем (сек)
+STORAGE_GC_TMP_GRACE = 60 * 60
+
+# Статистика очистки (для /status)
+storage_gc_stats = {
+    'runs': 0,
+    'deleted_files': 0,
+    'reclaimed_bytes': 0,
+    'usage_bytes': None,
+    'files': None,
+    'last_run': None
+}
+
+
+def collect_file_paths(files: list[dict] | None) -> list[str]:
+    """Все пути файла задачи: оригинал и производные (превью и т.п. - ключи *_path, кадры - *_paths)."""
+    paths = []
+    for file_info in files or []:
+        paths += [value for key, value in file_info.items() if (key == 'path' or key.endswith('_path')) and value]
+        for key, value in file_info.items():
+            if key.endswith('_paths') and value:
+                paths += value
+    return paths
+
+
+def get_message_file_ids(message: Message) -> list[str]:
+    """file_unique_id вложений сообщения (фото - в лучшем качестве, как его сохраняет _save_photo)."""
+    file_ids = []
+    for attr, _, _ in MESSAGE_FILE_SAVERS:
+        media = getattr(message, attr)
+        if attr == 'photo' and media:
+            media = media[-1]
+        if media:
+            file_ids.append(media.file_unique_id)
+    return file_ids
+
+
+def get_protected_files() -> set[str]:
+    """
+    Файлы, которые сейчас нужны Claude: текущие сессии, выполняемая задача и задачи в очередях,
+    а также сообщения, которые ещё готовятся или ждут отправки (auto-mode, /multi, альбомы).
+    """
+    protected = set()
+    for chat in chats.values():
+        protected |= chat.session_files
+        for job in chat.job_queue + ([chat.current_job] if chat.current_job else []):
+            protected.update(collect_file_paths(job['files']))
+
+        for message, task in chat.ingest_tasks.values():
+            if not task.done():
+                # Подготовка идёт - защищаем то, что уже лежит в хранилище (производные - по имени)
+                entries = (upload_store.peek(file_id) for file_id in get_message_file_ids(message))
+                protected.update(entry['path'] for entry in entries if entry)
+            elif not task.cancelled() and task.exception() is None:
+                files, voice_info = task.result()
+                protected.update(collect_file_paths(files + ([voice_info] if voice_info else [])))
+    return protected
+
+
+def is_derived_file(path: str, stems: set[str]) -> bool:
+    """Файл назван <stem>.<суффикс> для одного из stems (.extract.json, .frame1.jpg, превью, .skip)."""
+    directory, name = os.path.split(path)
+    while '.' in name:
+        name = name.rsplit('.', 1)[0]
+        if os.path.join(directory, name) in stems:
+            return True
+    return False
+
+
+def collect_storage_files() -> list[tuple[str, int, float]]:
+    """Все файлы uploads и tmp: (путь, размер, время последнего обращения = mtime)."""
+    result = []
+    for root_dir in (UPLOADS_DIR, BOT_TMP_DIR):
+        for dirpath, _, filenames in os.walk(root_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path == UPLOADS_INDEX_FILE:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                result.append((path, stat.st_size, stat.st_mtime))
+    return result
+
+
+def run_storage_gc(protected: set[str]) -> dict:
+    """
+    Один проход очистки (синхронный - запускается в потоке).
+
+    1. Удаляет файлы старше UPLOADS_MAX_AGE_DAYS.
+    2. Если uploads+tmp больше UPLOADS_QUOTA_MB - удаляет давно не использованные файлы
+       (по mtime: повторная отправка файла обновляет его) до STORAGE_GC_TARGET квоты.
+
+    Файлы из protected, их производные и недокачанные файлы не трогаются.
+    """
+    now = time.time()
+    max_age = UPLOADS_MAX_AGE_DAYS * 24 * 60 * 60
+    quota = UPLOADS_QUOTA_MB * 1024 * 1024
+
+    files = collect_storage_files()
+    usage = sum(size for _, size, _ in files)
+    deleted = 0
+    reclaimed = 0
+
+    # Производные файлы защищённого оригинала: <путь>.* (текст, кадры, кеши) и <путь без расширения>.* (превью)
+    stems = protected | {os.path.splitext(path)[0] for path in protected}
+
+    def can_delete(path: str, mtime: float) -> bool:
+        if path in protected or is_derived_file(path, stems):
+            return False
+        if os.path.basename(path).startswith('.download_') and now - mtime < STORAGE_GC_TMP_GRACE:
+            return False
+        return True
+
+    def delete(path: str, size: int) -> bool:
+        nonlocal deleted, reclaimed, usage
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Очистка: не удалось удалить {path}: {e}")
+            return False
+        deleted += 1
+        reclaimed += size
+        usage -= size
+        return True
+
+    remaining = []
+    for path, size, mtime in files:
+        if now - mtime > max_age and can_delete(path, mtime):
+            if delete(path, size):
+                continue
+        remaining.append((path, size, mtime))
+
+    if usage > quota:
+        # Самые давно не использованные - первыми
+        for path, size, mtime in sorted(remaining, key=lambda item: item[2]):
+            if usage <= quota * STORAGE_GC_TARGET:
+                break
+            if can_delete(path, mtime):
+                delete(path, size)
+
+        if usage > quota:
+            logger.warning(f"Очистка: квота превышена ({format_bytes(usage)}), остальные файлы защищены")
+
+    return {
+        'deleted_files': deleted,
+        'reclaimed_bytes': reclaimed,
+        'usage_bytes': usage,
+        'files': len(files) - deleted
+    }
+
+
+async def storage_gc_loop():
+    """Background task - периодическая очистка uploads и tmp по возрасту и квоте."""
+    while True:
+        try:
+            result = await asyncio.to_thread(run_storage_gc, get_protected_files())
+            if result['deleted_files']:
+                forgotten = upload_store.prune()
+                logger.info(
+                    f"🗑 Очистка: удалено {result['deleted_files']} файлов, освобождено "
+                    f"{format_bytes(result['reclaimed_bytes'])}, занято {format_bytes(result['usage_bytes'])} "
+                    f"(записей индекса убрано: {forgotten})"
+                )
 
-            files.append({
-                'type': 'video_note',
-                'path': local_path,
-                'name': local_filename,
-                'size': video_note.file_size,
-                'caption': message.caption
-            })
+            storage_gc_stats['runs'] += 1
+            storage_gc_stats['deleted_files'] += result['deleted_files']
+            storage_gc_stats['reclaimed_bytes'] += result['reclaimed_bytes']
+            storage_gc_stats['usage_bytes'] = result['usage_bytes']
+            storage_gc_stats['files'] = result['files']
+            storage_gc_stats['last_run'] = datetime.now()
+        except Exception as e:
+            logger.error(f"Ошибка очистки uploads: {e}")
 
-            logger.info(f"Видео-заметка сохранена: {local_path}")
+        # Заодно сохраняем время использования записей кеша транскрипций (LRU)
+        await transcript_cache.flush()
 
-        except Exception as e:
-            logger.error(f"Ошибка сохранения видео-заметки: {e}")
+        await asyncio.sleep(STORAGE_GC_INTERVAL)
 
-    return files, voice_info
 
+# === AUTO-MODE: АДАПТИВНЫЙ DEBOUNCE ===
 
-async def transcribe_audio(audio_file_path: str, language: str = "ru") -> str | None:
-    """
-    Транскрибирует аудио файл используя OpenAI gpt-4o-transcribe.
+# Сколько последних пауз между сообщениями и размеров пакетов помнить (на чат)
+DEBOUNCE_KEEP_GAPS = 50
+DEBOUNCE_KEEP_BATCHES = 20
+# Короткий текст без вложений - кандидат на мгновенную отправку (символов)
+DEBOUNCE_SHORT_TEXT = 300
+# Мгновенная отправка, если пакеты с продолжением встречаются не чаще этой доли
+DEBOUNCE_INSTANT_MAX_FOLLOWUP = 0.25
 
-    Модель gpt-4o-transcribe - улучшенная модель транскрипции от OpenAI,
-    предоставляющая лучшую точность чем Whisper (меньше Word Error Rate),
-    особенно для речи с акцентами и в шумной среде.
 
-    Стоимость: $0.006 за минуту аудио (gpt-4o-transcribe)
-    Лимит: 25 MB файл, до 2000 токенов на выход
+def debounce_followup_rate(chat: ChatState) -> float:
+    """Доля пакетов, в которых пользователь дописывал сообщения (пока истории мало - считаем это вероятным)."""
+    sizes = chat.auto_mode['batch_sizes']
+    followups = sum(1 for size in sizes if size > 1)
+    return (followups + 1) / (len(sizes) + 2)
 
-    Args:
-        audio_file_path: Путь к аудио файлу (ogg, mp3, mp4, mpeg, mpga, m4a, wav, webm)
-        language: Код языка (ru, en, etc.) - опционально, помогает точности
 
-    Returns:
-        Текст транскрипции или None в случае ошибки
+def debounce_window(chat: ChatState) -> float:
     """
-    import subprocess
-    converted_file = None
-
-    try:
-        from openai import OpenAI
+    Сколько ждать продолжения: чуть больше обычной паузы пользователя между сообщениями одного пакета
+    (p90 x1.5), в пределах AUTO_MODE_MIN_WINDOW..AUTO_MODE_WINDOW.
+    """
+    gaps = chat.auto_mode['gaps']
+    if len(gaps) < 3:
+        return AUTO_MODE_WINDOW
+    return min(AUTO_MODE_WINDOW, max(AUTO_MODE_MIN_WINDOW, percentile(gaps, 0.9) * 1.5 + 0.5))
 
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            logger.warning("OPENAI_API_KEY не найден в .env - транскрипция пропущена")
-            return None
 
-        client = OpenAI(api_key=api_key)
+def should_submit_instantly(chat: ChatState, messages: list[Message]) -> bool:
+    """Одиночный короткий текст в начале пакета от пользователя, который обычно не дописывает."""
+    auto_mode = chat.auto_mode
+    if not AUTO_MODE_INSTANT or len(messages) != 1 or auto_mode['messages'] or auto_mode['waiting_for_next']:
+        return False
 
-        # Конвертируем .oga в .mp3 если нужно (Telegram отправляет голосовые в .oga)
-        file_to_transcribe = audio_file_path
-        if audio_file_path.endswith('.oga') or audio_file_path.endswith('.ogg'):
-            converted_file = audio_file_path.rsplit('.', 1)[0] + '.mp3'
-            logger.info(f"Конвертация {audio_file_path} -> {converted_file}")
+    message = messages[0]
+    if not message.text or len(message.text) > DEBOUNCE_SHORT_TEXT:
+        return False
 
-            # ffmpeg -i input.oga -codec:a libmp3lame -q:a 2 output.mp3
-            result = subprocess.run(
-                ['ffmpeg', '-i', audio_file_path, '-codec:a', 'libmp3lame', '-q:a', '2', converted_file, '-y'],
-                capture_output=True,
-                text=True
-            )
+    return debounce_followup_rate(chat) <= DEBOUNCE_INSTANT_MAX_FOLLOWUP
 
-            if result.returncode != 0:
-                logger.error(f"Ошибка конвертации аудио: {result.stderr}")
-                return None
 
-            file_to_transcribe = converted_file
-            logger.info("Конвертация завершена")
+def record_debounce_arrival(chat: ChatState):
+    """
+    Запоминает паузу перед сообщением, если оно продолжает пакет.
+    Сообщение вскоре после уже отправленного пакета - тоже продолжение: окно было коротким
+    (или мгновенная отправка поспешила), пакет помечается как продолженный.
+    """
+    auto_mode = chat.auto_mode
+    now = time.monotonic()
+    last = auto_mode['last_message_at']
+    auto_mode['last_message_at'] = now
 
-        # Открываем аудио файл и отправляем на транскрипцию
-        with open(file_to_transcribe, "rb") as audio_file:
-            logger.info(f"Отправка аудио на транскрипцию (gpt-4o-transcribe): {file_to_transcribe}")
+    if last is None or now - last > AUTO_MODE_WINDOW * 2:
+        return
 
-            transcription = client.audio.transcriptions.create(
-                model="gpt-4o-transcribe",  # Новая модель с лучшей точностью
-                file=audio_file,
-                response_format="text",
-                language=language,
-                temperature=0.0,
-            )
+    auto_mode['gaps'].append(now - last)
+    del auto_mode['gaps'][:-DEBOUNCE_KEEP_GAPS]
 
-            # API возвращает строку напрямую при response_format="text"
-            transcription_text = transcription.strip() if transcription else ""
+    if not auto_mode['messages'] and auto_mode['batch_sizes']:
+        auto_mode['batch_sizes'][-1] = max(2, auto_mode['batch_sizes'][-1])
 
-            logger.info(f"Транскрипция получена: {len(transcription_text)} символов")
-            return transcription_text
 
-    except ImportError:
-        logger.error("Библиотека openai не установлена. Установите: pip install openai")
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка транскрипции аудио: {e}")
-        return None
-    finally:
-        # Удаляем временный конвертированный файл
-        if converted_file and os.path.exists(converted_file):
-            try:
-                os.remove(converted_file)
-                logger.debug(f"Удалён временный файл: {converted_file}")
-            except Exception as e:
-                logger.warning(f"Не удалось удалить временный файл {converted_file}: {e}")
+def record_debounce_batch(chat: ChatState, size: int):
+    """Запоминает размер отправленного пакета."""
+    sizes = chat.auto_mode['batch_sizes']
+    sizes.append(size)
+    del sizes[:-DEBOUNCE_KEEP_BATCHES]
 
 
-async def submit_accumulated_messages(chat_id: int, messages_list: list, bot):
-    """
-    Отправляет накопленные сообщения в Claude Code.
-    Используется как для multi-mode, так и для auto-mode.
+# === ИСХОДЯЩИЕ ЗАПРОСЫ TELEGRAM ===
 
-    Args:
-        chat_id: ID чата пользователя
-        messages_list: Список сообщений для отправки
-        bot: Экземпляр бота для отправки статусных сообщений
-    """
-    global is_processing, is_stopping, intermediate_message_ids, current_hourglass_message_id
+# Запросы, которые пользователь не ждёт: пропускают вперёд сообщения этого чата
+LOW_PRIORITY_METHODS = (EditMessageText, EditMessageReplyMarkup)
+# Не расходуют поканальный лимит сообщений (только глобальный) и никого не ждут
+CHAT_UNMETERED_METHODS = (DeleteMessage, SendChatAction)
+# Правки одного сообщения: если пока правка ждала очереди пришла новая, старая не отправляется
+COALESCED_METHODS = (EditMessageText, EditMessageReplyMarkup)
+# Сколько раз повторять запрос после TelegramRetryAfter
+OUTBOUND_RETRY_ATTEMPTS = 3
 
-    if not messages_list:
-        logger.warning("submit_accumulated_messages вызван с пустым списком")
-        return
+# Статистика исходящих запросов (для /status)
+outbound_stats = {
+    'requests': 0,
+    'delayed': 0,
+    'retry_after': 0,
+    'coalesced': 0
+}
 
-    # Проверяем блокировку
-    if is_processing or is_stopping:
-        await bot.send_message(
-            chat_id=chat_id,
-            text="⏳ <b>Подожди немного</b>\n\nЯ ещё обрабатываю предыдущее сообщение.",
-            parse_mode="HTML"
-        )
-        return
 
-    # Удаляем промежуточные сообщения от предыдущей задачи
-    await cleanup_intermediate_messages()
-    intermediate_message_ids.clear()
-    current_hourglass_message_id = None
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity; flood-wait Telegram блокирует его целиком."""
 
-    # Устанавливаем флаг блокировки
-    is_processing = True
-    logger.info(f"Обработка {len(messages_list)} накопленных сообщений")
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
 
-    # Обрабатываем все сообщения и собираем файлы + текст
-    all_files = []
-    all_texts = []
+    def wait_time(self) -> float:
+        """Сколько ждать до свободного токена (0 - можно сейчас)."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
 
-    for msg in messages_list:
-        # Сохраняем файлы если есть
-        files, voice_info = await save_message_files(msg)
-        if files:
-            all_files.extend(files)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
 
-        # Собираем текст
-        text = msg.text or msg.caption or ""
+    def blocked_time(self) -> float:
+        """Сколько ещё действует flood-wait (0 - не заблокирован)."""
+        return max(0.0, self.blocked_until - time.monotonic())
 
-        # Обработка голосового сообщения
-        if voice_info:
-            try:
-                transcription = await transcribe_audio(voice_info['path'], language="ru")
-                if transcription:
-                    text += f"\n\n🎤 Голосовое сообщение: {transcription}"
-                else:
-                    await bot.send_message(
-                        chat_id=chat_id,
-                        text="❌ <b>Ошибка транскрипции голосового сообщения</b>",
-                        parse_mode="HTML"
-                    )
-                    is_processing = False
-                    return
-            finally:
-                # Удаляем файлы голосового
-                import os
-                try:
-                    if os.path.exists(voice_info['path']):
-                        os.remove(voice_info['path'])
-                    mp3_path = voice_info['path'].rsplit('.', 1)[0] + '.mp3'
-                    if os.path.exists(mp3_path):
-                        os.remove(mp3_path)
-                except Exception as e:
-                    logger.warning(f"Не удалось удалить файлы голосового: {e}")
+    def take(self):
+        self.tokens -= 1
 
-        if text:
-            all_texts.append(text)
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
 
-    # Объединяем все тексты
-    combined_text = "\n\n---\n\n".join(all_texts) if all_texts else ""
 
-    # Логирование
-    logger.info(f"Объединённый текст: {len(combined_text)} символов, {len(all_files)} файл(ов)")
-    message_history.append({
-        "timestamp": datetime.now().isoformat(),
-        "from": "user",
-        "text": combined_text,
-        "files": [f['name'] for f in all_files] if all_files else []
-    })
+class OutboundRateLimiter(BaseRequestMiddleware):
+    """
+    Единая точка для всех исходящих запросов бота (middleware сессии aiogram):
+    хендлеры, HTTP API для Claude, фоновые циклы.
 
-    # Формируем статусное сообщение
-    if all_files:
-        files_info = f"{len(all_files)} файл(ов)"
-        status_emoji = "📎"
-    else:
-        files_info = ""
-        status_emoji = "💬"
+    - Запросы к чату проходят через глобальный и поканальный token bucket
+      (лимиты Telegram: ~30 сообщений/сек на бота, ~1/сек в личке, 20/мин в группе).
+      Удаления и chat action - только через глобальный.
+    - Правки ждут, пока в чате есть видимые сообщения, ещё не получившие токен.
+    - Из нескольких ожидающих правок одного сообщения уходит только последняя.
+    - TelegramRetryAfter блокирует bucket чата на retry_after, запрос повторяется.
 
-    # Проверяем активную сессию
-    session_id = read_active_session()
+    Запросы без chat_id (getUpdates, getFile, ...) проходят без ограничений.
+    """
 
-    if session_id:
-        # Продолжить существующую сессию
-        logger.info(f"Продолжаю сессию: {session_id}")
-        status_msg = f"{status_emoji} Обрабатываю {len(messages_list)} сообщений (продолжение сессии)..."
-        if files_info:
-            status_msg += f"\n📎 {files_info}"
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.high_waiting = {}  # {chat_id: сколько видимых сообщений ждут токена}
+        self.edit_generations = {}  # {(chat_id, message_id): номер последней правки}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            # Группы и каналы (отрицательный chat_id) - 20 сообщений в минуту
+            if isinstance(chat_id, int) and chat_id > 0:
+                self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+            else:
+                self.chat_buckets[chat_id] = TokenBucket(20 / 60, TELEGRAM_CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    def _edit_checker(self, edit_key, generation):
+        """Проверка, что правка generation всё ещё последняя для edit_key."""
+        return lambda: self.edit_generations.get(edit_key) == generation
+
+    async def _acquire(self, chat_id, method, is_current=None) -> bool:
+        """Ждёт токены bucket'ов. False - запрос устарел (is_current вернул False)."""
+        bucket = self._chat_bucket(chat_id)
+        metered = not isinstance(method, CHAT_UNMETERED_METHODS)
+        low_priority = isinstance(method, LOW_PRIORITY_METHODS)
+        # Видимое сообщение считается ожидающим только до получения токена
+        counted = metered and not low_priority
+        if counted:
+            self.high_waiting[chat_id] = self.high_waiting.get(chat_id, 0) + 1
+
+        delayed = False
+        try:
+            while True:
+                if is_current is not None and not is_current():
+                    return False
+
+                # Flood-wait чата действует и на запросы без поканального лимита
+                chat_delay = bucket.wait_time() if metered else bucket.blocked_time()
+                delay = max(self.global_bucket.wait_time(), chat_delay)
+                if delay == 0 and low_priority and self.high_waiting.get(chat_id):
+                    delay = 0.05  # Сначала уходят сообщения, которые пользователь ждёт
+                if delay == 0:
+                    self.global_bucket.take()
+                    if metered:
+                        bucket.take()
+                    if delayed:
+                        outbound_stats['delayed'] += 1
+                    return True
+
+                delayed = True
+                await asyncio.sleep(delay)
+        finally:
+            if counted:
+                self.high_waiting[chat_id] -= 1
+                if not self.high_waiting[chat_id]:
+                    self.high_waiting.pop(chat_id)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        outbound_stats['requests'] += 1
+
+        is_current = None
+        edit_key = None
+        if isinstance(method, COALESCED_METHODS) and getattr(method, 'message_id', None):
+            edit_key = (chat_id, method.message_id)
+            generation = self.edit_generations.get(edit_key, 0) + 1
+            self.edit_generations[edit_key] = generation
+            is_current = self._edit_checker(edit_key, generation)
 
-        sent_msg = await bot.send_message(chat_id=chat_id, text=status_msg)
-        intermediate_message_ids.append(sent_msg.message_id)
-        current_hourglass_message_id = await send_progress_indicator()
+        try:
+            for attempt in range(OUTBOUND_RETRY_ATTEMPTS + 1):
+                if not await self._acquire(chat_id, method, is_current):
+                    outbound_stats['coalesced'] += 1
+                    logger.debug(f"Правка сообщения {edit_key} пропущена - есть более новая")
+                    return True
 
-        await resume_session(session_id, combined_text, all_files)
-    else:
-        # Создать новую сессию
-        logger.info("Создаю новую сессию Claude Code")
-        status_msg = f"{status_emoji} Обрабатываю {len(messages_list)} сообщений (новая сессия)..."
-        if files_info:
-            status_msg += f"\n📎 {files_info}"
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    outbound_stats['retry_after'] += 1
+                    if attempt == OUTBOUND_RETRY_ATTEMPTS:
+                        raise
+                    logger.warning(
+                        f"Flood-wait Telegram для чата {chat_id}: {e.retry_after} сек "
+                        f"({type(method).__name__}, попытка {attempt + 1}/{OUTBOUND_RETRY_ATTEMPTS})"
+                    )
+                    self._chat_bucket(chat_id).block(e.retry_after)
+        finally:
+            if edit_key and is_current():
+                self.edit_generations.pop(edit_key, None)
 
-        sent_msg = await bot.send_message(chat_id=chat_id, text=status_msg)
-        intermediate_message_ids.append(sent_msg.message_id)
-        current_hourglass_message_id = await send_progress_indicator()
 
-        await start_new_session(combined_text, all_files)
+outbound_limiter = OutboundRateLimiter()
 
 
 # === HANDLERS TELEGRAM ===
@@ -1095,7 +3766,7 @@ async def submit_accumulated_messages(chat_id: int, messages_list: list, bot):
 @router.message(CommandStart())
 async def cmd_start(message: Message):
     """Обработчик команды /start"""
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         logger.warning(f"Неавторизованный доступ от {message.chat.id}")
         await message.answer("⛔ Доступ запрещён")
         return
@@ -1117,27 +3788,90 @@ async def cmd_start(message: Message):
 @router.message(Command("status"))
 async def cmd_status(message: Message):
     """Обработчик команды /status"""
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
     uptime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    session_id = read_active_session()
+    session_id = read_active_session(chat)
 
     # Эмодзи и название режима
-    if current_model == "haiku":
+    if chat.current_model == "haiku":
         model_emoji, model_name = "⚡️", "Быстрый"
-    elif current_model == "opus":
+    elif chat.current_model == "opus":
         model_emoji, model_name = "🧠", "Умный"
     else:  # sonnet
         model_emoji, model_name = "⚖️", "Оптимальный"
 
     session_info = f"📝 Сессия: <code>{session_id[:8]}...</code>" if session_id else "📝 Сессия: нет"
 
+    # Статистика последнего запуска Claude
+    last_run_stats = chat.last_run_stats
+    if last_run_stats:
+        ttft = last_run_stats['ttft']
+        run_info = (
+            f"⏱ Последний запуск: <code>{last_run_stats['model']}</code>, "
+            f"{last_run_stats['duration']:.1f}s, "
+            f"TTFT {f'{ttft:.1f}s' if ttft is not None else '—'}"
+        )
+        if last_run_stats['cost'] is not None:
+            run_info += f", ${last_run_stats['cost']:.4f}"
+        if last_run_stats['cpu_time'] is not None:
+            run_info += (
+                f"\n🖥 Ресурсы: CPU {last_run_stats['cpu_time']:.1f}s, "
+                f"пик RSS {format_bytes(last_run_stats['peak_rss'])}, "
+                f"дочерних {last_run_stats['max_children']}"
+            )
+    else:
+        run_info = "⏱ Последний запуск: —"
+
+    # Накопленные ресурсы по моделям - какие модели дороже для хоста
+    for model, stats in model_resource_stats.items():
+        run_info += (
+            f"\n   • <code>{model}</code>: {stats['runs']} запусков, "
+            f"{stats['wall']:.0f}s, CPU {stats['cpu']:.0f}s, пик RSS {format_bytes(stats['peak_rss'])}"
+        )
+
+    queue_info = f"📥 Очередь: {len(chat.job_queue)}"
+    if chat.job_queue or chat.current_job:
+        queue_info += f", ETA {format_eta(estimate_queue_eta(chat))}"
+    if chat.pending_question:
+        queue_info += " (пауза: ждёт ответа на вопрос)"
+
+    warm_workers = sum(len(workers) for workers in claude_pool.values())
+    pool_info = (
+        f"🔥 Пул CLI: тёплых {warm_workers}, "
+        f"hit {claude_pool_stats['hits']} / miss {claude_pool_stats['misses']}"
+    )
+    slots_info = f"🎛 Запусков Claude: {running_claude_jobs}/{CLAUDE_MAX_CONCURRENT} (чатов: {len(chats)})"
+    if storage_gc_stats['usage_bytes'] is not None:
+        storage_info = (
+            f"🗑 Uploads: {format_bytes(storage_gc_stats['usage_bytes'])} из {UPLOADS_QUOTA_MB} MB "
+            f"({storage_gc_stats['files']} файлов), освобождено {format_bytes(storage_gc_stats['reclaimed_bytes'])}"
+        )
+    else:
+        storage_info = "🗑 Uploads: ещё не проверялись"
+    slots_info += f"\n{storage_info}"
+    slots_info += (
+        f"\n📤 Telegram: {outbound_stats['requests']} запросов, ждали лимита {outbound_stats['delayed']}, "
+        f"flood-wait {outbound_stats['retry_after']}, пропущено правок {outbound_stats['coalesced']}"
+    )
+
+    soft_deadline, hard_deadline = get_run_deadlines(chat.current_model)
+    slots_info += (
+        f"\n🐕 Watchdog: ping {int(soft_deadline / 60)} мин, стоп {int(hard_deadline / 60)} мин, "
+        f"тишина {int(CLAUDE_STALL_TIMEOUT / 60)} мин"
+    )
+
     await message.answer(
         f"✅ <b>Бот работает</b>\n\n"
         f"🕐 Время сервера: {uptime}\n"
-        f"{model_emoji} Режим: <b>{model_name}</b> (<code>{current_model}</code>)\n"
+        f"{model_emoji} Режим: <b>{model_name}</b> (<code>{chat.current_model}</code>)\n"
         f"{session_info}\n"
+        f"{run_info}\n"
+        f"{queue_info}\n"
+        f"{pool_info}\n"
+        f"{slots_info}\n"
         f"📨 Сообщений в истории: {len(message_history)}\n"
         f"🆔 Ваш chat_id: <code>{message.chat.id}</code>",
         parse_mode="HTML"
@@ -1147,7 +3881,7 @@ async def cmd_status(message: Message):
 @router.message(Command("help"))
 async def cmd_help(message: Message):
     """Обработчик команды /help"""
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
 
     help_text = (
@@ -1156,8 +3890,8 @@ async def cmd_help(message: Message):
         "Начать работу с ботом. Показывает приветственное сообщение.\n\n"
 
         "<b>💬 Обычное сообщение (Auto-mode)</b>\n"
-        "Просто напиши мне любое сообщение - появится таймер на 5 секунд. "
-        "Можешь добавить ещё сообщения или дождаться автоотправки. "
+        "Просто напиши мне любое сообщение - появится таймер (до 5 секунд, подстраивается под твой темп). "
+        "Можешь добавить ещё сообщения или дождаться автоотправки. Короткий вопрос уходит сразу. "
         "Claude выполнит задачу и отправит результат.\n\n"
 
         "<b>📝 /multi</b>\n"
@@ -1202,13 +3936,14 @@ async def cmd_help(message: Message):
 @router.message(Command("stop"))
 async def cmd_stop(message: Message):
     """Обработчик команды /stop - останавливает выполнение без ожидания ответа"""
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
-    session_id = read_active_session()
+    session_id = read_active_session(chat)
 
     # Останавливаем процесс если работает
-    stopped = await stop_claude_process()
+    stopped = await stop_claude_process(chat)
 
     if stopped:
         if session_id:
@@ -1223,25 +3958,25 @@ async def cmd_stop(message: Message):
     else:
         await message.answer("ℹ️ Нет активного процесса для остановки", parse_mode="HTML")
 
-    logger.info("Процесс остановлен командой /stop")
+    logger.info(f"[{chat.chat_id}] Процесс остановлен командой /stop")
 
 
 @router.message(Command("end"))
 async def cmd_end(message: Message):
     """Обработчик команды /end - завершает сессию полностью"""
-    global pending_question
-
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
-    session_id = read_active_session()
+    session_id = read_active_session(chat)
 
     # Останавливаем процесс если работает
-    stopped = await stop_claude_process()
+    stopped = await stop_claude_process(chat)
 
-    # Очищаем session_id и pending_question
-    clear_session()
-    pending_question = None
+    # Очищаем session_id и pending_question (очередь снимается с паузы)
+    clear_session(chat)
+    chat.pending_question = None
+    chat.job_queue_event.set()
 
     if session_id:
         msg = f"✅ <b>Сессия завершена</b>\n\n"
@@ -1254,29 +3989,30 @@ async def cmd_end(message: Message):
     else:
         await message.answer("ℹ️ Нет активной сессии", parse_mode="HTML")
 
-    logger.info("Сессия завершена командой /end")
+    logger.info(f"[{chat.chat_id}] Сессия завершена командой /end")
 
 
 @router.message(Command("restart"))
 async def cmd_restart(message: Message):
     """Обработчик команды /restart - перезапускает контейнер бота"""
-    global pending_question
-
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
     # Останавливаем активный процесс если есть
-    await stop_claude_process()
+    await stop_claude_process(chat)
+    await claude_pool_shutdown()
 
-    # Очищаем сессию и pending_question
-    clear_session()
-    pending_question = None
+    # Очищаем сессию, очередь задач и pending_question этого чата
+    clear_session(chat)
+    clear_job_queue(chat)
+    chat.pending_question = None
 
     # Отправляем сообщение перед перезапуском
     await message.answer(
         "🔄 <b>Перезагружаю бота...</b>\n\n"
         "Контейнер будет перезапущен через несколько секунд.\n"
-        "Все сессии будут очищены.",
+        "Сессия этого чата будет очищена.",
         parse_mode="HTML"
     )
 
@@ -1285,7 +4021,7 @@ async def cmd_restart(message: Message):
     # Сохраняем флаг что нужно отправить сообщение после перезапуска
     restart_flag_file = "/opt/ai-workspace/.claude/skills/telegram-notifier/restart_flag.txt"
     with open(restart_flag_file, 'w') as f:
-        f.write("1")
+        f.write(str(chat.chat_id))
 
     # Запускаем перезапуск контейнера в фоне
     import subprocess
@@ -1299,10 +4035,11 @@ async def cmd_restart(message: Message):
 @router.message(Command("fast"))
 async def cmd_fast(message: Message):
     """Обработчик команды /fast - переключает на быстрый режим (haiku)"""
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
-    set_model("haiku")
+    set_model(chat, "haiku")
     await message.answer(
         "⚡️ <b>Режим: Быстрый</b>\n\n"
         "Модель: <code>haiku</code>\n"
@@ -1316,10 +4053,11 @@ async def cmd_fast(message: Message):
 @router.message(Command("optimal"))
 async def cmd_optimal(message: Message):
     """Обработчик команды /optimal - переключает на оптимальный режим (sonnet)"""
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
-    set_model("sonnet")
+    set_model(chat, "sonnet")
     await message.answer(
         "⚖️ <b>Режим: Оптимальный</b>\n\n"
         "Модель: <code>sonnet</code>\n"
@@ -1333,10 +4071,11 @@ async def cmd_optimal(message: Message):
 @router.message(Command("smart"))
 async def cmd_smart(message: Message):
     """Обработчик команды /smart - переключает на умный режим (opus)"""
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
-    set_model("opus")
+    set_model(chat, "opus")
     await message.answer(
         "🧠 <b>Режим: Умный</b>\n\n"
         "Модель: <code>opus</code>\n"
@@ -1350,15 +4089,14 @@ async def cmd_smart(message: Message):
 @router.message(Command("multi"))
 async def cmd_multi(message: Message):
     """Обработчик команды /multi - включает/выключает режим накопления сообщений"""
-    global multi_mode_active, multi_messages, multi_control_message_ids
-
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         return
+    chat = chats[message.chat.id]
 
     # Переключаем режим
-    multi_mode_active = not multi_mode_active
+    chat.multi_mode_active = not chat.multi_mode_active
 
-    if multi_mode_active:
+    if chat.multi_mode_active:
         # Включаем режим
         await message.answer(
             "📝 <b>Режим накопления включён</b>\n\n"
@@ -1368,19 +4106,20 @@ async def cmd_multi(message: Message):
             "Чтобы выключить режим, отправь /multi ещё раз",
             parse_mode="HTML"
         )
-        logger.info("Режим /multi включён")
+        logger.info(f"[{chat.chat_id}] Режим /multi включён")
     else:
         # Выключаем режим и очищаем накопленные сообщения
-        num_messages = len(multi_messages)
-        multi_messages.clear()
+        num_messages = len(chat.multi_messages)
+        cancel_ingest(chat, chat.multi_messages)
+        chat.multi_messages.clear()
 
         # Удаляем все контрольные сообщения с кнопками
-        for msg_id in multi_control_message_ids:
+        for msg_id in chat.multi_control_message_ids:
             try:
                 await message.bot.delete_message(chat_id=message.chat.id, message_id=msg_id)
             except Exception as e:
                 logger.warning(f"Не удалось удалить контрольное сообщение {msg_id}: {e}")
-        multi_control_message_ids.clear()
+        chat.multi_control_message_ids.clear()
 
         await message.answer(
             f"✅ <b>Режим накопления выключен</b>\n\n"
@@ -1388,53 +4127,71 @@ async def cmd_multi(message: Message):
             f"Возвращаюсь к обычному режиму работы.",
             parse_mode="HTML"
         )
-        logger.info(f"Режим /multi выключён, сброшено {num_messages} сообщений")
+        logger.info(f"[{chat.chat_id}] Режим /multi выключён, сброшено {num_messages} сообщений")
 
 
 @router.message(F.text | F.photo | F.document | F.video | F.audio | F.voice | F.video_note)
 async def handle_message(message: Message):
     """Универсальный обработчик сообщений (текст, фото, документы, видео, аудио, голосовые) - запускает Claude Code"""
-    global is_processing, is_stopping, intermediate_message_ids, current_hourglass_message_id
-    global multi_mode_active, multi_messages, multi_control_message_ids, auto_mode, pending_question
-
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if not is_allowed_chat(message.chat.id):
         logger.warning(f"Неавторизованное сообщение от {message.chat.id}")
         await message.answer("⛔ Доступ запрещён")
         return
 
+    chat = chats[message.chat.id]
+
     # === РЕЖИМ 1: Ответ на вопрос от Claude (/tg-ask) ===
-    if pending_question and message.text:
-        logger.info(f"Получен ответ на вопрос Claude: {message.text[:50]}")
+    if chat.pending_question and message.text:
+        logger.info(f"[{chat.chat_id}] Получен ответ на вопрос Claude: {message.text[:50]}")
 
         # Сбрасываем pending_question
-        pending_question = None
+        chat.pending_question = None
 
-        # Отправляем ответ в Claude через resume_session
-        session_id = read_active_session()
+        # Отправляем ответ в Claude - первым в очереди (очередь ждала этот ответ)
+        session_id = read_active_session(chat)
         if session_id:
             await message.answer("✅ Ответ принят, передаю Claude...", parse_mode="HTML")
-            intermediate_message_ids.clear()
-            current_hourglass_message_id = None
-            is_processing = True
-
-            sent_msg = await message.answer("⏳ Обрабатываю ответ...")
-            intermediate_message_ids.append(sent_msg.message_id)
-            current_hourglass_message_id = await send_progress_indicator()
-
-            await resume_session(session_id, message.text, [])
         else:
             await message.answer("❌ Сессия потеряна, начинаю новую...", parse_mode="HTML")
-            is_processing = True
-            await start_new_session(message.text, [])
+
+        await enqueue_job(chat, message.text, [], title="⏳ Обрабатываю ответ", front=True)
 
         return  # Выходим, не продолжаем обычную обработку
 
+    # Часть альбома - ждём остальные части, альбом пойдёт дальше одним пакетом
+    if message.media_group_id:
+        await collect_media_group(message)
+        return
+
+    await accept_messages(chat, [message])
+
+
+def preview_messages(messages: list[Message], limit: int) -> str:
+    """Превью для контрольного сообщения: текст сообщения или описание альбома."""
+    if len(messages) > 1:
+        caption = next((msg.caption for msg in messages if msg.caption), "")
+        return f"[альбом: {len(messages)} файлов] {caption[:limit]}".strip()
+    message = messages[0]
+    return message.text[:limit] if message.text else "[файл/фото]"
+
+
+async def accept_messages(chat: ChatState, messages: list[Message]):
+    """
+    Приём сообщений в multi-mode или auto-mode.
+    messages - одно сообщение или целый альбом: альбом получает одно контрольное сообщение.
+    """
+    message = messages[-1]
+    auto_mode = chat.auto_mode
+
+    # Скачивание и транскрипция начинаются сразу - пока пользователь думает, I/O уже идёт
+    start_ingest(chat, messages)
+
     # === РЕЖИМ 2: Multi-mode (явный режим накопления) ===
-    if multi_mode_active:
-        logger.info("Multi-mode: добавляю сообщение в очередь")
+    if chat.multi_mode_active:
+        logger.info(f"[{chat.chat_id}] Multi-mode: добавляю сообщение в очередь")
 
         # Добавляем сообщение в список
-        multi_messages.append(message)
+        chat.multi_messages.extend(messages)
 
         # Создаём кнопки [начать сессию] [отменить]
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1444,39 +4201,42 @@ async def handle_message(message: Message):
             ]
         ])
 
-        text_preview = message.text[:50] if message.text else "[файл/фото]"
+        text_preview = preview_messages(messages, 50)
         control_msg = await message.answer(
-            f"📝 <b>Сообщение #{len(multi_messages)} добавлено</b>\n\n"
+            f"📝 <b>Сообщение #{len(chat.multi_messages)} добавлено</b>\n\n"
             f"{text_preview}...\n\n"
-            f"Всего накоплено: <b>{len(multi_messages)}</b> сообщений",
+            f"Всего накоплено: <b>{len(chat.multi_messages)}</b> сообщений",
             parse_mode="HTML",
             reply_markup=keyboard
         )
 
-        multi_control_message_ids.append(control_msg.message_id)
+        chat.multi_control_message_ids.append(control_msg.message_id)
         return  # Выходим, не продолжаем обычную обработку
 
-    # === РЕЖИМ 3: Auto-mode (режим по умолчанию с 5-сек таймером) ===
+    # === РЕЖИМ 3: Auto-mode (режим по умолчанию, адаптивный debounce) ===
     # Если мы здесь, значит multi_mode НЕ активен, используем auto-mode
 
-    logger.info("Auto-mode: запускаю таймер для сообщения")
+    record_debounce_arrival(chat)
+
+    # Короткий одиночный вопрос от пользователя, который обычно не дописывает, - без ожидания
+    if should_submit_instantly(chat, messages):
+        logger.info(f"[{chat.chat_id}] Auto-mode: короткое сообщение без продолжения - отправляю сразу")
+        record_debounce_batch(chat, len(messages))
+        await submit_accumulated_messages(chat.chat_id, messages, message.bot)
+        return
+
+    window = debounce_window(chat)
+    logger.info(f"[{chat.chat_id}] Auto-mode: жду продолжения {window:.1f} сек")
 
     # Добавляем сообщение в auto_mode
-    auto_mode['messages'].append(message)
+    auto_mode['messages'].extend(messages)
     auto_mode['active'] = True
 
-    # Отменяем предыдущий таймер если был
+    # Отменяем предыдущий таймер если был - окно продлевается, пока сообщения идут
     if auto_mode['timer_task'] and not auto_mode['timer_task'].done():
         auto_mode['timer_task'].cancel()
         logger.debug("Отменён предыдущий auto-mode таймер")
 
-    # Удаляем предыдущее контрольное сообщение
-    if auto_mode['control_message_id']:
-        try:
-            await message.bot.delete_message(chat_id=message.chat.id, message_id=auto_mode['control_message_id'])
-        except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее контрольное сообщение: {e}")
-
     # Определяем текст и кнопки в зависимости от состояния
     if auto_mode['waiting_for_next']:
         # Пользователь нажал [+ сообщение], ожидали следующее
@@ -1493,39 +4253,42 @@ async def handle_message(message: Message):
         ]
     ])
 
-    text_preview = message.text[:80] if message.text else "[файл/фото]"
-    control_msg = await message.answer(
+    text_preview = preview_messages(messages, 80)
+    control_text = (
         f"✅ <b>{keyboard_text}</b>\n\n"
         f"{text_preview}...\n\n"
-        f"Через 5 секунд отправлю Claude, либо выбери действие:",
-        parse_mode="HTML",
-        reply_markup=keyboard
+        f"Через {window:.0f} сек отправлю Claude, либо выбери действие:"
     )
 
-    auto_mode['control_message_id'] = control_msg.message_id
+    # Пакет продолжается - одно редактирование контрольного сообщения вместо удаления и новой отправки
+    control_message_id = None
+    if auto_mode['control_message_id']:
+        try:
+            await message.bot.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=auto_mode['control_message_id'],
+                text=control_text,
+                parse_mode="HTML",
+                reply_markup=keyboard
+            )
+            control_message_id = auto_mode['control_message_id']
+        except Exception as e:
+            logger.debug(f"Не удалось обновить контрольное сообщение: {e}")
+            try:
+                await message.bot.delete_message(chat_id=message.chat.id, message_id=auto_mode['control_message_id'])
+            except Exception as e:
+                logger.warning(f"Не удалось удалить предыдущее контрольное сообщение: {e}")
+
+    if control_message_id is None:
+        control_msg = await message.answer(control_text, parse_mode="HTML", reply_markup=keyboard)
+        control_message_id = control_msg.message_id
+
+    auto_mode['control_message_id'] = control_message_id
 
-    # Создаём таймер с анимацией обратного отсчёта (5→4→3→2→1)
+    # Таймер без анимации: одно ожидание, никаких ежесекундных правок сообщения
     async def auto_submit_after_timeout():
         try:
-            # Обратный отсчёт с обновлением каждую секунду
-            for seconds_left in range(5, 0, -1):
-                try:
-                    await message.bot.edit_message_text(
-                        chat_id=message.chat.id,
-                        message_id=control_msg.message_id,
-                        text=(
-                            f"✅ <b>{keyboard_text}</b>\n\n"
-                            f"{text_preview}...\n\n"
-                            f"Через {seconds_left} {'секунд' if seconds_left >= 5 else 'секунды' if seconds_left >= 2 else 'секунду'} отправлю Claude, либо выбери действие:"
-                        ),
-                        parse_mode="HTML",
-                        reply_markup=keyboard
-                    )
-                except Exception as e:
-                    logger.debug(f"Не удалось обновить countdown: {e}")
-
-                # Ждём 1 секунду перед следующим обновлением
-                await asyncio.sleep(1.0)
+            await asyncio.sleep(window)
 
             logger.info("Auto-mode: таймер истёк, отправляю накопленные сообщения")
 
@@ -1541,184 +4304,29 @@ async def handle_message(message: Message):
             auto_mode['active'] = False
             auto_mode['control_message_id'] = None
             auto_mode['waiting_for_next'] = False
+            # Пакет уже забран: следующее сообщение начнёт новый и не должно отменить эту отправку
+            auto_mode['timer_task'] = None
 
+            record_debounce_batch(chat, len(messages_to_send))
             await submit_accumulated_messages(message.chat.id, messages_to_send, message.bot)
         except asyncio.CancelledError:
             logger.debug("Auto-mode таймер отменён")
 
     auto_mode['timer_task'] = asyncio.create_task(auto_submit_after_timeout())
 
-    return  # Выходим, сообщение будет обработано позже через таймер или кнопку
-
-    # === ОБЫЧНЫЙ РЕЖИМ (КОД НИЖЕ УЖЕ НЕ ДОЛЖЕН ВЫПОЛНЯТЬСЯ) ===
-    # Весь код ниже достигаться не будет, т.к. всегда сработает один из режимов выше
-
-    # Проверяем: идёт ли уже обработка другого сообщения ИЛИ процесс остановки?
-    if is_processing or is_stopping:
-        text_preview = message.text[:100] if message.text else "[файл/фото]"
-        logger.warning(f"Отклонено сообщение (processing={is_processing}, stopping={is_stopping}): {text_preview}")
-        await message.answer(
-            "⏳ <b>Подожди немного</b>\n\n"
-            "Я ещё обрабатываю предыдущее сообщение.\n"
-            "Напиши снова когда получишь ответ.",
-            parse_mode="HTML"
-        )
-        return
-
-    # Проверяем: это медиа-группа (альбом)?
-    if message.media_group_id:
-        media_group_id = message.media_group_id
-
-        # Если это первое сообщение из группы - создаём запись
-        if media_group_id not in media_groups_cache:
-            media_groups_cache[media_group_id] = {
-                'messages': [],
-                'timer': None
-            }
-
-        # Добавляем сообщение в группу
-        media_groups_cache[media_group_id]['messages'].append(message)
-
-        # Отменяем предыдущий таймер если был
-        if media_groups_cache[media_group_id]['timer']:
-            media_groups_cache[media_group_id]['timer'].cancel()
-
-        # Создаём новый таймер (0.5 секунды после последнего файла)
-        # Когда все файлы придут, таймер сработает и обработает всю группу
-        async def delayed_process():
-            await asyncio.sleep(0.5)
-            await process_media_group(media_group_id)
-
-        media_groups_cache[media_group_id]['timer'] = asyncio.create_task(delayed_process())
-
-        logger.info(f"Добавлено сообщение в медиа-группу {media_group_id} ({len(media_groups_cache[media_group_id]['messages'])} файлов)")
-        return  # НЕ обрабатываем сейчас, дождёмся всех файлов
-
-    # Удаляем промежуточные сообщения от предыдущей задачи
-    await cleanup_intermediate_messages()
-
-    # Очищаем списки промежуточных сообщений перед новой сессией
-    intermediate_message_ids.clear()
-    current_hourglass_message_id = None
-    logger.debug("Списки промежуточных сообщений очищены перед новой сессией")
-
-    # Устанавливаем флаг блокировки (только для одиночных сообщений)
-    is_processing = True
-    logger.info("Флаг is_processing установлен (начало обработки)")
-
-    # Сохраняем файлы если есть
-    files, voice_info = await save_message_files(message)
-
-    # Формируем текст сообщения
-    user_text = message.text or message.caption or ""
-
-    # Обработка голосового сообщения (если есть)
-    if voice_info:
-        logger.info("🎤 Обнаружено голосовое сообщение, начинаю транскрипцию...")
-
-        try:
-            # Транскрибируем голосовое сообщение
-            transcription = await transcribe_audio(voice_info['path'], language="ru")
-
-            if transcription:
-                # Успешно - добавляем транскрипцию к тексту сообщения
-                voice_text = f"\n\n🎤 <b>Голосовое сообщение:</b>\n{transcription}"
-                user_text = user_text + voice_text if user_text else voice_text.strip()
-                logger.info(f"✅ Транскрипция успешна: {len(transcription)} символов")
-            else:
-                # Транскрипция не удалась - показываем ошибку
-                error_msg = (
-                    "❌ <b>Ошибка транскрипции голосового сообщения</b>\n\n"
-                    "Не удалось расшифровать голосовое сообщение. "
-                    "Возможные причины:\n"
-                    "• Не настроен OPENAI_API_KEY\n"
-                    "• Проблемы с API OpenAI\n"
-                    "• Неподдерживаемый формат аудио"
-                )
-                await message.answer(error_msg, parse_mode="HTML")
-                logger.error("Транскрипция не удалась - останавливаем обработку")
-                is_processing = False
-                return
-
-        finally:
-            # ВСЕГДА удаляем файлы голосового (.oga и .mp3 если создан)
-            import os
-            try:
-                if os.path.exists(voice_info['path']):
-                    os.remove(voice_info['path'])
-                    logger.debug(f"Удалён .oga файл: {voice_info['path']}")
-
-                # Удаляем .mp3 если был создан при конвертации
-                mp3_path = voice_info['path'].rsplit('.', 1)[0] + '.mp3'
-                if os.path.exists(mp3_path):
-                    os.remove(mp3_path)
-                    logger.debug(f"Удалён .mp3 файл: {mp3_path}")
-            except Exception as e:
-                logger.warning(f"Не удалось удалить файлы голосового: {e}")
-
-    # Логирование
-    text_preview = user_text[:100] if user_text else f"[{len(files)} файл(ов)]"
-    logger.info(f"Получено сообщение: {text_preview}")
-    message_history.append({
-        "timestamp": datetime.now().isoformat(),
-        "from": "user",
-        "text": user_text,
-        "files": [f['name'] for f in files] if files else []
-    })
-
-    # Формируем статусное сообщение
-    if files:
-        files_info = ", ".join([f"{f['type']}: {f['name']}" for f in files])
-        status_emoji = "📸" if files[0]['type'] == 'photo' else "📎"
-    else:
-        files_info = ""
-        status_emoji = "💬"
-
-    # Проверяем активную сессию
-    session_id = read_active_session()
-
-    if session_id:
-        # Продолжить существующую сессию
-        logger.info(f"Продолжаю сессию: {session_id}")
-        status_msg = f"{status_emoji} Обрабатываю (продолжение сессии)..."
-        if files_info:
-            status_msg += f"\n📎 {files_info}"
-
-        # Отправляем статусное сообщение и трекаем его
-        sent_msg = await message.answer(status_msg)
-        intermediate_message_ids.append(sent_msg.message_id)
-
-        # Отправляем индикатор прогресса (custom emoji из NewsEmoji)
-        current_hourglass_message_id = await send_progress_indicator()
-
-        await resume_session(session_id, user_text, files)
-    else:
-        # Создать новую сессию
-        logger.info("Создаю новую сессию Claude Code")
-        status_msg = f"{status_emoji} Обрабатываю (новая сессия)..."
-        if files_info:
-            status_msg += f"\n📎 {files_info}"
-
-        # Отправляем статусное сообщение и трекаем его
-        sent_msg = await message.answer(status_msg)
-        intermediate_message_ids.append(sent_msg.message_id)
-
-        # Отправляем индикатор прогресса (custom emoji из NewsEmoji)
-        current_hourglass_message_id = await send_progress_indicator()
-
-        await start_new_session(user_text, files)
-
-    # Claude САМ отправит ответ через /tg команды
-
 
 @router.callback_query(F.data == "end_session")
 async def handle_end_session(callback: CallbackQuery):
     """Обработчик кнопки 'Завершить сессию' - останавливает процесс и удаляет session_id"""
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    chat = chats[callback.message.chat.id]
+
     # Останавливаем процесс если работает
-    stopped = await stop_claude_process()
+    stopped = await stop_claude_process(chat)
 
     # Очищаем session_id
-    clear_session()
+    clear_session(chat)
 
     msg = "✅ Сессия завершена"
     if stopped:
@@ -1738,8 +4346,12 @@ async def handle_end_session(callback: CallbackQuery):
 @router.callback_query(F.data == "stop_execution")
 async def handle_stop_execution(callback: CallbackQuery):
     """Обработчик кнопки 'Остановить выполнение' - останавливает процесс, но сохраняет session_id"""
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    chat = chats[callback.message.chat.id]
+
     # Останавливаем процесс если работает
-    stopped = await stop_claude_process()
+    stopped = await stop_claude_process(chat)
 
     # НЕ очищаем session_id - следующее сообщение возобновит сессию
 
@@ -1763,7 +4375,9 @@ async def handle_stop_execution(callback: CallbackQuery):
 @router.callback_query(F.data == "continue_session")
 async def handle_continue_session(callback: CallbackQuery):
     """Обработчик кнопки 'Продолжить работу' (при неактивности)"""
-    update_activity()
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    update_activity(chats[callback.message.chat.id])
     await callback.answer("✅ Таймер сброшен")
 
     # Удаляем сообщение с предложением
@@ -1778,7 +4392,9 @@ async def handle_continue_session(callback: CallbackQuery):
 @router.callback_query(F.data == "auto_add_message")
 async def handle_auto_add_message(callback: CallbackQuery):
     """Обработчик кнопки '+ Добавить сообщение' в auto-mode"""
-    global auto_mode
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    auto_mode = chats[callback.message.chat.id].auto_mode
 
     # Отменяем таймер
     if auto_mode['timer_task'] and not auto_mode['timer_task'].done():
@@ -1802,7 +4418,7 @@ async def handle_auto_add_message(callback: CallbackQuery):
     # Отправляем новое сообщение
     await callback.message.answer(
         "📝 <b>Отправь следующее сообщение</b>\n\n"
-        "После отправки снова появится таймер на 5 секунд.",
+        "После отправки снова появится таймер.",
         parse_mode="HTML"
     )
 
@@ -1810,7 +4426,10 @@ async def handle_auto_add_message(callback: CallbackQuery):
 @router.callback_query(F.data == "auto_cancel")
 async def handle_auto_cancel(callback: CallbackQuery):
     """Обработчик кнопки 'Отменить запрос' в auto-mode"""
-    global auto_mode
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    chat = chats[callback.message.chat.id]
+    auto_mode = chat.auto_mode
 
     # Отменяем таймер
     if auto_mode['timer_task'] and not auto_mode['timer_task'].done():
@@ -1818,7 +4437,8 @@ async def handle_auto_cancel(callback: CallbackQuery):
 
     num_messages = len(auto_mode['messages'])
 
-    # Очищаем auto_mode
+    # Очищаем auto_mode (и останавливаем скачивание/транскрипцию сброшенных сообщений)
+    cancel_ingest(chat, auto_mode['messages'])
     auto_mode['messages'].clear()
     auto_mode['active'] = False
     auto_mode['control_message_id'] = None
@@ -1838,7 +4458,11 @@ async def handle_auto_cancel(callback: CallbackQuery):
 @router.callback_query(F.data == "multi_start_session")
 async def handle_multi_start_session(callback: CallbackQuery):
     """Обработчик кнопки 'Начать сессию' в multi-mode"""
-    global multi_messages, multi_control_message_ids
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    chat = chats[callback.message.chat.id]
+    multi_messages = chat.multi_messages
+    multi_control_message_ids = chat.multi_control_message_ids
 
     if not multi_messages:
         await callback.answer("❌ Нет накопленных сообщений")
@@ -1868,11 +4492,16 @@ async def handle_multi_start_session(callback: CallbackQuery):
 @router.callback_query(F.data == "multi_cancel")
 async def handle_multi_cancel(callback: CallbackQuery):
     """Обработчик кнопки 'Отменить' в multi-mode"""
-    global multi_messages, multi_control_message_ids
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    chat = chats[callback.message.chat.id]
+    multi_messages = chat.multi_messages
+    multi_control_message_ids = chat.multi_control_message_ids
 
     num_messages = len(multi_messages)
 
-    # Очищаем multi_mode
+    # Очищаем multi_mode (и останавливаем скачивание/транскрипцию сброшенных сообщений)
+    cancel_ingest(chat, multi_messages)
     multi_messages.clear()
 
     # Удаляем все контрольные сообщения
@@ -1890,16 +4519,18 @@ async def handle_multi_cancel(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("answer_"))
 async def handle_question_answer(callback: CallbackQuery):
     """Обработчик ответов на вопросы Claude (/tg-ask)"""
-    global pending_question, is_processing
+    if not is_allowed_chat(callback.message.chat.id):
+        return
+    chat = chats[callback.message.chat.id]
 
-    if not pending_question:
+    if not chat.pending_question:
         await callback.answer("❌ Нет активного вопроса")
         return
 
     # Извлекаем индекс ответа
     try:
         answer_index = int(callback.data.split("_")[1])
-        answer_text = pending_question['options'][answer_index]
+        answer_text = chat.pending_question['options'][answer_index]
     except (IndexError, ValueError) as e:
         logger.error(f"Ошибка извлечения ответа: {e}")
         await callback.answer("❌ Ошибка обработки ответа")
@@ -1914,30 +4545,20 @@ async def handle_question_answer(callback: CallbackQuery):
         pass
 
     # Сбрасываем pending_question
-    pending_question = None
+    chat.pending_question = None
 
-    # Отправляем ответ в Claude через resume_session
-    session_id = read_active_session()
+    # Отправляем ответ в Claude - первым в очереди (очередь ждала этот ответ)
+    session_id = read_active_session(chat)
     if session_id:
         await callback.answer("✅ Ответ отправлен Claude")
 
         # Показываем пользователю что было выбрано
         await callback.message.answer(f"✅ Ты выбрал: <b>{answer_text}</b>", parse_mode="HTML")
-
-        intermediate_message_ids.clear()
-        current_hourglass_message_id = None
-        is_processing = True
-
-        sent_msg = await callback.message.answer("⏳ Обрабатываю ответ...")
-        intermediate_message_ids.append(sent_msg.message_id)
-        current_hourglass_message_id = await send_progress_indicator()
-
-        await resume_session(session_id, answer_text, [])
     else:
         await callback.answer("❌ Сессия потеряна")
         await callback.message.answer("❌ Сессия потеряна, начинаю новую...", parse_mode="HTML")
-        is_processing = True
-        await start_new_session(answer_text, [])
+
+    await enqueue_job(chat, answer_text, [], title="⏳ Обрабатываю ответ", front=True)
 
 
 # Старые обработчики handle_photo и handle_document удалены
@@ -1946,16 +4567,29 @@ async def handle_question_answer(callback: CallbackQuery):
 
 # === HTTP API ДЛЯ CLAUDE ===
 
+def resolve_api_chat(raw_chat_id) -> ChatState | None:
+    """
+    Определяет чат для запроса к HTTP API.
+    Claude получает свой chat_id через TG_BOT_CHAT_ID; без него - основной чат.
+    """
+    if raw_chat_id in (None, ""):
+        return chats[ALLOWED_CHAT_ID]
+    try:
+        return chats.get(int(raw_chat_id))
+    except (TypeError, ValueError):
+        return None
+
+
 async def send_message_handler(request):
     """
     POST /send
-    Body: {"text": "message", "parse_mode": "HTML"}
+    Body: {"text": "message", "parse_mode": "HTML", "chat_id": 123}
+
+    chat_id необязателен (по умолчанию - основной чат).
 
     Поддерживает специальную команду /tg-ask для вопросов с кнопками:
     {"text": "/tg-ask {\"question\": \"Вопрос?\", \"options\": [\"Вариант 1\", \"Вариант 2\"]}"}
     """
-    global pending_question
-
     try:
         data = await request.json()
         text = data.get("text")
@@ -1964,6 +4598,10 @@ async def send_message_handler(request):
         if not text:
             return web.json_response({"error": "text is required"}, status=400)
 
+        chat = resolve_api_chat(data.get("chat_id"))
+        if not chat:
+            return web.json_response({"error": "chat_id is not allowed"}, status=403)
+
         # === ОБРАБОТКА /tg-ask (вопросы с кнопками) ===
         if text.strip().startswith("/tg-ask "):
             import json
@@ -1999,25 +4637,25 @@ async def send_message_handler(request):
                 keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
                 # Сохраняем вопрос в pending_question
-                pending_question = {
+                chat.pending_question = {
                     'question': question_text,
                     'options': options
                 }
 
                 # Отправляем вопрос с кнопками
                 sent_message = await bot.send_message(
-                    chat_id=ALLOWED_CHAT_ID,
+                    chat_id=chat.chat_id,
                     text=f"❓ <b>{question_text}</b>\n\n"
                          f"Выбери вариант или напиши свой ответ:",
                     parse_mode="HTML",
                     reply_markup=keyboard
                 )
 
-                logger.info(f"/tg-ask: отправлен вопрос с {len(options)} вариантами")
+                logger.info(f"[{chat.chat_id}] /tg-ask: отправлен вопрос с {len(options)} вариантами")
 
                 # Останавливаем процесс Claude (как при "Остановить выполнение")
                 # НЕ очищаем session_id - следующее сообщение возобновит сессию
-                await stop_claude_process()
+                await stop_claude_process(chat)
                 logger.info("/tg-ask: процесс Claude остановлен, ожидаем ответ пользователя")
 
                 return web.json_response({"success": True, "type": "question"})
@@ -2032,7 +4670,7 @@ async def send_message_handler(request):
         # === ОБЫЧНОЕ СООБЩЕНИЕ ===
 
         # Проверяем есть ли активная сессия
-        session_id = read_active_session()
+        session_id = read_active_session(chat)
 
         # Создаём кнопки управления если сессия активна
         keyboard = None
@@ -2052,38 +4690,37 @@ async def send_message_handler(request):
 
         # Отправляем основное сообщение и сохраняем его ID
         sent_message = await bot.send_message(
-            chat_id=ALLOWED_CHAT_ID,
+            chat_id=chat.chat_id,
             text=text,
             parse_mode=parse_mode,
             reply_markup=keyboard
         )
 
-        logger.info(f"Отправлено сообщение через API: {text[:100]}")
+        logger.info(f"[{chat.chat_id}] Отправлено сообщение через API: {text[:100]}")
         message_history.append({
             "timestamp": datetime.now().isoformat(),
+            "chat_id": chat.chat_id,
             "from": "bot",
             "text": text
         })
 
         # Управление прогресс-индикатором
-        global current_hourglass_message_id
-
         # НЕ добавляем финальные сообщения в intermediate_message_ids!
         # Они должны оставаться в чате, только промежуточные "/update" и статусы удаляются
 
         # Удаляем предыдущий индикатор прогресса ⌛ если есть
-        if current_hourglass_message_id:
+        if chat.current_hourglass_message_id:
             try:
-                await bot.delete_message(chat_id=ALLOWED_CHAT_ID, message_id=current_hourglass_message_id)
-                logger.debug(f"Удален предыдущий ⌛: {current_hourglass_message_id}")
+                await bot.delete_message(chat_id=chat.chat_id, message_id=chat.current_hourglass_message_id)
+                logger.debug(f"Удален предыдущий ⌛: {chat.current_hourglass_message_id}")
             except Exception as e:
                 logger.warning(f"Не удалось удалить предыдущий ⌛: {e}")
 
         # Отправляем новый индикатор прогресса (custom emoji из NewsEmoji)
-        current_hourglass_message_id = await send_progress_indicator()
-        logger.debug(f"Отправлен новый прогресс-индикатор: {current_hourglass_message_id}")
+        chat.current_hourglass_message_id = await send_progress_indicator(chat.chat_id)
+        logger.debug(f"Отправлен новый прогресс-индикатор: {chat.current_hourglass_message_id}")
 
-        update_activity()  # Обновляем время активности
+        update_activity(chat)  # Обновляем время активности
 
         return web.json_response({"success": True})
 
@@ -2095,7 +4732,7 @@ async def send_message_handler(request):
 async def send_file_handler(request):
     """
     POST /send_file
-    Multipart form: file=<binary>, caption=<text>
+    Multipart form: file=<binary>, caption=<text>, chat_id=<id> (необязательно)
     """
     try:
         reader = await request.multipart()
@@ -2103,6 +4740,7 @@ async def send_file_handler(request):
         file_data = None
         file_name = None
         caption = None
+        raw_chat_id = None
 
         async for field in reader:
             if field.name == 'file':
@@ -2110,20 +4748,26 @@ async def send_file_handler(request):
                 file_data = await field.read()
             elif field.name == 'caption':
                 caption = await field.text()
+            elif field.name == 'chat_id':
+                raw_chat_id = await field.text()
 
         if not file_data:
             return web.json_response({"error": "file is required"}, status=400)
 
+        chat = resolve_api_chat(raw_chat_id)
+        if not chat:
+            return web.json_response({"error": "chat_id is not allowed"}, status=403)
+
         # Сохраняем временно
-        tmp_dir = "/opt/ai-workspace/.claude/skills/telegram-notifier/tmp"
-        temp_path = f"{tmp_dir}/{file_name}"
+        os.makedirs(BOT_TMP_DIR, exist_ok=True)
+        temp_path = f"{BOT_TMP_DIR}/{file_name}"
         with open(temp_path, "wb") as f:
             f.write(file_data)
         os.chmod(temp_path, 0o644)  # Читаемый для всех
 
         # Отправляем
         await bot.send_document(
-            chat_id=ALLOWED_CHAT_ID,
+            chat_id=chat.chat_id,
             document=FSInputFile(temp_path),
             caption=caption,
             parse_mode="HTML"
@@ -2132,7 +4776,7 @@ async def send_file_handler(request):
         # Удаляем временный файл
         os.remove(temp_path)
 
-        logger.info(f"Отправлен файл через API: {file_name}")
+        logger.info(f"[{chat.chat_id}] Отправлен файл через API: {file_name}")
         return web.json_response({"success": True, "file": file_name})
 
     except Exception as e:
@@ -2151,6 +4795,67 @@ async def health_handler(request):
 
 # === ЗАПУСК ===
 
+async def notify_inactive_chat(chat: ChatState, interval_30min: int, interval_8h: int):
+    """Отправляет уведомления о неактивности сессии одного чата."""
+    inactive_time = time.time() - chat.last_activity_time
+
+    # Уведомление через 30 минут (только если ещё не отправляли)
+    if inactive_time >= interval_30min and not chat.notification_30min_sent:
+        logger.info(f"[{chat.chat_id}] Сессия неактивна {int(inactive_time/60)} минут - отправляю первое уведомление")
+
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(
+                text="✅ Продолжить работу",
+                callback_data="continue_session"
+            )],
+            [InlineKeyboardButton(
+                text="❌ Завершить сессию",
+                callback_data="end_session"
+            )]
+        ])
+
+        try:
+            await bot.send_message(
+                chat.chat_id,
+                f"⏰ <b>Сессия неактивна 30 минут</b>\n\n"
+                f"Хочешь завершить сессию или продолжить работу?",
+                parse_mode="HTML",
+                reply_markup=keyboard
+            )
+            chat.notification_30min_sent = True
+            logger.info("✅ Первое уведомление (30 мин) отправлено")
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления о неактивности (30 мин): {e}")
+
+    # Уведомление через 8 часов (только если ещё не отправляли)
+    if inactive_time >= interval_8h and not chat.notification_8h_sent:
+        logger.info(f"[{chat.chat_id}] Сессия неактивна {int(inactive_time/3600)} часов - отправляю второе уведомление")
+
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(
+                text="✅ Продолжить работу",
+                callback_data="continue_session"
+            )],
+            [InlineKeyboardButton(
+                text="❌ Завершить сессию",
+                callback_data="end_session"
+            )]
+        ])
+
+        try:
+            await bot.send_message(
+                chat.chat_id,
+                f"⏰ <b>Сессия неактивна 8 часов</b>\n\n"
+                f"Хочешь завершить сессию или продолжить работу?",
+                parse_mode="HTML",
+                reply_markup=keyboard
+            )
+            chat.notification_8h_sent = True
+            logger.info("✅ Второе уведомление (8 часов) отправлено")
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления о неактивности (8 часов): {e}")
+
+
 async def check_inactivity_loop():
     """
     Background task - проверяет неактивность сессии.
@@ -2160,71 +4865,12 @@ async def check_inactivity_loop():
     INTERVAL_8H = 8 * 60 * 60  # 8 часов в секундах
     CHECK_INTERVAL = 5 * 60  # Проверяем каждые 5 минут
 
-    global notification_30min_sent, notification_8h_sent
-
     while True:
         await asyncio.sleep(CHECK_INTERVAL)
 
-        session_id = read_active_session()
-
-        if session_id:
-            inactive_time = time.time() - last_activity_time
-
-            # Уведомление через 30 минут (только если ещё не отправляли)
-            if inactive_time >= INTERVAL_30MIN and not notification_30min_sent:
-                logger.info(f"Сессия неактивна {int(inactive_time/60)} минут - отправляю первое уведомление")
-
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(
-                        text="✅ Продолжить работу",
-                        callback_data="continue_session"
-                    )],
-                    [InlineKeyboardButton(
-                        text="❌ Завершить сессию",
-                        callback_data="end_session"
-                    )]
-                ])
-
-                try:
-                    await bot.send_message(
-                        ALLOWED_CHAT_ID,
-                        f"⏰ <b>Сессия неактивна 30 минут</b>\n\n"
-                        f"Хочешь завершить сессию или продолжить работу?",
-                        parse_mode="HTML",
-                        reply_markup=keyboard
-                    )
-                    notification_30min_sent = True
-                    logger.info("✅ Первое уведомление (30 мин) отправлено")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки уведомления о неактивности (30 мин): {e}")
-
-            # Уведомление через 8 часов (только если ещё не отправляли)
-            if inactive_time >= INTERVAL_8H and not notification_8h_sent:
-                logger.info(f"Сессия неактивна {int(inactive_time/3600)} часов - отправляю второе уведомление")
-
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(
-                        text="✅ Продолжить работу",
-                        callback_data="continue_session"
-                    )],
-                    [InlineKeyboardButton(
-                        text="❌ Завершить сессию",
-                        callback_data="end_session"
-                    )]
-                ])
-
-                try:
-                    await bot.send_message(
-                        ALLOWED_CHAT_ID,
-                        f"⏰ <b>Сессия неактивна 8 часов</b>\n\n"
-                        f"Хочешь завершить сессию или продолжить работу?",
-                        parse_mode="HTML",
-                        reply_markup=keyboard
-                    )
-                    notification_8h_sent = True
-                    logger.info("✅ Второе уведомление (8 часов) отправлено")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки уведомления о неактивности (8 часов): {e}")
+        for chat in chats.values():
+            if read_active_session(chat):
+                await notify_inactive_chat(chat, INTERVAL_30MIN, INTERVAL_8H)
 
 
 async def start_http_server():
@@ -2266,6 +4912,11 @@ async def check_restart_flag():
 
     if os.path.exists(restart_flag_file):
         try:
+            # Флаг содержит chat_id, из которого пришёл /restart
+            with open(restart_flag_file, 'r') as f:
+                flag = f.read().strip()
+            chat = resolve_api_chat(flag if flag != "1" else None) or chats[ALLOWED_CHAT_ID]
+
             # Удаляем флаг
             os.remove(restart_flag_file)
 
@@ -2274,7 +4925,7 @@ async def check_restart_flag():
 
             # Отправляем сообщение о готовности
             await bot.send_message(
-                ALLOWED_CHAT_ID,
+                chat.chat_id,
                 "✅ <b>Бот перезапущен и готов к работе!</b>\n\n"
                 "Все сессии очищены, можешь начинать работу.",
                 parse_mode="HTML"
@@ -2287,11 +4938,24 @@ async def check_restart_flag():
 async def main():
     """Главная функция"""
     logger.info("🚀 Запуск Telegram бота...")
-    logger.info(f"Разрешённый chat_id: {ALLOWED_CHAT_ID}")
+    logger.info(f"Разрешённые chat_id: {ALLOWED_CHAT_IDS} (основной: {ALLOWED_CHAT_ID})")
+
+    # Все исходящие запросы - через лимиты Telegram и обработку flood-wait
+    bot.session.middleware(outbound_limiter)
 
     # Устанавливаем меню команд
     await set_bot_commands()
 
+    # Загружаем сессии чатов в память (дальше файлы сессий только пишутся)
+    for chat in chats.values():
+        session_store.load(chat)
+
+    # История длительностей запусков - для дедлайнов watchdog
+    load_run_history()
+
+    # Кеш транскрипций (до TRANSCRIPT_CACHE_MB) читаем при старте, а не на первом голосовом
+    transcript_cache.load()
+
     # Запускаем HTTP API
     await start_http_server()
 
@@ -2299,6 +4963,24 @@ async def main():
     asyncio.create_task(check_inactivity_loop())
     logger.info("✅ Background task неактивности запущен")
 
+    # Запускаем исполнителей очередей задач (с восстановлением очереди после перезапуска)
+    load_job_queue()
+    for chat in chats.values():
+        asyncio.create_task(job_queue_consumer(chat))
+    logger.info(f"✅ Очереди задач запущены (чатов: {len(chats)}, одновременно: {CLAUDE_MAX_CONCURRENT})")
+
+    # Очистка uploads и tmp по квоте и возрасту
+    asyncio.create_task(storage_gc_loop())
+    logger.info(f"✅ Очистка uploads запущена (квота {UPLOADS_QUOTA_MB} MB, возраст {UPLOADS_MAX_AGE_DAYS:g} дн.)")
+
+    # Локальная транскрипция: модель грузится заранее и остаётся в памяти
+    if TRANSCRIBE_BACKEND in ('auto', 'local') and transcription_backends['local'].available():
+        asyncio.create_task(transcription_backends['local'].warm_up())
+
+    # Прогреваем пул Claude CLI
+    asyncio.create_task(claude_pool_maintenance_loop())
+    logger.info(f"✅ Пул Claude CLI запущен (размер: {CLAUDE_POOL_SIZE})")
+
     # Проверяем флаг перезапуска
     asyncio.create_task(check_restart_flag())
 
@@ -2307,7 +4989,14 @@ async def main():
 
     # Запускаем polling
     logger.info("✅ Бот готов к работе")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await claude_pool_shutdown()
+        shutdown_extract_pool()
+        for backend in transcription_backends.values():
+            await backend.shutdown()
+        await transcript_cache.flush()
 
 
 if __name__ == "__main__":
@@ -27,6 +27,8 @@ set -euo pipefail
 
 # Конфигурация
 BOT_API="http://localhost:8081"
+# Чат, из которого запущен Claude (бот передаёт его в окружение); пусто - основной чат
+CHAT_ID="${TG_BOT_CHAT_ID:-}"
 
 # Цвета для вывода
 RED='\033[0;31m'
@@ -95,7 +97,7 @@ fi
 check_bot_running
 
 # Формируем /tg-ask команду в правильном формате
-# Бот ожидает: {"text": "/tg-ask {...}", "parse_mode": "HTML"}
+# Бот ожидает: {"text": "/tg-ask {...}", "parse_mode": "HTML", "chat_id": ...}
 TG_ASK_PAYLOAD=$(jq -n \
     --arg question "$QUESTION" \
     --argjson options "$OPTIONS" \
@@ -106,7 +108,8 @@ FULL_TEXT="/tg-ask $TG_ASK_PAYLOAD"
 # Отправка через /send endpoint
 response=$(curl -s -X POST "$BOT_API/send" \
     -H "Content-Type: application/json" \
-    -d "{\"text\": $(echo "$FULL_TEXT" | jq -Rs .), \"parse_mode\": \"HTML\"}")
+    -d "$(jq -n --arg text "$FULL_TEXT" --arg chat_id "$CHAT_ID" \
+        '{text: $text, parse_mode: "HTML"} + (if $chat_id != "" then {chat_id: $chat_id} else {} end)')")
 
 # Проверка результата
 if echo "$response" | jq -e '.success' > /dev/null 2>&1; then
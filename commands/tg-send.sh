@@ -12,6 +12,8 @@ set -euo pipefail
 
 # Конфигурация
 BOT_API="http://localhost:8081"
+# Чат, из которого запущен Claude (бот передаёт его в окружение); пусто - основной чат
+CHAT_ID="${TG_BOT_CHAT_ID:-}"
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 ROOT_DIR="$(dirname "$SCRIPT_DIR")"
 
@@ -52,7 +54,8 @@ send_text() {
     local response
     response=$(curl -s -X POST "$BOT_API/send" \
         -H "Content-Type: application/json" \
-        -d "{\"text\": $(echo "$text" | jq -Rs .), \"parse_mode\": \"$parse_mode\"}")
+        -d "$(jq -n --arg text "$text" --arg parse_mode "$parse_mode" --arg chat_id "$CHAT_ID" \
+            '{text: $text, parse_mode: $parse_mode} + (if $chat_id != "" then {chat_id: $chat_id} else {} end)')")
 
     if echo "$response" | jq -e '.success' > /dev/null 2>&1; then
         success "Сообщение отправлено"
@@ -72,16 +75,17 @@ send_file() {
         error "Файл не найден: $file_path"
     fi
 
-    local response
+    local form=(-F "file=@$file_path")
     if [[ -n "$caption" ]]; then
-        response=$(curl -s -X POST "$BOT_API/send_file" \
-            -F "file=@$file_path" \
-            -F "caption=$caption")
-    else
-        response=$(curl -s -X POST "$BOT_API/send_file" \
-            -F "file=@$file_path")
+        form+=(-F "caption=$caption")
+    fi
+    if [[ -n "$CHAT_ID" ]]; then
+        form+=(-F "chat_id=$CHAT_ID")
     fi
 
+    local response
+    response=$(curl -s -X POST "$BOT_API/send_file" "${form[@]}")
+
     if echo "$response" | jq -e '.success' > /dev/null 2>&1; then
         local filename=$(echo "$response" | jq -r '.file')
         success "Файл отправлен: $filename"